@@ -0,0 +1,135 @@
+import argparse
+import random
+
+from curriculum import SUBJECT_TO_TOPICS
+from db import get_pool, query_all, with_connection
+from generation import PROMPT_VARIANTS
+
+# Ratings from this many days back steer the choice of prompt variant
+VARIANT_WINDOW_DAYS = 90
+
+# Add a rating to the daily rollups. A paper's rating counts once under topic '' and once for each of its topics, so
+# totals by subject, level or difficulty read the '' rows and totals by topic read the others.
+ROLLUP_UPSERT = '''
+                INSERT INTO rating_rollups (subject, topic, acad_level, difficulty, prompt_variant, day, ratings, rating_sum)
+                VALUES (?, ?, ?, ?, ?, ?, 1, ?)
+                ON CONFLICT (subject, topic, acad_level, difficulty, prompt_variant, day) DO UPDATE SET
+                    ratings = ratings + 1,
+                    rating_sum = rating_sum + excluded.rating_sum
+                '''
+
+# Topics of a paper from the comma-joined string stored with it. Topic names can contain commas themselves, so the
+# subject's known topics are matched first and only what is left is split on commas.
+def split_topics(subject, topics):
+    remaining = f", {topics or ''}, "
+    found = []
+    for topic in sorted(SUBJECT_TO_TOPICS.get(subject, []), key=len, reverse=True):
+        if f", {topic}, " in remaining:
+            found.append(topic)
+            remaining = remaining.replace(f", {topic}, ", ", ", 1)
+    found.extend(part.strip() for part in remaining.split(",") if part.strip())
+    return [topic for topic in found if topic != "Any"]
+
+# Store a rating with its topics and add it to the rollups in the same transaction; used as a write-behind job.
+# Only the first rating of a paper is kept.
+def record_feedback(conn, question_hash, subject, topics, rating, feedback, acad_level=None, difficulty=None, prompt_variant=None):
+    row = conn.execute('''
+                       INSERT INTO feedback (question_hash, subject, topics, rating, feedback, acad_level, difficulty, prompt_variant)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                       ON CONFLICT (question_hash) DO NOTHING
+                       RETURNING id, date(timestamp)
+                       ''', (question_hash, subject, topics, rating, feedback, acad_level, difficulty, prompt_variant)).fetchone()
+    if row is None:
+        return
+    feedback_id, day = row
+    paper_topics = split_topics(subject, topics)
+    conn.executemany('INSERT OR IGNORE INTO feedback_topics (feedback_id, topic) VALUES (?, ?)', [(feedback_id, topic) for topic in paper_topics])
+    conn.executemany(ROLLUP_UPSERT, [(subject, topic, acad_level or '', difficulty or '', prompt_variant or '', day, rating)
+                                     for topic in [''] + paper_topics])
+
+# Recompute the topics and rollups of every stored rating
+def rebuild_analytics(conn):
+    conn.execute('DELETE FROM feedback_topics')
+    conn.execute('DELETE FROM rating_rollups')
+    rows = conn.execute('SELECT id, subject, topics FROM feedback').fetchall()
+    conn.executemany('INSERT OR IGNORE INTO feedback_topics (feedback_id, topic) VALUES (?, ?)',
+                     [(feedback_id, topic) for feedback_id, subject, topics in rows for topic in split_topics(subject, topics)])
+    conn.execute('''
+                 INSERT INTO rating_rollups (subject, topic, acad_level, difficulty, prompt_variant, day, ratings, rating_sum)
+                 SELECT f.subject, COALESCE(t.topic, ''), COALESCE(f.acad_level, ''), COALESCE(f.difficulty, ''), COALESCE(f.prompt_variant, ''),
+                        date(f.timestamp), COUNT(*), SUM(f.rating)
+                 FROM feedback f LEFT JOIN (SELECT feedback_id, topic FROM feedback_topics UNION ALL SELECT id, NULL FROM feedback) t
+                     ON t.feedback_id = f.id
+                 GROUP BY 1, 2, 3, 4, 5, 6
+                 ''')
+    return len(rows)
+
+# Prompt variant a stored paper was generated with, if known
+def paper_prompt_variant(conn, question_hash):
+    row = conn.execute('SELECT prompt_variant FROM generated_questions WHERE question_hash = ? AND prompt_variant IS NOT NULL LIMIT 1',
+                       (question_hash,)).fetchone()
+    return row[0] if row else None
+
+# Choose the prompt variant for a paper by Thompson sampling on the variants' ratings for the subject and level.
+# Each rating counts as a share of a success, from 0 for 1 star to 1 for 5 stars; a value is drawn from each variant's
+# Beta distribution and the highest wins. Variants with few ratings have wide distributions and keep being tried,
+# while poorly rated ones are chosen less and less.
+def choose_prompt_variant(conn, subject, acad_level, variants=PROMPT_VARIANTS):
+    rows = conn.execute('''
+                        SELECT prompt_variant, SUM(ratings), SUM(rating_sum) FROM rating_rollups
+                        WHERE subject = ? AND topic = '' AND acad_level = ? AND day >= date('now', ?)
+                        GROUP BY prompt_variant
+                        ''', (subject, acad_level or '', f'-{VARIANT_WINDOW_DAYS} days')).fetchall()
+    ratings = {variant: (count, total) for variant, count, total in rows}
+
+    def draw(variant):
+        count, total = ratings.get(variant, (0, 0))
+        successes = (total - count) / 4
+        return random.betavariate(1 + successes, 1 + count - successes)
+
+    return max(variants, key=draw)
+
+# Columns of the rollups, and how the analytics view labels them
+ROLLUP_LABELS = {
+    "subject": "Subject",
+    "topic": "Topic",
+    "acad_level": "Academic Level",
+    "difficulty": "Difficulty",
+    "prompt_variant": "Prompt Variant",
+}
+
+# Load the rollups of the last `days` days as a DataFrame. pandas is only imported by the analytics view.
+def load_rating_rollups(days):
+    import pandas as pd
+
+    rows = query_all('''
+                     SELECT day, subject, topic, acad_level, difficulty, prompt_variant, ratings, rating_sum
+                     FROM rating_rollups WHERE day >= date('now', ?)
+                     ''', (f'-{days} days',))
+    df = pd.DataFrame(rows, columns=["day", *ROLLUP_LABELS, "ratings", "rating_sum"])
+    df["day"] = pd.to_datetime(df["day"])
+    return df
+
+# Number of ratings and average rating for each value of a rollup column
+def summarize_ratings(df, by):
+    rows = df[df["topic"] != ""] if by == "topic" else df[df["topic"] == ""]
+    summary = rows.groupby(by)[["ratings", "rating_sum"]].sum()
+    summary["average"] = (summary["rating_sum"] / summary["ratings"]).round(2)
+    summary = summary.reset_index().sort_values("average", ascending=False).replace({by: {"": "Not recorded"}})
+    return summary[[by, "ratings", "average"]].rename(columns={by: ROLLUP_LABELS[by], "ratings": "Ratings", "average": "Average rating"})
+
+# Average rating per subject in each time bucket
+def rating_trend(df, bucket="1D"):
+    import pandas as pd
+
+    papers = df[df["topic"] == ""]
+    totals = papers.groupby(["subject", pd.Grouper(key="day", freq=bucket)])[["ratings", "rating_sum"]].sum()
+    return (totals["rating_sum"] / totals["ratings"]).unstack("subject").sort_index()
+
+def main():
+    argparse.ArgumentParser(description="Rebuild the feedback topics and rating rollups from the stored ratings").parse_args()
+    get_pool()
+    print(f"Rebuilt the analytics of {with_connection(rebuild_analytics)} ratings.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+import hashlib
+import os
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import streamlit as st
+
+from shared_state import get_shared_state
+from telemetry import record
+
+# Requests and tokens per minute assumed for a key until its first response reports the real limits in its headers.
+# The limits are for the key as a whole: every replica counts its requests in the shared state store (see shared_state.py).
+DEFAULT_RPM_LIMIT = int(os.environ.get('OPENAI_RPM_LIMIT', 500))
+DEFAULT_TPM_LIMIT = int(os.environ.get('OPENAI_TPM_LIMIT', 450000))
+
+# Completion tokens counted against the tokens-per-minute limit for a request whose response size is not known
+DEFAULT_COMPLETION_TOKENS = 1000
+
+# Requests in flight per key: the starting point and the bounds between which it adapts
+INITIAL_CONCURRENCY = 16
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 64
+
+# When less than this share of a key's requests or tokens is left for the current minute, its concurrency is lowered
+LOW_HEADROOM = 0.1
+
+# Length of the windows in which replicas count a key's requests and tokens together (in seconds)
+SHARED_WINDOW = 60
+
+# Most API keys whose client and limiter are kept, and how long one is kept after its last use (in seconds)
+KEY_CLIENT_CACHE_SIZE = 100
+KEY_CLIENT_IDLE = 60 * 60
+
+# Retry settings for rate-limited or transiently failing requests
+MAX_RETRIES = 5
+BACKOFF_BASE = 1.0  # seconds
+BACKOFF_MAX = 30.0  # seconds
+
+# Tokens counted against the tokens-per-minute limit for a request, estimated the way the API does it: about four
+# characters per prompt token plus the completion tokens the request may produce
+def estimate_request_tokens(messages, completion_tokens=DEFAULT_COMPLETION_TOKENS):
+    return sum(len(message["content"]) for message in messages) // 4 + completion_tokens
+
+def header_number(headers, name):
+    try:
+        return float(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+# Seconds the server asked us to wait before the next request, if it said so
+def retry_after(headers):
+    milliseconds = header_number(headers, 'retry-after-ms')
+    seconds = milliseconds / 1000 if milliseconds is not None else header_number(headers, 'retry-after')
+    return min(seconds, BACKOFF_MAX) if seconds is not None else None
+
+# Full jitter: a random wait of up to the exponential backoff, so that retries from many sessions spread out
+def backoff_delay(attempt):
+    return random.uniform(0, min(BACKOFF_BASE * (2 ** attempt), BACKOFF_MAX))
+
+# Capacity that refills continuously over a minute
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.level = per_minute
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.capacity / 60)
+        self._updated = now
+
+    # Seconds until `amount` is available. Amounts over the capacity only wait for a full bucket.
+    def wait_time(self, amount):
+        self._refill()
+        return max(0.0, (min(amount, self.capacity) - self.level) * 60 / self.capacity)
+
+    def take(self, amount):
+        self._refill()
+        self.level -= min(amount, self.capacity)
+
+    # Adopt the server's limit and its count of what is left for the current minute
+    def sync(self, limit, remaining):
+        self._refill()
+        self.capacity = limit
+        self.level = remaining
+
+# Rate limits of one API key, shared by all sessions using it. Requests wait until the requests-per-minute and
+# tokens-per-minute buckets have room and fewer than `concurrency` requests are in flight. Waiting requests are
+# served one session at a time in turn, so a session with many requests cannot hold up the others.
+# Concurrency adapts additively upwards and multiplicatively downwards: it rises by one after a run of successes,
+# halves on a 429 and drops by one while the rate-limit headers show the minute's allowance nearly used up.
+# With a key_digest, requests are also counted per minute in the shared state store, so replicas sharing a key stay
+# under its limits together rather than each starting from the full allowance.
+class KeyLimiter:
+    def __init__(self, rpm=DEFAULT_RPM_LIMIT, tpm=DEFAULT_TPM_LIMIT, key_digest=None):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.key_digest = key_digest
+        self.concurrency = INITIAL_CONCURRENCY
+        self.active = 0
+        self._successes = 0
+        self._paused_until = 0
+        # Session id -> its waiting requests, in the order the sessions take their turns
+        self._waiting = OrderedDict()
+        self._condition = threading.Condition()
+
+    # Wait for this session's turn and for room under the limits, then count the request as in flight. The shared
+    # window is counted without holding the lock, so a slow shared state store never holds up release() or other sessions
+    # checking their turn; the request keeps its turn meanwhile.
+    def acquire(self, session_id, tokens):
+        ticket = object()
+        with self._condition:
+            self._waiting.setdefault(session_id, deque()).append(ticket)
+        try:
+            while True:
+                with self._condition:
+                    while True:
+                        delay = self._delay(tokens) if self._next_ticket() is ticket else None
+                        if delay == 0:
+                            break
+                        self._condition.wait(delay)
+                    limits = (self.requests.capacity, self.tokens.capacity)
+                wait = self._reserve_shared(tokens, *limits)
+                with self._condition:
+                    if wait == 0:
+                        self.requests.take(1)
+                        self.tokens.take(tokens)
+                        self.active += 1
+                        return
+                    self._paused_until = max(self._paused_until, time.monotonic() + wait)
+        finally:
+            with self._condition:
+                # The session goes to the back of the line, whether it was served or gave up
+                self._waiting[session_id].remove(ticket)
+                if self._waiting[session_id]:
+                    self._waiting.move_to_end(session_id)
+                else:
+                    del self._waiting[session_id]
+                self._condition.notify_all()
+
+    # Count a request as finished, learning from its response headers and HTTP status (None if there was no response)
+    def release(self, headers=None, status=None):
+        with self._condition:
+            self.active -= 1
+            headroom = self._sync(headers or {})
+            if status == 429:
+                self.concurrency = max(MIN_CONCURRENCY, self.concurrency // 2)
+                self._successes = 0
+                self._paused_until = max(self._paused_until, time.monotonic() + (retry_after(headers or {}) or BACKOFF_BASE))
+            elif headroom < LOW_HEADROOM:
+                self.concurrency = max(MIN_CONCURRENCY, self.concurrency - 1)
+                self._successes = 0
+            elif status is not None and status < 400:
+                self._successes += 1
+                if self._successes >= self.concurrency:
+                    self.concurrency = min(MAX_CONCURRENCY, self.concurrency + 1)
+                    self._successes = 0
+            self._condition.notify_all()
+
+    # Count a request in the key's shared window across replicas. Returns 0 if it fits under the limits, otherwise takes
+    # the count back and returns the seconds until the next window.
+    def _reserve_shared(self, tokens, requests_limit, tokens_limit):
+        if self.key_digest is None:
+            return 0
+        tokens = min(tokens, tokens_limit)
+        store = get_shared_state()
+        window = int(time.time() // SHARED_WINDOW)
+        prefix = f"ratelimit:{self.key_digest}:{window}"
+        requests_used = store.incr(f"{prefix}:requests", 1, 2 * SHARED_WINDOW)
+        tokens_used = store.incr(f"{prefix}:tokens", tokens, 2 * SHARED_WINDOW)
+        if requests_used <= requests_limit and tokens_used <= tokens_limit:
+            return 0
+        store.incr(f"{prefix}:requests", -1, 2 * SHARED_WINDOW)
+        store.incr(f"{prefix}:tokens", -tokens, 2 * SHARED_WINDOW)
+        return max((window + 1) * SHARED_WINDOW - time.time(), 0.01)
+
+    def _next_ticket(self):
+        return self._waiting[next(iter(self._waiting))][0]
+
+    # Whether any request is in flight or waiting
+    def in_use(self):
+        with self._condition:
+            return bool(self.active or self._waiting)
+
+    # Seconds until a request of `tokens` tokens may start, or None while the concurrency is used up
+    def _delay(self, tokens):
+        if self.active >= self.concurrency:
+            return None
+        return max(self._paused_until - time.monotonic(), self.requests.wait_time(1), self.tokens.wait_time(tokens), 0)
+
+    # Match the buckets to the rate-limit headers and return the smallest share of the minute's allowance left
+    def _sync(self, headers):
+        headroom = 1.0
+        for bucket, name in ((self.requests, 'requests'), (self.tokens, 'tokens')):
+            limit = header_number(headers, f'x-ratelimit-limit-{name}')
+            remaining = header_number(headers, f'x-ratelimit-remaining-{name}')
+            if limit and remaining is not None:
+                bucket.sync(limit, remaining)
+                headroom = min(headroom, remaining / limit)
+        return headroom
+
+# An API key's client as used by one session
+class SessionClient:
+    def __init__(self, client, limiter, session_id=None):
+        self.client = client
+        self.limiter = limiter
+        self.session_id = session_id
+
+    # Send a chat completion request once the key's limits allow, retrying rate limits and transient failures with
+    # jittered exponential backoff; a 429 also pauses the key for the server's retry-after period. Yields the response
+    # (a stream when stream=True), which counts as in flight until the block exits, so streams are read inside it.
+    # on_retry(attempt) is called before each retry.
+    @contextmanager
+    def completion(self, estimated_tokens, on_retry=None, **params):
+        import openai
+
+        retryable = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+        for attempt in range(MAX_RETRIES + 1):
+            self.limiter.acquire(self.session_id, estimated_tokens)
+            try:
+                raw_response = self.client.chat.completions.with_raw_response.create(**params)
+            except retryable as e:
+                response = getattr(e, 'response', None)
+                self.limiter.release(response.headers if response is not None else None, getattr(e, 'status_code', None))
+                # Retries are recorded, so rate limits show up in the metrics
+                record("api_retry", 0, model=params.get("model"), error=type(e).__name__)
+                if attempt == MAX_RETRIES:
+                    raise
+                if on_retry:
+                    on_retry(attempt + 1)
+                time.sleep(backoff_delay(attempt))
+                continue
+            except BaseException:
+                self.limiter.release()
+                raise
+            try:
+                yield raw_response.parse()
+            finally:
+                self.limiter.release(raw_response.headers, raw_response.status_code)
+            return
+
+# The OpenAI clients and limiters of API keys, each shared by every session using its key. Keyed by the key's digest
+# rather than the key itself. Keys are dropped once unused for `idle` seconds, or least recently used first beyond
+# `size` keys, so keys of teachers who have left are not kept; a key with requests in flight or waiting counts as used,
+# so busy keys keep what their limiter has learned.
+class KeyClients:
+    def __init__(self, size=KEY_CLIENT_CACHE_SIZE, idle=KEY_CLIENT_IDLE):
+        self.size = size
+        self.idle = idle
+        # Key digest -> (client, limiter, time of last use), least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    # The client and limiter of a key, created on its first use. The client makes a single attempt per request, since
+    # retries are done by SessionClient. openai is slow to import, so it is only loaded once a client is needed.
+    def get(self, api_key):
+        import openai
+
+        key_digest = hashlib.sha256((api_key or "").encode()).hexdigest()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.pop(key_digest, None)
+            client, limiter = entry[:2] if entry else (openai.OpenAI(api_key=api_key, max_retries=0), KeyLimiter(key_digest=key_digest))
+            self._entries[key_digest] = (client, limiter, now)
+            self._evict(now)
+        return client, limiter
+
+    def _evict(self, now):
+        for key_digest, (client, limiter, used) in list(self._entries.items()):
+            if len(self._entries) <= self.size and now - used <= self.idle:
+                break
+            del self._entries[key_digest]
+            if limiter.in_use():
+                self._entries[key_digest] = (client, limiter, now)
+
+@st.cache_resource
+def get_key_clients():
+    return KeyClients()
+
+# The client for an API key as used by a session; OPENAI_API_KEY is used when no key is given
+def get_client(api_key=None, session_id=None):
+    client, limiter = get_key_clients().get(api_key or os.environ.get('OPENAI_API_KEY'))
+    return SessionClient(client, limiter, session_id)
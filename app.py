@@ -1,215 +1,196 @@
 import streamlit as st
-import pandas as pd
-import openai
-import PyPDF2
-import io
-import openpyxl
-import sqlite3
-import re
+import tempfile
 import time
-import random
-from datetime import datetime, timedelta
+from datetime import datetime
 import hashlib
 import os
-
-# Apply a custom theme via Streamlit's configuration
-st.set_page_config(page_title="Assessment Generator & Grader", page_icon=":pencil:", layout="wide")
-
-# Load CSS for additional styling
-with open('style.css') as f:
-    st.markdown(f'<style>{f.read()}</style>', unsafe_allow_html=True)
-
-# Setup SQLite database for storing feedback
-conn = sqlite3.connect('feedback.db')
-c = conn.cursor()
-
-# Create or alter table to add subject and topics columns for feedback
-c.execute('''
-          CREATE TABLE IF NOT EXISTS feedback (
-              id INTEGER PRIMARY KEY,
-              question_hash TEXT UNIQUE,
-              subject TEXT NOT NULL,
-              topics TEXT NOT NULL,
-              rating INTEGER NOT NULL,
-              feedback TEXT NOT NULL,
-              timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-          )
-          ''')
-
-# Create table for storing generated questions
-c.execute('''
-          CREATE TABLE IF NOT EXISTS generated_questions (
-              id INTEGER PRIMARY KEY,
-              subject TEXT NOT NULL,
-              difficulty_level TEXT NOT NULL,
-              question_content TEXT NOT NULL,
-              generated_at DATETIME DEFAULT CURRENT_TIMESTAMP
-          )
-          ''')
-conn.commit()
+import uuid
+from curriculum import ACADEMIC_LEVELS, DIFFICULTIES, LANGUAGE_OPTIONS, QUESTION_TYPES, SUBJECT_TO_TOPICS
+from analytics import ROLLUP_LABELS, load_rating_rollups, rating_trend, record_feedback, summarize_ratings
+from api_client import get_client
+from generation import generate_completion
+from grading import GRADING_MAX_WORKERS
+from response_cache import reference_digest
+from db import execute_later, get_pool, query_all, query_one, submit_write
+from exports import EXPORT_FORMATS, export_paper, iter_stored_papers, write_archive
+from retrieval import CANDIDATE_TOKEN_RATIO, CONTEXT_TOKEN_BUDGET, ReferenceIndex, build_query
+from ingest import file_digest, has_cached_pages, iter_pdf_pages, read_pdf_bytes
+from latex import latex_to_markdown
+from prompt_budget import count_tokens, remove_boilerplate
+from question_bank import add_to_bank, start_prewarm_worker
+from shared_state import get_shared_state
+from telemetry import latency_trend, load_metrics, measure, prune_metrics, summarize_metrics
+from questions import build_replacement_prompt, parse_question, questions_to_text, store_paper_questions
+from jobs import CANCELLED, DONE, FAILED, FINISHED_STATUSES, QUEUED, RUNNING, cancel_job, get_job, list_jobs, submit_job
+
+# Apply a custom theme via Streamlit's configuration. The icon is given as an emoji rather than a shortcode such as
+# ":pencil:", which Streamlit first tries to load as an image, importing numpy on every cold start.
+st.set_page_config(page_title="Assessment Generator & Grader", page_icon="✏️", layout="wide")
+
+# Load CSS for additional styling; the file is read once per process rather than on every rerun
+@st.cache_resource
+def load_css():
+    with open('style.css') as f:
+        return f.read()
+
+st.markdown(f'<style>{load_css()}</style>', unsafe_allow_html=True)
 
 # Define cooldown period for feedback submission (in minutes)
 FEEDBACK_COOLDOWN = 10
 
-@st.cache_data
+# How often the page refreshes the progress of background jobs (in seconds)
+JOB_UI_POLL_INTERVAL = 1.0
+
+# Number of recent papers offered as answer keys for grading
+ANSWER_KEY_PAPERS = 50
+
+# Time windows offered on the performance dashboard (in seconds)
+DASHBOARD_WINDOWS = {
+    "Last hour": 60 * 60,
+    "Last 24 hours": 24 * 60 * 60,
+    "Last 7 days": 7 * 24 * 60 * 60,
+    "Last 30 days": 30 * 24 * 60 * 60,
+}
+
+# Time windows offered on the ratings analytics (in days)
+RATINGS_WINDOWS = {
+    "Last 7 days": 7,
+    "Last 30 days": 30,
+    "Last 90 days": 90,
+    "Last year": 365,
+}
+
 # Function to read the content from an uploaded PDF file
 def read_pdf(file):
-    with io.BytesIO(file.getvalue()) as f:
-        reader = PyPDF2.PdfReader(f)
-        text = ''.join([page.extract_text() for page in reader.pages])
-    return text
-
-# Helper function to check if user is within cooldown period for feedback submission
-def within_cooldown(last_feedback_time):
-    if not last_feedback_time:
-        return False
-    cooldown_time = last_feedback_time + timedelta(minutes=FEEDBACK_COOLDOWN)
-    return datetime.now() < cooldown_time
+    data = file.getvalue()
+    with measure("pdf_extraction", cache_hit=has_cached_pages(file_digest(data))):
+        return read_pdf_bytes(data)
+
+# Build (or reuse) the retrieval index for a reference document, keyed by its digest
+@st.cache_resource(max_entries=16)
+def get_reference_index(digest, _text):
+    return ReferenceIndex(_text, count_tokens)
+
+# Helper function to check if user is within cooldown period for feedback submission; returns when it started, or None.
+# The cooldown is kept in the shared state under the session id, so it holds whichever replica serves the session.
+def feedback_cooldown_started(session_id):
+    return get_shared_state().get(f"feedback_cooldown:{session_id}")
+
+# Start the feedback cooldown; returns False if one is already running
+def start_feedback_cooldown(session_id):
+    return get_shared_state().add(f"feedback_cooldown:{session_id}", time.time(), FEEDBACK_COOLDOWN * 60)
 
 # Generate a unique hash for the generated questions to identify feedback
 def generate_question_hash(content):
     return hashlib.sha256(content.encode()).hexdigest()
 
-# Estimate the number of tokens in the text (approximation used for API limits)
-def estimate_tokens(text):
-    words = text.split()
-    return len(words) * 1.33  # Approximation: 1.33 words per token
-
-# Fix repeated units in the content, such as "km/h km/h"
-def fix_repeated_units(content):
-    # Replace repeated occurrences of "km/h" with a single instance
-    content = re.sub(r'(km/h)\s+\1', r'\1', content)
-    # Replace repeated occurrences of "hours" with a single instance
-    content = re.sub(r'(hours)\s+\1', r'\1', content)
-    return content
-
-# Fix unbalanced braces in the content
-def fix_unbalanced_braces(content):
-    # Count the number of opening and closing braces
-    open_braces = content.count('{')
-    close_braces = content.count('}')
-    # Add missing closing braces if there are more opening braces
-    if open_braces > close_braces:
-        content += '}' * (open_braces - close_braces)
-    # Add missing opening braces if there are more closing braces
-    elif close_braces > open_braces:
-        content = '{' * (close_braces - open_braces) + content
-    return content
-
-# Fix nested fractions by ensuring braces are balanced
-def fix_nested_fractions(content):
-    # Regular expression to match LaTeX fraction commands
-    fraction_pattern = r'\\frac\{[^\}]*\}\{[^\}]*\}'
-    # Apply fix_unbalanced_braces to each fraction found
-    content = re.sub(fraction_pattern, lambda match: fix_unbalanced_braces(match.group()), content)
-    return content
-
-# Clean up LaTeX expressions for better formatting
-def clean_latex_expression(content):
-    # Remove unnecessary parentheses around fractions
-    content = re.sub(r'\(\s*\\frac\{[^}]*\}\{[^}]*\}\s*\)', lambda match: match.group(0)[1:-1], content)
-    # Ensure proper spacing in units like km/h and hours
-    content = re.sub(r',\s*\\text{km/h}', r'\\, \text{km/h}', content)
-    content = re.sub(r',\s*\\text{hours}', r'\\, \text{hours}', content)
-    content = re.sub(r'\)\s*km/h', r'\\, \text{km/h})', content)
-    content = re.sub(r'\)\s*hours', r'\\, \text{hours})', content)
-    # Fix fraction formatting by ensuring no extra spaces
-    content = re.sub(r'\\frac\s*\{(.*?)\}\s*\{(.*?)\}', r'\\frac{\1}{\2}', content)
-    # Remove repeated units like "km/h km/h" or "hours hours"
-    content = re.sub(r'(km/h)\s+(km/h)', r'\1', content)
-    content = re.sub(r'(hours)\s+(hours)', r'\1', content)
-    return content
-
-# Apply a series of fixes to LaTeX expressions to improve formatting
-def fix_latex_expressions(content):
-    # Fix unbalanced braces first
-    content = fix_unbalanced_braces(content)
-    # Fix repeated units
-    content = fix_repeated_units(content)
-    # Remove extra spaces inside parentheses
-    content = re.sub(r'\(\s+', '(', content)
-    content = re.sub(r'\s+\)', ')', content)
-    # Clean up LaTeX expressions for better formatting
-    content = clean_latex_expression(content)
-    return content
-
-# Ensure that LaTeX expressions are complete, particularly fractions and text commands
-def complete_latex_expressions(content):
-    # Fix nested fractions by balancing braces
-    content = fix_nested_fractions(content)
-    # Ensure fractions are complete if braces are missing
-    content = re.sub(r'\\frac\{([^\}]*)$', r'\\frac{\1}', content)
-    # Ensure text commands are complete if braces are missing
-    content = re.sub(r'\\text\{([^\}]*)$', r'\\text{\1}', content)
-    return content
-
-# Custom LaTeX processing function that combines multiple fixes
-def custom_latex_processing(content):
-    # Fix unbalanced braces
-    content = fix_unbalanced_braces(content)
-    # Complete LaTeX expressions for fractions and text commands
-    content = complete_latex_expressions(content)
-    # Fix repeated units in the content
-    content = fix_repeated_units(content)
-    return content
+# Render content to Markdown once per generated paper so reruns reuse the processed text
+@st.cache_data(max_entries=256)
+def render_latex_markdown(question_hash, _content):
+    with measure("latex_render"):
+        return latex_to_markdown(_content)
+
+# Export a paper only when a download is asked for, once per paper and format
+@st.cache_data(max_entries=64)
+def export_paper_data(question_hash, format_name, _content, _questions):
+    with measure("export"):
+        return export_paper(format_name, _content, _questions)
+
+# Zip stored papers into a temporary file, reading them from the database in batches; only the finished archive is
+# read into memory, since that is what the download button serves
+def export_archive(format_name, subject, since):
+    with tempfile.TemporaryFile() as archive:
+        with measure("export_archive"), get_pool().connection() as conn:
+            count = write_archive(archive, iter_stored_papers(conn, subject, since), format_name)
+        archive.seek(0)
+        return archive.read(), count
 
 # Display LaTeX content with proper formatting in Streamlit
-def display_content_with_latex(content):
-    # Apply custom LaTeX processing to clean up the content
-    content = custom_latex_processing(content)
-    # Define patterns for LaTeX expressions to identify them
-    latex_patterns = [
-        r'\\frac\{.*?\}\{.*?\}',  # Fractions
-        r'\$.*?\$',               # Inline math
-        r'\\sqrt(?:\{.*?\})?',    # Square root
-        r'\\sum(?:_\{.*?\})?(?:\^\{.*?\})?',  # Summation
-        r'\\int(?:_\{.*?\})?(?:\^\{.*?\})?',  # Integral
-        r'\^\{.*?\}',  # Exponents (Superscripts)
-        r'_\{.*?\}',  # Subscripts
-        r'\\begin\{.*?matrix\}.*?\\end\{.*?matrix\}',  # Matrices and arrays
-        r'\\text\{.*?\}',  # Text formatting in math mode
-        r'\\[a-zA-Z]+(?=\W|\Z)',  # Greek letters
-        r'\\(?:log|sin|cos|tan|ln|exp|arcsin|arccos|arctan)\b',  # Trig and log functions
-        r'\\left[\(\[\{].*?\\right[\)\]\}]',  # Parentheses and Brackets
-        r'\\begin\{aligned\}.*?\\end\{aligned\}',  # Aligned equations
-        r'\\begin\{align\*?\}.*?\\end\{align\*?\}',  # Align and align* environments
-    ]
-    latex_regex = re.compile('|'.join(latex_patterns))
-    # Split content based on LaTeX patterns
-    parts = re.split(
-        r'('  # Start a capturing group
-        r'\$.*?\$|'  # Inline math
-        r'\\frac\{.*?\}\{.*?\}|'  # Fractions
-        r'\\sqrt(?:\{.*?\})?|'  # Square root
-        r'\\sum(?:_\{.*?\})?(?:\^\{.*?\})?|'  # Summation
-        r'\\int(?:_\{.*?\})?(?:\^\{.*?\})?|'  # Integral
-        r'\^\{.*?\}|'  # Exponents (Superscripts)
-        r'_\{.*?\}|'  # Subscripts
-        r'\\begin\{.*?matrix\}.*?\\end\{.*?matrix\}|'  # Matrices and arrays
-        r'\\text\{.*?\}|'  # Text formatting in math mode
-        r'\\[a-zA-Z]+(?=\W|\Z)|'  # Greek letters
-        r'\\(?:log|sin|cos|tan|ln|exp|arcsin|arccos|arctan)\b|'  # Trig and log functions
-        r'\\left[\(\[\{].*?\\right[\)\]\}]|'  # Parentheses and Brackets
-        r'\\begin\{aligned\}.*?\\end\{aligned\}'  # Aligned equations
-        r')', 
-        content
-)
-    # Process each part to format LaTeX content
-    processed_parts = []
-    for part in parts:
-        if latex_regex.search(part):
-            processed_parts.append(f"$$ {part.strip()} $$")
-        else:
-            processed_parts.append(part.strip())
-    final_content = ' '.join(processed_parts)
-    # Display the processed content in Streamlit
-    st.markdown(final_content)
-
-# Convert LaTeX to plain text for display or export
-def convert_latex_to_text(content):
-    content = re.sub(r'\\frac\{(.*?)\}\{(.*?)\}', r'\1/\2', content)
-    content = re.sub(r'\\text\{(.*?)\}', r'\1', content)
-    return content
+def display_content_with_latex(content, question_hash=None):
+    if question_hash:
+        st.markdown(render_latex_markdown(question_hash, content))
+    else:
+        with measure("latex_render"):
+            markdown = latex_to_markdown(content)
+        st.markdown(markdown)
+
+# Display a single structured question with its answer
+def display_question(number, question):
+    details = [question["topic"], f"{question['marks']} marks" if question["marks"] else "", question["difficulty"]]
+    details = ", ".join(detail for detail in details if detail)
+    st.markdown(f"**Question {number}**" + (f" ({details})" if details else ""))
+    display_content_with_latex(question["question"], generate_question_hash(question["question"]))
+    display_content_with_latex(f"Answer: {question['answer']}", generate_question_hash(question["answer"]))
+
+# Show a paper in the generation tab
+def load_paper(result):
+    st.session_state.generated_questions = result["content"]
+    st.session_state.structured_questions = result["questions"]
+    st.session_state.question_hash = result["question_hash"]
+    st.session_state.similar_paper = result["similar_paper"]
+    st.session_state.near_duplicates = result["near_duplicates"]
+    st.session_state.subject = result["context"]["subject"]
+    st.session_state.topics = result["context"]["topics"]
+    st.session_state.generation_context = result["context"]
+
+def load_grading_results(result):
+    st.session_state.grading_results = result["results"]
+
+# Questions, or text, received so far for a paper that is still being generated
+def show_partial_paper(partial):
+    for number, question in enumerate(partial.get("questions", []), start=1):
+        display_question(number, question)
+    if partial.get("text"):
+        display_content_with_latex(partial["text"])
+
+# Per-file status of a grading batch that is still running
+def show_partial_grading(partial):
+    if partial.get("statuses"):
+        import pandas as pd
+
+        st.dataframe(pd.DataFrame([{"File": name, "Status": status["Status"], "Grade": status["Grade"]}
+                                   for name, status in partial["statuses"].items()]), use_container_width=True)
+
+# Load the result of the session's active job of a kind the first time it is seen finished, and return the job
+def collect_job(kind, on_done):
+    job_id = st.session_state.active_jobs.get(kind)
+    job = get_job(job_id) if job_id else None
+    if job and job["status"] in FINISHED_STATUSES and st.session_state.collected_jobs.get(kind) != job_id:
+        st.session_state.collected_jobs[kind] = job_id
+        if job["status"] == DONE:
+            on_done(job["result"])
+    return job
+
+# Tell the user how a finished job ended, if it did not succeed
+def show_job_outcome(job):
+    if job["status"] == FAILED:
+        st.error(f"An error occurred: {job['error']}")
+    elif job["status"] == CANCELLED:
+        st.info(f"{job['label']} was cancelled.")
+
+# Progress of the session's active job of a kind and a list of its earlier jobs, refreshed while the page is open.
+# Once the active job finishes the whole page is rerun so its result is shown in place.
+@st.fragment(run_every=JOB_UI_POLL_INTERVAL)
+def watch_jobs(session_id, kind, show_partial):
+    job_id = st.session_state.active_jobs.get(kind)
+    job = get_job(job_id) if job_id else None
+    if job and job["status"] in FINISHED_STATUSES and st.session_state.collected_jobs.get(kind) != job_id:
+        st.rerun()
+    if job and job["status"] in (QUEUED, RUNNING):
+        st.progress(job["progress"], text=f"{job['label']}: " + ("waiting for a free worker" if job["status"] == QUEUED else f"{int(job['progress'] * 100)}%"))
+        if st.button("Cancel", key=f"cancel_{kind}_job"):
+            cancel_job(job_id)
+        show_partial(job["partial"])
+
+    earlier_jobs = [listed for listed in list_jobs(session_id, kind) if listed["id"] != job_id]
+    if earlier_jobs:
+        with st.expander(f"Earlier and queued jobs ({len(earlier_jobs)})"):
+            for listed in earlier_jobs:
+                col1, col2 = st.columns([5, 1])
+                col1.markdown(f"{listed['label']} — {listed['status']}, submitted {datetime.fromtimestamp(listed['created_at']):%d %b %H:%M}")
+                if listed["status"] != CANCELLED and col2.button("Open", key=f"open_job_{listed['id']}"):
+                    st.session_state.active_jobs[kind] = listed["id"]
+                    st.rerun()
 
 def main():
     # Initialize session state
@@ -221,6 +202,23 @@ def main():
         st.session_state.last_feedback_time = None
     if 'question_hash' not in st.session_state:
         st.session_state.question_hash = None
+    if 'similar_paper' not in st.session_state:
+        st.session_state.similar_paper = None
+    if 'near_duplicates' not in st.session_state:
+        st.session_state.near_duplicates = []
+    if 'grading_results' not in st.session_state:
+        st.session_state.grading_results = []
+    if 'structured_questions' not in st.session_state:
+        st.session_state.structured_questions = []
+    if 'active_jobs' not in st.session_state:
+        st.session_state.active_jobs = {}
+    if 'collected_jobs' not in st.session_state:
+        st.session_state.collected_jobs = {}
+
+    # Background jobs belong to the session id in the page address, so they can be collected after a reload
+    if 'session' not in st.query_params:
+        st.query_params['session'] = uuid.uuid4().hex
+    session_id = st.query_params['session']
 
     st.title("Assessment Generator & Grader")
     st.subheader("Generate Assessments based on Academic Level, Topics, and Language or Grade them")
@@ -238,32 +236,20 @@ def main():
         st.warning("Please enter and confirm your OpenAI API key to continue.")
         st.stop()
 
-    # Configure OpenAI client using API key securely
-    openai.api_key = st.session_state.api_key
+    # Keep the question bank stocked for popular requests (only when the server has its own API key)
+    start_prewarm_worker()
 
-    # Create tabs for Teachers (Assessment Generation), Students (Grading), and Guide
-    tab1, tab2, tab3 = st.tabs(["Assessment Generation", "Grade Assessments", "Guide"])
+    # Create tabs for Teachers (Assessment Generation), Students (Grading), Admin (performance and exports), and Guide
+    tab1, tab2, tab_admin, tab3 = st.tabs(["Assessment Generation", "Grade Assessments", "Admin", "Guide"])
 
     # Mapping subjects to topics
-    subject_to_topics = {
-        "Mathematics": ["Whole Numbers", "Algebra", "Money", "Measurement and Geometry", "Statistics", "Fractions", "Time", "Area and Volume", "Decimals", "Multiplication and Division", "Percentage", "Ratio", "Rate and Speed"],
-        "English Language": ["Grammar", "Literature", "Writing", "Reading Comprehension"],
-        "Science": ["Physics", "Chemistry", "Biology"],
-        "Social Studies": ["Discovering Self and Immediate Environment", "Understanding Singapore in the Past and Present", "Appreciating Singapore, the Region and the World We Live In"]
-    }
+    subject_to_topics = SUBJECT_TO_TOPICS
 
     with tab1:
         st.subheader("Generate Assessments based on Academic Level, Topics, and Language")
 
         # Language selection
-        language_options = {
-            "English": "en",
-            "Spanish": "es",
-            "French": "fr",
-            "Chinese": "zh",
-            "German": "de",
-            "Japanese": "ja"
-        }
+        language_options = LANGUAGE_OPTIONS
         language = st.selectbox("Choose a Language", list(language_options.keys()))
 
         col1, col2, col3 = st.columns([1, 1, 1])
@@ -275,16 +261,16 @@ def main():
         selected_topics = col2.multiselect('Select Topics (You can choose multiple)', topics)
 
         with col3:
-            acad_levels = ["Primary One", "Primary Two", "Primary Three", "Primary Four", "Primary Five", "Primary Six"]
+            acad_levels = ACADEMIC_LEVELS
             user_input_acad_level = st.selectbox('Academic Level', acad_levels)
 
         col4, col5, col6 = st.columns([1, 1, 3])
         with col4:
-            difficulties = ["Basic", "Intermediate", "Advanced"]
+            difficulties = DIFFICULTIES
             user_input_difficulty = st.selectbox('Question Difficulty', difficulties)
 
         with col5:
-            question_type = st.selectbox("Question Type", ["Short Questions", "Comprehensive Exam-Style Questions"])
+            question_type = st.selectbox("Question Type", QUESTION_TYPES)
 
         with col6:
             user_input_no_of_qns = st.number_input("Number of Questions:", min_value=1, max_value=50, value=10)
@@ -293,6 +279,15 @@ def main():
             # Adding a tooltip for the "Keywords" field
             user_input_keyword = st.text_input("Keywords (Optional):", help="Use specific keywords to guide the type of questions generated. For example, 'fractions' for math, or 'grammar' for English.")
 
+        stream_output = st.checkbox("Show questions as they are generated", value=True)
+        structured_output = st.checkbox("Generate questions individually", value=True,
+                                        help="Each question is shown and stored separately, can be regenerated on its own, and is exported with its answer, topic, marks and difficulty in separate columns. "
+                                             "Large papers are generated in parallel parts.")
+        force_regenerate = st.checkbox("Force regenerate", help="Ignore previously generated questions for the same inputs and request a new set.")
+        use_bank = st.checkbox("Reuse questions from the question bank", value=True, disabled=not structured_output,
+                               help="Assemble the paper from well-rated questions generated before for the same subject, level, difficulty, language and question type, "
+                                    "and only generate the rest. Not used with reference files or keywords.")
+
         specify_portions = st.checkbox("Specify Topic Portioning for Assessment?")
         portions_info = {}
 
@@ -317,117 +312,134 @@ def main():
             uploaded_files = st.file_uploader("Upload files (PDFs or Text)", type=['txt', 'pdf'], accept_multiple_files=True)
 
         file_text = ""
+        context_budget = CONTEXT_TOKEN_BUDGET
         if uploaded_files:
             combined_texts = []
+            reading_status = st.empty()
+            preview = st.empty()
             for uploaded_file in uploaded_files:
                 if uploaded_file.type == "text/plain":
                     combined_texts.append(str(uploaded_file.read(), "utf-8"))
                 elif uploaded_file.type == "application/pdf":
-                    combined_texts.append(read_pdf(uploaded_file))
-
-            file_text = "\n".join(combined_texts)
+                    # Show pages and the running token count as they are extracted
+                    pdf_pages = []
+                    pdf_data = uploaded_file.getvalue()
+                    with measure("pdf_extraction", subject=user_input_topic, cache_hit=has_cached_pages(file_digest(pdf_data))):
+                        for pages_done, total_pages, batch in iter_pdf_pages(pdf_data):
+                            pdf_pages.extend(batch)
+                            if pages_done < total_pages:
+                                text_so_far = "\n".join(combined_texts + [''.join(pdf_pages)])
+                                reading_status.progress(pages_done / total_pages, text=f"Reading {uploaded_file.name}: page {pages_done} of {total_pages} "
+                                                                                       f"({count_tokens(text_so_far)} tokens so far)")
+                                with preview.container(height=250):
+                                    st.text(text_so_far)
+                    combined_texts.append(''.join(pdf_pages))
+
+            # Headers and footers repeated on every page would only take up the reference budget
+            file_text = remove_boilerplate("\n".join(combined_texts))
+            reading_status.empty()
             st.success(f"{len(uploaded_files)} files uploaded successfully!")
-            token_count = estimate_tokens(file_text)
-            if token_count > 100000:
-                st.error(f"The combined document is too long ({int(token_count)} tokens). Please reduce the file content (Max tokens = 100000).")
-            else:
-                st.text_area("File content", file_text, height=250)
+            token_count = count_tokens(file_text)
+            context_budget = st.number_input("Reference material budget (tokens)", min_value=500, max_value=20000, value=CONTEXT_TOKEN_BUDGET, step=500,
+                                             help="Only the passages most relevant to the selected subject, topics and keywords are sent, up to this many tokens.")
+            if token_count > context_budget:
+                st.caption(f"The uploaded material is {token_count} tokens; the most relevant {context_budget} tokens will be used.")
+            preview.text_area("File content", file_text, height=250)
 
         if st.button("Generate Questions"):
             if specify_portions and sum(portions_info.values()) != 100:
                 st.error("Please ensure the total portions sums up to 100% before generating questions.")
             else:
-                with st.spinner('Generating questions...'):
-                    progress = st.progress(0)
-                    i = 0
-
+                try:
+                    reference_file_digest = reference_digest(file_text)
+                    # The passages picked are summarized down to the budget when the paper is generated
+                    reference_text = get_reference_index(reference_file_digest, file_text).select(
+                        build_query(user_input_topic, selected_topics, user_input_keyword), int(context_budget * CANDIDATE_TOKEN_RATIO)) if file_text else ""
+                    request = {
+                        "subject": user_input_topic,
+                        "topics": selected_topics,
+                        "acad_level": user_input_acad_level,
+                        "difficulty": user_input_difficulty,
+                        "question_type": question_type,
+                        "no_of_qns": user_input_no_of_qns,
+                        "language": language,
+                        "keyword": user_input_keyword,
+                        "portions": portions_info if specify_portions else {},
+                        "reference_text": reference_text,
+                        "file_digest": reference_file_digest,
+                        "context_budget": context_budget,
+                        "structured": structured_output,
+                        "stream": stream_output,
+                        "force_regenerate": force_regenerate,
+                        "use_bank": use_bank,
+                    }
+                    label = f"{user_input_no_of_qns} {user_input_topic} questions ({user_input_acad_level}, {user_input_difficulty})"
+                    st.session_state.active_jobs["generation"] = submit_job(session_id, "generation", label, request, st.session_state.api_key)
+                except Exception as e:
+                    st.error(f"An error occurred: {str(e)}")
+
+        # Papers are generated in the background; the page keeps working while they run
+        generation_job = collect_job("generation", load_paper)
+        watch_jobs(session_id, "generation", show_partial_paper)
+        if generation_job and generation_job["status"] == DONE:
+            if generation_job["result"]["cached"]:
+                st.caption("Loaded from previously generated questions. Tick \"Force regenerate\" for a new set.")
+            elif generation_job["result"]["bank_count"]:
+                st.caption(f"{generation_job['result']['bank_count']} of {len(generation_job['result']['questions'])} questions were taken from the question bank.")
+        elif generation_job:
+            show_job_outcome(generation_job)
+        if st.session_state.generated_questions and not st.session_state.structured_questions:
+            display_content_with_latex(st.session_state.generated_questions, st.session_state.question_hash)
+            if st.session_state.near_duplicates:
+                st.warning(f"Questions {', '.join(map(str, st.session_state.near_duplicates))} are very similar to earlier questions in this paper.")
+
+        # Structured papers: each question is rendered on its own and can be regenerated without rerunning the paper
+        for index, question in enumerate(st.session_state.structured_questions):
+            display_question(index + 1, question)
+            if st.button("Regenerate this question", key=f"regenerate_question_{index}"):
+                with st.spinner(f"Regenerating question {index + 1}..."):
                     try:
-                        selected_topics_str = "Any" if "Any" in selected_topics else ", ".join(selected_topics)
-                        portions_str = ', '.join([f"{topic}: {weight}%" for topic, weight in portions_info.items()]) if specify_portions else "Not specified"
-
-                        if question_type == "Comprehensive Exam-Style Questions":
-                            prompt_type = f"generate {user_input_no_of_qns} {user_input_topic} long, multi-part questions suitable for exams that carry more marks and require detailed answers"
-                        else:
-                            prompt_type = f"generate {user_input_no_of_qns} {user_input_topic} short quiz questions"
-
-                        # Simulate progress while waiting for API response
-                        while i < 90:  # Simulate up to 90% until the response is received
-                            time.sleep(random.uniform(0.1, 0.3))  # Random time delay
-                            i += random.randint(5, 10)
-                            progress.progress(min(i, 90))  # Cap the progress at 90%
-
-                        # Start timing API call
-                        start_time = time.time()
-
-                        # Get the response
-                        response = openai.chat.completions.create(
-                            model="gpt-4o",
-                            messages=[{
-                                "role": "user",
-                                "content": f"You are a primary school teacher in Singapore. With reference to the content in {file_text}, if any, \
-                                    and topics {selected_topics_str}, {prompt_type} with corresponding answers for the academic level of \
-                                    {user_input_acad_level} according to the Singapore education system of {user_input_difficulty} difficulty level. \
-                                    Please generate the content in {language_options[language]}. Keywords: {user_input_keyword}. \
-                                    Display only questions and answers without caption or commentary. \
-                                    Use LaTeX for rendering fractions and algebraic expressions. Present these questions and answers in a format that is clear and readable to users. \
-                                    portions information: {portions_str}. \
-                                    If no topic is selected, generate a mix of questions based on the options in {subject_to_topics} according to the subject. \
-                                    Display questions and their corresponding answers separately, and ensure that all mathematical expressions can be processed through LaTeX."
-                            }],
-                            temperature=0.5,
-                            n=1,
-                            frequency_penalty=0.0
-                        )
-
-                        # Record response time
-                        response_time = int((time.time() - start_time) * 1000)  # Response time in milliseconds
-
-                        # Immediately set the progress bar to 100% when the response is received
-                        progress.progress(100)
-
-                        if response.choices:
-                            result_content = response.choices[0].message.content.strip()
-
-                            # Generate unique question hash
-                            st.session_state.question_hash = generate_question_hash(result_content)
-                            st.session_state.generated_questions = result_content
-                            st.session_state.subject = user_input_topic
-                            st.session_state.topics = selected_topics_str
-                            display_content_with_latex(st.session_state.generated_questions)
-
-                            # Insert generated questions into the generated_questions table
-                            c.execute('INSERT INTO generated_questions (subject, difficulty_level, question_content) VALUES (?, ?, ?)',
-                                      (user_input_topic, user_input_difficulty, result_content))
-                            
-                            # Insert API usage log into the api_usage_logs table
-                            c.execute('INSERT INTO api_usage_logs (api_request, api_response, response_time) VALUES (?, ?, ?)',
-                                      (str(response.choices[0].message), result_content, response_time))
-
-                            conn.commit()
-
+                        replacement_prompt = build_replacement_prompt(st.session_state.generation_context, st.session_state.structured_questions, index)
+                        replacement_content = "".join(content for content, _ in generate_completion(replacement_prompt, stream=False, json_mode=True,
+                                                                                          client=get_client(st.session_state.api_key, session_id),
+                                                                                          feature="regenerate_question", subject=st.session_state.subject))
+                        structured_questions = list(st.session_state.structured_questions)
+                        structured_questions[index] = parse_question(replacement_content)
+                        paper_content = questions_to_text(structured_questions)
+
+                        st.session_state.structured_questions = structured_questions
+                        st.session_state.generated_questions = paper_content
+                        st.session_state.question_hash = generate_question_hash(paper_content)
+                        st.session_state.similar_paper = None
+                        context = st.session_state.generation_context
+                        execute_later('INSERT INTO generated_questions (subject, difficulty_level, question_content, question_hash, acad_level, language, question_type, topics, prompt_variant, tailored) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                      (context["subject"], context["difficulty"], paper_content, st.session_state.question_hash,
+                                       context["acad_level"], context["language"], context["question_type"], context["topics"], context.get("prompt_variant"),
+                                       context.get("tailored", False)))
+                        submit_write(store_paper_questions, st.session_state.question_hash, structured_questions)
+                        if not context.get("tailored"):
+                            submit_write(add_to_bank, [structured_questions[index]], context, st.session_state.question_hash)
+                        st.rerun()
                     except Exception as e:
                         st.error(f"An error occurred: {str(e)}")
 
-                    finally:
-                        # Ensure progress bar always reaches 100% after execution
-                        progress.progress(100)
-
     if st.session_state.generated_questions:
         st.subheader("Rate the Generated Questions")
 
-        # Check if feedback has already been submitted for this output
+        # Check if feedback has already been submitted for this output, or for an earlier paper that it nearly repeats
         if st.session_state.question_hash:
-            c.execute('SELECT timestamp FROM feedback WHERE question_hash = ?', (st.session_state.question_hash,))
-            feedback_row = c.fetchone()
+            feedback_row = query_one('SELECT timestamp FROM feedback WHERE question_hash IN (?, ?)',
+                                     (st.session_state.question_hash, st.session_state.similar_paper))
 
             if feedback_row:
                 last_feedback_time = datetime.strptime(feedback_row[0], '%Y-%m-%d %H:%M:%S')
                 st.session_state.last_feedback_time = last_feedback_time
 
+        cooldown_started = feedback_cooldown_started(session_id)
         if st.session_state.question_hash and feedback_row:
             st.info(f"Feedback already submitted for this output at {st.session_state.last_feedback_time}.")
-        elif within_cooldown(st.session_state.last_feedback_time):
-            cooldown_remaining = (st.session_state.last_feedback_time + timedelta(minutes=FEEDBACK_COOLDOWN) - datetime.now()).seconds // 60
+        elif cooldown_started:
+            cooldown_remaining = int(cooldown_started + FEEDBACK_COOLDOWN * 60 - time.time()) // 60
             st.info(f"Please wait {cooldown_remaining} minutes before submitting feedback again.")
         else:
             # Feedback form for new submissions
@@ -436,24 +448,30 @@ def main():
                 feedback = st.text_area("Provide your feedback:", key="feedback")
 
                 if st.form_submit_button("Submit Feedback"):
-                    if rating:
+                    # Starting the cooldown is atomic, so feedback sent from two tabs or replicas at once is only recorded once
+                    if rating and not start_feedback_cooldown(session_id):
+                        st.info(f"Please wait {FEEDBACK_COOLDOWN} minutes before submitting feedback again.")
+                    elif rating:
                         st.success("Thank you for your feedback!")
-                        c.execute('INSERT INTO feedback (question_hash, subject, topics, rating, feedback) VALUES (?, ?, ?, ?, ?)', 
-                                  (st.session_state.question_hash, st.session_state.subject, st.session_state.topics, rating, feedback))
-                        conn.commit()
+                        # The rating is added to the analytics rollups in the same write
+                        context = st.session_state.generation_context
+                        submit_write(record_feedback, st.session_state.question_hash, st.session_state.subject, st.session_state.topics, rating, feedback,
+                                     context["acad_level"], context["difficulty"], context.get("prompt_variant"))
                         st.session_state.feedback_submitted = True
                         st.session_state.last_feedback_time = datetime.now()
                     else:
                         st.error("Please select a rating before submitting your feedback.")
 
-        conn.close()
-        readable_content = convert_latex_to_text(st.session_state.generated_questions)
-        df = pd.DataFrame({"Questions": [line.strip() for line in readable_content.splitlines() if line.strip()]})
-        towrite = io.BytesIO()
-        df.to_excel(towrite, index=False, engine='openpyxl')
-        towrite.seek(0)
-
-        st.download_button(label="Download Excel", data=towrite, file_name="generated_questions.xlsx", mime="application/vnd.ms-excel")
+        # Files are only built when asked for, so reruns do not rebuild them
+        col1, col2 = st.columns([1, 3])
+        export_format = col1.selectbox("Download format", list(EXPORT_FORMATS), key="export_format")
+        if col1.button("Prepare download"):
+            st.session_state.prepared_export = (st.session_state.question_hash, export_format)
+        if st.session_state.get("prepared_export") == (st.session_state.question_hash, export_format):
+            extension, mime, _ = EXPORT_FORMATS[export_format]
+            col1.download_button(label=f"Download {export_format}", file_name=f"generated_questions.{extension}", mime=mime,
+                                 data=export_paper_data(st.session_state.question_hash, export_format, st.session_state.generated_questions,
+                                                        st.session_state.structured_questions))
 
 
     # Grading Assessments Tab (For Teachers to Grade Student Work)
@@ -466,43 +484,119 @@ def main():
         uploaded_files_for_grading = st.file_uploader("Upload assessment files", type=['txt', 'pdf'], accept_multiple_files=True)
 
         if uploaded_files_for_grading:
-            combined_grading_texts = []
+            grading_texts = {}
             for uploaded_file in uploaded_files_for_grading:
                 if uploaded_file.type == "text/plain":
-                    combined_grading_texts.append(str(uploaded_file.read(), "utf-8"))
+                    grading_texts[uploaded_file.name] = str(uploaded_file.read(), "utf-8")
                 elif uploaded_file.type == "application/pdf":
-                    combined_grading_texts.append(read_pdf(uploaded_file))
+                    grading_texts[uploaded_file.name] = read_pdf(uploaded_file)
 
-            grading_text = "\n".join(combined_grading_texts)
+            grading_text = "\n".join(grading_texts.values())
             st.success(f"{len(uploaded_files_for_grading)} files uploaded for grading.")
             st.text_area("Uploaded Assessment Content", grading_text, height=250)
 
-            if st.button("Grade Assessment"):
-                with st.spinner('Grading the assessment...'):
-                    progress = st.progress(0)
-                    try:
-                        for percent_complete in range(0, 101, 10):
-                            time.sleep(0.1)
-                            progress.progress(percent_complete)
-
-                        grading_response = openai.chat.completions.create(
-                            model="gpt-4o",
-                            messages=[{
-                                "role": "user",
-                                "content": f"You are a teacher grading the following student assessment:\n\n{grading_text}\n\nProvide feedback, suggestions, and a grade."
-                            }],
-                            temperature=0.5,
-                            n=1,
-                            frequency_penalty=0.0
-                        )
-
-                        if grading_response.choices:
-                            st.subheader("Grading Results")
-                            grading_result = grading_response.choices[0].message.content.strip()
-                            st.write(grading_result)
+            max_workers = st.slider("Files to grade at the same time", min_value=1, max_value=10, value=GRADING_MAX_WORKERS)
+
+            # Marking against a generated paper's answer key grades each answer separately, and answers that are a number,
+            # fraction or option letter are marked without the model
+            answer_key_paper = None
+            if st.toggle("Mark against the answer key of a generated paper", key="use_answer_key"):
+                papers = query_all('SELECT id, subject, acad_level, generated_at, question_hash FROM generated_questions ORDER BY id DESC LIMIT ?',
+                                   (ANSWER_KEY_PAPERS,))
+                if papers:
+                    paper_labels = {paper_id: f"#{paper_id} {subject}, {acad_level or 'any level'} ({generated_at})"
+                                    for paper_id, subject, acad_level, generated_at, _ in papers}
+                    # The paper on screen in the Assessment Generation tab is offered first
+                    current = [index for index, paper in enumerate(papers) if paper[4] == st.session_state.question_hash]
+                    answer_key_paper = st.selectbox("Paper", list(paper_labels), format_func=paper_labels.get, index=current[0] if current else 0)
+                else:
+                    st.info("No papers have been generated yet.")
 
-                    except Exception as e:
-                        st.error(f"An error occurred during grading: {str(e)}")
+            if st.button("Grade Assessment"):
+                try:
+                    # Each file is graded separately on a bounded worker pool, in the background
+                    label = f"{len(grading_texts)} assessments" + (f" against paper #{answer_key_paper}" if answer_key_paper else "")
+                    st.session_state.active_jobs["grading"] = submit_job(session_id, "grading", label,
+                                                                         {"submissions": grading_texts, "max_workers": max_workers,
+                                                                          "paper_id": answer_key_paper},
+                                                                         st.session_state.api_key)
+                except Exception as e:
+                    st.error(f"An error occurred during grading: {str(e)}")
+
+        grading_job = collect_job("grading", load_grading_results)
+        watch_jobs(session_id, "grading", show_partial_grading)
+        if grading_job:
+            show_job_outcome(grading_job)
+
+        if st.session_state.grading_results:
+            import pandas as pd
+
+            st.subheader("Grading Results")
+            results_df = pd.DataFrame(st.session_state.grading_results)
+            st.dataframe(results_df[["File", "Status", "Grade"]], use_container_width=True)
+            for result in st.session_state.grading_results:
+                with st.expander(f"{result['File']} — {result['Grade'] or result['Status']}"):
+                    st.write(result["Feedback"])
+
+            st.download_button(label="Download Grades (CSV)", data=results_df.to_csv(index=False).encode('utf-8'),
+                               file_name="grading_results.csv", mime="text/csv")
+
+    # Performance dashboard (latency percentiles, token usage and errors of every measured operation), ratings analytics and bulk exports
+    with tab_admin:
+        admin_password = os.environ.get('ADMIN_PASSWORD')
+        if admin_password and st.text_input("Administrator password:", type="password", key="admin_password") != admin_password:
+            st.info("Enter the administrator password to view performance metrics and ratings and export papers.")
+        else:
+            st.subheader("Performance")
+            # Shown on request, since every tab runs on each rerun and the dashboards are the only parts of the page that need pandas
+            if st.toggle("Show performance dashboard", key="show_dashboard"):
+                window = st.selectbox("Time window", list(DASHBOARD_WINDOWS), index=1)
+                metrics_df = load_metrics(DASHBOARD_WINDOWS[window])
+                if metrics_df.empty:
+                    st.info("No measurements recorded in this time window yet.")
+                else:
+                    summary = summarize_metrics(metrics_df)
+                    col1, col2, col3, col4 = st.columns(4)
+                    col1.metric("Operations", len(metrics_df))
+                    col2.metric("Errors", int(summary["Errors"].sum()))
+                    col3.metric("Tokens", int(summary["Prompt tokens"].sum() + summary["Completion tokens"].sum()))
+                    col4.metric("Estimated cost", f"${summary['Cost (USD)'].sum():.2f}")
+                    st.dataframe(summary, use_container_width=True, hide_index=True,
+                                 column_config={"Cost (USD)": st.column_config.NumberColumn(format="$%.4f")})
+                    st.markdown("**p95 latency by feature (ms)**")
+                    st.line_chart(latency_trend(metrics_df, "1h" if DASHBOARD_WINDOWS[window] > 60 * 60 else "5min"))
+                    st.download_button(label="Download measurements (CSV)", data=metrics_df.to_csv(index=False).encode('utf-8'),
+                                       file_name="metrics.csv", mime="text/csv")
+                submit_write(prune_metrics)
+
+            st.subheader("Ratings")
+            # Read from the daily rollups, so the view stays fast however many ratings have been given
+            if st.toggle("Show ratings analytics", key="show_ratings"):
+                window = st.selectbox("Time window", list(RATINGS_WINDOWS), index=1, key="ratings_window")
+                ratings_df = load_rating_rollups(RATINGS_WINDOWS[window])
+                if ratings_df.empty:
+                    st.info("No ratings given in this time window yet.")
+                else:
+                    papers_df = ratings_df[ratings_df["topic"] == ""]
+                    col1, col2 = st.columns(2)
+                    col1.metric("Ratings", int(papers_df["ratings"].sum()))
+                    col2.metric("Average rating", f"{papers_df['rating_sum'].sum() / papers_df['ratings'].sum():.2f}")
+                    group_by = st.selectbox("Group by", list(ROLLUP_LABELS), format_func=ROLLUP_LABELS.get, key="ratings_group_by")
+                    st.dataframe(summarize_ratings(ratings_df, group_by), use_container_width=True, hide_index=True)
+                    st.markdown("**Average rating by subject**")
+                    st.line_chart(rating_trend(ratings_df, "7D" if RATINGS_WINDOWS[window] > 30 else "1D"))
+
+            # Every stored paper as one file each in a zip archive
+            st.subheader("Export past papers")
+            col1, col2, col3 = st.columns(3)
+            archive_format = col1.selectbox("Format", list(EXPORT_FORMATS), key="archive_format")
+            archive_subject = col2.selectbox("Subject", ["All"] + list(SUBJECT_TO_TOPICS), key="archive_subject")
+            archive_since = col3.date_input("Generated since", value=None, key="archive_since")
+            if st.button("Prepare archive"):
+                archive, count = export_archive(archive_format, None if archive_subject == "All" else archive_subject,
+                                                archive_since.isoformat() if archive_since else None)
+                st.caption(f"{count} papers exported.")
+                st.download_button(label="Download archive", data=archive, file_name="past_papers.zip", mime="application/zip")
 
     with tab3:
         st.subheader("Guide to Using Assessment Generator & Grader")
@@ -518,14 +612,32 @@ def main():
             - You can specify keywords for specific content or concepts you want to include.
             - Optionally, assign **portions** to selected topics.
             - Upload any **reference materials** (PDF or TXT).
-            - Click **Generate Questions** to generate exam-style questions. The generated content will be displayed, and you can download it as an Excel file.
+            - Click **Generate Questions** to generate exam-style questions. The generated content will be displayed, and you can download it as an Excel, CSV or Word file
+              (choose the format and click **Prepare download**).
+            - With **Generate questions individually** ticked, use **Regenerate this question** to replace a single question without regenerating the whole paper.
+            - With **Reuse questions from the question bank** ticked, well-rated questions generated before for the same choices are reused, and only the rest are generated.
+            - Papers are generated in the background, so you can keep using the app or submit more papers while they run. Earlier papers can be reopened
+              from the list below the **Generate Questions** button. Bookmark the page to come back to them later.
         
         
         You can upload your completed assessments for grading in the **Grade Assessments** section.
                     
         2. **Grading Assessments**:
             - Upload student assessments (preferably in **PDF** or **TXT** format).
+            - Each file is graded separately, so upload one file per student.
+            - Turn on **Mark against the answer key of a generated paper** and choose the paper to mark each numbered answer against
+              its answer key. Answers that are a number, fraction or option letter are marked instantly; the others are marked by the AI.
             - Click **Grade Assessment** to have the AI evaluate the content and provide feedback and grading.
+            - Grading also runs in the background; the results appear when it completes.
+            - Download the per-student grades as a CSV file once grading completes.
+
+        3. **Admin** (for administrators):
+            - Turn on **Show performance dashboard** to see response times (p50/p95/p99), time to first token, token usage, estimated cost,
+              cache hits and errors for each feature and subject.
+            - Turn on **Show ratings analytics** to see the number of ratings and average rating by subject, topic, academic level,
+              difficulty or prompt variant, and how ratings change over time. Better-rated prompt variants are chosen more often for new papers.
+            - **Export past papers** downloads every stored paper, optionally for one subject or since a date, as a zip archive.
+            - Set the `ADMIN_PASSWORD` environment variable to require a password for this tab.
 
         #### File Format Guidelines:
         - Supported formats: **PDF**, **TXT**.
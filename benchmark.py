@@ -0,0 +1,427 @@
+# Offline performance benchmarks for the generation, PDF reading and grading paths.
+#
+# Everything runs in-process against the fake OpenAI server (fake_openai.py), with a throwaway
+# database and extraction cache, so no API key or network access is needed:
+#     python benchmark.py
+#     python benchmark.py --output baseline.json
+#     python benchmark.py --baseline baseline.json    # exits with status 1 if anything regressed
+#
+# Startup cost is also checked against fixed budgets (BUDGETS), so CI fails when a change makes the app
+# slower to start or rerun, or loads a heavy dependency before it is needed.
+import argparse
+import io
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer
+from unittest import mock
+
+import fake_openai
+
+# Representative inputs
+PAPER_QUESTIONS = 50
+PDF_PAGES = 200
+REFERENCE_PDF_PAGES = 20
+GRADING_SCRIPTS = 40
+RUBRIC_QUESTIONS = 20
+RUBRIC_OPEN_ENDED = 4
+CONCURRENT_SESSIONS = 8
+CONCURRENT_PAPER_QUESTIONS = 10
+SIMILARITY_QUESTIONS = 200_000
+SIMILARITY_LOOKUPS = 1000
+
+# Number of timed reruns of the app after a paper has been generated
+RERUNS = 5
+
+# How much worse than the baseline a result may be before it counts as a regression
+REGRESSION_TOLERANCE = 0.2
+
+# Modules that are slow to import and are only loaded once the feature that needs them is used
+LAZY_MODULES = ["openai", "pandas", "numpy", "pyarrow", "openpyxl", "PyPDF2"]
+
+# Limits that must be met whatever the baseline: seconds to the first full page in a new process, seconds for a rerun
+# of an idle page, the number of LAZY_MODULES loaded by then, and milliseconds to check a question for near-duplicates
+BUDGETS = {
+    "cold_start": 4.0,
+    "idle_rerun": 0.3,
+    "startup_lazy_modules": 0,
+    "similarity_lookup": 1.0,
+}
+
+# Metric name -> (unit, whether higher is better)
+METRICS = {
+    "cold_start": ("s", False),
+    "idle_rerun": ("s", False),
+    "startup_lazy_modules": ("modules", False),
+    "paper_latency": ("s", False),
+    "paper_rerun": ("s", False),
+    "reference_paper_latency": ("s", False),
+    "pdf_cold": ("s", False),
+    "pdf_warm": ("s", False),
+    "grading_batch": ("s", False),
+    "grading_throughput": ("scripts/min", True),
+    "rubric_grading_batch": ("s", False),
+    "rubric_auto_marked": ("%", True),
+    "session_latency_p50": ("s", False),
+    "session_latency_p95": ("s", False),
+    "session_throughput": ("papers/min", True),
+    "prompt_tokens": ("tokens", False),
+    "similarity_lookup": ("ms", False),
+    "peak_memory": ("MB", False),
+}
+
+# Start the fake OpenAI server on a free local port and point the OpenAI client at it
+def start_fake_server(first_token_latency, token_delay, tokens_per_chunk, rate_limit_rpm):
+    fake_openai.FakeOpenAIHandler.first_token_latency = first_token_latency
+    fake_openai.FakeOpenAIHandler.token_delay = token_delay
+    fake_openai.FakeOpenAIHandler.tokens_per_chunk = tokens_per_chunk
+    fake_openai.FakeOpenAIHandler.rate_limit_rpm = rate_limit_rpm
+    server = ThreadingHTTPServer(('127.0.0.1', 0), fake_openai.FakeOpenAIHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ['OPENAI_BASE_URL'] = f"http://127.0.0.1:{server.server_port}/v1"
+    return server
+
+# Build a plain text PDF with the given number of pages
+def make_pdf(pages, lines_per_page=40):
+    font_id = 3 + 2 * pages
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        f"<< /Type /Pages /Kids [{' '.join(f'{3 + 2 * page} 0 R' for page in range(pages))}] /Count {pages} >>".encode(),
+    ]
+    for page in range(pages):
+        lines = "".join(f"(Page {page + 1} line {line}: fractions, ratio, algebra and speed.) Tj 0 -14 Td " for line in range(lines_per_page))
+        stream = f"BT /F1 10 Tf 40 760 Td {lines} ET".encode()
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {4 + 2 * page} 0 R "
+                       f"/Resources << /Font << /F1 {font_id} 0 R >> >> >>".encode())
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+    objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+    pdf = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        pdf += b"%010d 00000 n \n" % offset
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(pdf)
+
+# Seconds taken by fn(), and its result
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+# Peak resident memory of this process so far, in MB
+def peak_memory_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+# A file as the app receives it from st.file_uploader
+class UploadedFile(io.BytesIO):
+    def __init__(self, name, data, type):
+        super().__init__(data)
+        self.name = name
+        self.type = type
+
+# Streamlit's test runner cannot upload files, so the Assessment Generation tab's uploader is made to return `files`
+@contextmanager
+def reference_upload(files):
+    import streamlit as st
+
+    file_uploader = st.file_uploader
+
+    def upload(label, *args, **kwargs):
+        return files if label.startswith("Upload files") else file_uploader(label, *args, **kwargs)
+
+    with mock.patch.object(st, "file_uploader", upload):
+        yield
+
+# A fresh app session with the API key entered
+def new_session():
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file('app.py', default_timeout=600)
+    at.run()
+    at.text_input[0].input("benchmark")
+    at.button[0].click()
+    at.run()
+    return at
+
+def set_checkbox(at, label, value):
+    next(checkbox for checkbox in at.checkbox if checkbox.label == label).set_value(value)
+
+# Runs in a fresh interpreter: time the first full page (imports, database setup and the script run after the API key
+# is entered) and the reruns after it, and print the results as JSON
+def probe_startup(reruns=RERUNS):
+    start = time.perf_counter()
+    at = new_session()
+    cold_start = time.perf_counter() - start
+    if at.exception:
+        raise RuntimeError(f"The app failed to start: {at.exception}")
+    loaded = [name for name in LAZY_MODULES if name in sys.modules]
+    rerun_times = [timed(at.run)[0] for _ in range(reruns)]
+    print(json.dumps({"cold_start": cold_start, "idle_rerun": statistics.median(rerun_times), "loaded": loaded}))
+
+# Cold start and idle rerun cost, measured in a new process so that nothing is already imported or cached
+def bench_startup():
+    output = subprocess.run([sys.executable, "-c", "import benchmark; benchmark.probe_startup()"], capture_output=True, text=True, check=True)
+    probe = json.loads(output.stdout.strip().splitlines()[-1])
+    if probe["loaded"]:
+        print(f"Loaded at startup: {', '.join(probe['loaded'])}", file=sys.stderr)
+    return {"cold_start": probe["cold_start"], "idle_rerun": probe["idle_rerun"], "startup_lazy_modules": len(probe["loaded"])}
+
+# Generate a fresh paper in a session, rerunning the page until the background job has been collected,
+# and return it, failing if the app reported an error
+def generate_paper(at, questions, poll_interval=0.05):
+    at.number_input[0].set_value(questions)
+    set_checkbox(at, "Force regenerate", True)
+    set_checkbox(at, "Reuse questions from the question bank", False)
+    at.run()
+    if at.exception:
+        raise RuntimeError(f"The app failed before generating: {at.exception[0].message}")
+    next(button for button in at.button if button.label == "Generate Questions").click()
+    at.run()
+    while not at.exception and at.session_state.collected_jobs.get("generation") != at.session_state.active_jobs.get("generation"):
+        time.sleep(poll_interval)
+        at.run()
+    if at.exception or at.error:
+        raise RuntimeError(f"Generation failed: {[error.value for error in at.error] or at.exception}")
+    return at.session_state.structured_questions
+
+# End-to-end latency of a large paper, how long a rerun takes with it on screen, and the latency with a PDF uploaded as reference material
+def bench_paper(questions=PAPER_QUESTIONS, reruns=RERUNS):
+    at = new_session()
+    latency, paper = timed(lambda: generate_paper(at, questions))
+    if len(paper) != questions:
+        raise RuntimeError(f"Expected {questions} questions, got {len(paper)}")
+    rerun_times = [timed(at.run)[0] for _ in range(reruns)]
+
+    # The same with a PDF uploaded as reference material, which is read, indexed and summarized into the prompt
+    with reference_upload([UploadedFile("reference.pdf", make_pdf(REFERENCE_PDF_PAGES), "application/pdf")]):
+        at = new_session()
+        reference_latency, paper = timed(lambda: generate_paper(at, questions))
+    if len(paper) != questions:
+        raise RuntimeError(f"Expected {questions} questions with reference material, got {len(paper)}")
+    return {"paper_latency": latency, "paper_rerun": statistics.median(rerun_times), "reference_paper_latency": reference_latency}
+
+# Reading a large PDF, first uncached and then from the extraction cache
+def bench_pdf(pages=PDF_PAGES):
+    from ingest import read_pdf_bytes
+
+    data = make_pdf(pages)
+    cold, text = timed(lambda: read_pdf_bytes(data))
+    warm, _ = timed(lambda: read_pdf_bytes(data))
+    if f"Page {pages} line" not in text:
+        raise RuntimeError("The PDF was not read completely")
+    return {"pdf_cold": cold, "pdf_warm": warm}
+
+# Grading a class worth of scripts on the worker pool
+def bench_grading(scripts=GRADING_SCRIPTS):
+    from api_client import get_client
+    from grading import grade_submissions
+
+    submissions = {f"student_{number}.txt": f"1. 3/4 of 12 = 9\n2. 25% of 80 = 20\n3. Student {number}" for number in range(1, scripts + 1)}
+    statuses = {}
+
+    def run():
+        for statuses_so_far in grade_submissions(submissions, client=get_client("benchmark", "benchmark")):
+            statuses.update(statuses_so_far)
+
+    duration, _ = timed(run)
+    failed = [name for name, status in statuses.items() if status["Status"] != "Done"]
+    if failed:
+        raise RuntimeError(f"{len(failed)} scripts failed to grade")
+    return {"grading_batch": duration, "grading_throughput": scripts / duration * 60}
+
+# Grading a class worth of scripts against a Mathematics paper's answer key, where most answers are numbers and
+# fractions that are marked without the model
+def bench_rubric(scripts=GRADING_SCRIPTS, questions=RUBRIC_QUESTIONS, open_ended=RUBRIC_OPEN_ENDED):
+    from api_client import get_client
+    from grading import grade_submissions
+    from marking import auto_mark
+
+    answer_key = [{"question": f"What is \\frac{{{n}}}{{{n + 1}}} of {n * 12} km/h?", "answer": f"\\frac{{{n * 12 * n}}}{{{n + 1}}} km/h", "marks": 2}
+                  for n in range(1, questions - open_ended + 1)]
+    answer_key += [{"question": f"Explain how you would check your answer to question {n}.",
+                    "answer": "Multiply the answer by the denominator and divide by the numerator to get back the original speed.", "marks": 3}
+                   for n in range(1, open_ended + 1)]
+    # Every student shows working for the fractions, gets one wrong, and writes a sentence for each explanation
+    submissions = {f"student_{number}.txt": "\n".join(
+        [f"{n}. {n}/{n + 1} x {n * 12} = {(n * 12 * n + (number == n)) / (n + 1):.2f} km/h" for n in range(1, questions - open_ended + 1)] +
+        [f"{n}. I would work backwards from my answer to question {n - questions + open_ended}." for n in range(questions - open_ended + 1, questions + 1)])
+        for number in range(1, scripts + 1)}
+    statuses = {}
+
+    def run():
+        for statuses_so_far in grade_submissions(submissions, client=get_client("benchmark", "benchmark"), answer_key=answer_key):
+            statuses.update(statuses_so_far)
+
+    duration, _ = timed(run)
+    failed = [name for name, status in statuses.items() if status["Status"] != "Done"]
+    if failed:
+        raise RuntimeError(f"{len(failed)} scripts failed to grade: {statuses[failed[0]]['Feedback']}")
+    first = submissions["student_1.txt"].splitlines()
+    auto_marked = sum(auto_mark(question["answer"], line.partition(". ")[2]) is not None for question, line in zip(answer_key, first))
+    return {"rubric_grading_batch": duration, "rubric_auto_marked": auto_marked / questions * 100}
+
+# Several sessions submitting papers at the same time, as in a class using the app together.
+# Streamlit's test runner cannot run several scripts at once, so the jobs are submitted to the job queue directly.
+def bench_sessions(sessions=CONCURRENT_SESSIONS, questions=CONCURRENT_PAPER_QUESTIONS, poll_interval=0.05):
+    from jobs import DONE, FINISHED_STATUSES, get_job, submit_job
+
+    request = {
+        "subject": "Mathematics", "topics": [], "acad_level": "Primary Five", "difficulty": "Intermediate", "question_type": "Short Questions",
+        "no_of_qns": questions, "language": "English", "keyword": "", "portions": {}, "reference_text": "", "file_digest": "",
+        "context_budget": 0, "structured": True, "stream": True, "force_regenerate": True, "use_bank": False,
+    }
+    start = time.time()
+    job_ids = [submit_job(f"benchmark-{session}", "generation", "benchmark", request, "benchmark") for session in range(sessions)]
+    jobs = {}
+    while len(jobs) < len(job_ids):
+        time.sleep(poll_interval)
+        for job_id in job_ids:
+            job = jobs.get(job_id) or get_job(job_id)
+            if job["status"] in FINISHED_STATUSES:
+                jobs[job_id] = job
+    duration = time.time() - start
+    failed = [job for job in jobs.values() if job["status"] != DONE or len(job["result"]["questions"]) != questions]
+    if failed:
+        raise RuntimeError(f"{len(failed)} sessions did not get a complete paper: {failed[0]['error']}")
+    latencies = sorted(job["finished_at"] - job["created_at"] for job in jobs.values())
+    return {
+        "session_latency_p50": statistics.median(latencies),
+        "session_latency_p95": latencies[min(len(latencies) - 1, round(0.95 * (len(latencies) - 1)))],
+        "session_throughput": sessions / duration * 60,
+    }
+
+# Size of the prompt sent for a typical paper: structured, no topics chosen and no reference material
+def bench_prompt():
+    from curriculum import SUBJECT_TO_TOPICS
+    from generation import build_generation_prompt, build_prompt_type
+    from prompt_budget import compact_whitespace, count_prompt_tokens
+    from questions import build_structured_prompt
+
+    prompt = build_structured_prompt(build_generation_prompt("", "", build_prompt_type("Short Questions", "Mathematics", CONCURRENT_PAPER_QUESTIONS),
+                                                             "Primary Five", "Intermediate", "en", "", "Not specified",
+                                                             SUBJECT_TO_TOPICS["Mathematics"], structured=True))
+    return {"prompt_tokens": count_prompt_tokens(compact_whitespace(prompt))}
+
+# A question history of the given size, in papers of ten questions
+def make_question_history(questions):
+    import random
+
+    rng = random.Random(499)
+    templates = [
+        "A shop sold {a} {item} on {day} and {b} {item} on the next day. How many {item} did it sell altogether?",
+        "{name} had {a} {item} and gave {b} of them away. How many {item} were left?",
+        "What is {a}/{b} of {c}?",
+        "Find the area of a rectangle {a} cm long and {b} cm wide.",
+        "A tank holds {a} litres of water. {b} litres are used each day. How many days does the water last?",
+        "Round {a}{b}{c} to the nearest hundred.",
+    ]
+    words = {"item": ["apples", "pencils", "stickers", "marbles"], "day": ["Monday", "Tuesday", "Saturday"], "name": ["Mei", "Siti", "Ravi"]}
+    return [{"question": rng.choice(templates).format(a=rng.randint(2, 999), b=rng.randint(2, 999), c=rng.randint(2, 999),
+                                                     **{key: rng.choice(values) for key, values in words.items()})}
+            for _ in range(questions)]
+
+# Checking a new question for near-duplicates in a large question history
+def bench_similarity(questions=SIMILARITY_QUESTIONS, lookups=SIMILARITY_LOOKUPS):
+    from similarity import SimilarityIndex, sign_questions
+
+    history = make_question_history(questions)
+    index = SimilarityIndex()
+    for start in range(0, questions, 10):
+        index.add(f"paper-{start}", sign_questions(history[start:start + 10]))
+    # Half the lookups repeat a stored question and should find it
+    probes = history[:lookups // 2] + make_question_history(questions + lookups // 2)[questions:]
+    index.query(sign_questions(probes[:1])[0])
+    found = 0
+    times = []
+    for probe in probes:
+        duration, papers = timed(lambda: index.query(sign_questions([probe])[0]))
+        times.append(duration * 1000)
+        found += bool(papers)
+    if found < lookups // 2:
+        raise RuntimeError(f"Only {found} of {lookups // 2} repeated questions were found")
+    return {"similarity_lookup": statistics.median(times)}
+
+# Metrics over their budget
+def find_over_budget(results, budgets=BUDGETS):
+    return [(name, budgets[name], value) for name, value in results.items() if name in budgets and value > budgets[name]]
+
+# Metrics that are worse than the baseline by more than the tolerance
+def find_regressions(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    regressions = []
+    for name, value in results.items():
+        previous = baseline.get(name)
+        if not previous or name not in METRICS:
+            continue
+        change = (value - previous) / previous
+        if (-change if METRICS[name][1] else change) > tolerance:
+            regressions.append((name, previous, value))
+    return regressions
+
+def print_results(results, baseline):
+    print(f"{'Metric':<22}{'Result':>14}{'Baseline':>14}  Unit")
+    for name, (unit, _) in METRICS.items():
+        if name in results:
+            previous = f"{baseline[name]:.3f}" if name in baseline else "-"
+            print(f"{name:<22}{results[name]:>14.3f}{previous:>14}  {unit}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the app offline against the fake OpenAI server")
+    parser.add_argument('--only', nargs='+', choices=['startup', 'prompt', 'paper', 'pdf', 'grading', 'rubric', 'sessions', 'similarity'], help="Run only these benchmarks")
+    parser.add_argument('--sessions', type=int, default=CONCURRENT_SESSIONS, help="Number of concurrent sessions in the sessions benchmark")
+    parser.add_argument('--first-token-latency', type=float, default=0.2, help="Seconds before the fake server sends the first token")
+    parser.add_argument('--token-delay', type=float, default=0.005, help="Seconds between streamed tokens")
+    parser.add_argument('--tokens-per-chunk', type=int, default=1, help="Tokens in each streamed chunk")
+    parser.add_argument('--rate-limit-rpm', type=int, default=0, help="Requests per minute before the fake server answers 429 (0 for no limit)")
+    parser.add_argument('--output', help="Write the results to this JSON file")
+    parser.add_argument('--baseline', help="Compare against results previously written with --output")
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE, help="Allowed slowdown against the baseline (0.2 is 20%%)")
+    args = parser.parse_args()
+
+    # The app reads these when its modules are first imported, so they are set before anything else is loaded
+    workdir = tempfile.mkdtemp(prefix="benchmark-")
+    os.environ['FEEDBACK_DB_PATH'] = os.path.join(workdir, "benchmark.db")
+    os.environ['EXTRACTION_CACHE_DIR'] = os.path.join(workdir, "extraction_cache")
+    start_fake_server(args.first_token_latency, args.token_delay, args.tokens_per_chunk, args.rate_limit_rpm)
+
+    benchmarks = {"startup": bench_startup, "prompt": bench_prompt, "paper": bench_paper, "pdf": bench_pdf, "grading": bench_grading,
+                  "rubric": bench_rubric, "sessions": lambda: bench_sessions(args.sessions), "similarity": bench_similarity}
+    results = {}
+    for name, benchmark in benchmarks.items():
+        if args.only and name not in args.only:
+            continue
+        print(f"Running {name}...", file=sys.stderr)
+        results.update(benchmark())
+    results["peak_memory"] = peak_memory_mb()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    regressions = find_regressions(results, baseline, args.tolerance)
+    for name, previous, value in regressions:
+        print(f"Regression: {name} went from {previous:.3f} to {value:.3f} {METRICS[name][0]}")
+    over_budget = find_over_budget(results)
+    for name, budget, value in over_budget:
+        print(f"Over budget: {name} is {value:.3f} {METRICS[name][0]}, the budget is {budget}")
+    sys.exit(1 if regressions or over_budget else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,23 @@
+# Mapping subjects to topics
+SUBJECT_TO_TOPICS = {
+    "Mathematics": ["Whole Numbers", "Algebra", "Money", "Measurement and Geometry", "Statistics", "Fractions", "Time", "Area and Volume", "Decimals", "Multiplication and Division", "Percentage", "Ratio", "Rate and Speed"],
+    "English Language": ["Grammar", "Literature", "Writing", "Reading Comprehension"],
+    "Science": ["Physics", "Chemistry", "Biology"],
+    "Social Studies": ["Discovering Self and Immediate Environment", "Understanding Singapore in the Past and Present", "Appreciating Singapore, the Region and the World We Live In"]
+}
+
+# Languages questions can be generated in, with their language codes
+LANGUAGE_OPTIONS = {
+    "English": "en",
+    "Spanish": "es",
+    "French": "fr",
+    "Chinese": "zh",
+    "German": "de",
+    "Japanese": "ja"
+}
+
+ACADEMIC_LEVELS = ["Primary One", "Primary Two", "Primary Three", "Primary Four", "Primary Five", "Primary Six"]
+
+DIFFICULTIES = ["Basic", "Intermediate", "Advanced"]
+
+QUESTION_TYPES = ["Short Questions", "Comprehensive Exam-Style Questions"]
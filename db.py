@@ -0,0 +1,359 @@
+import atexit
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import streamlit as st
+
+logger = logging.getLogger(__name__)
+
+# Location of the application database
+DB_PATH = os.environ.get('FEEDBACK_DB_PATH', 'feedback.db')
+
+# Number of pooled connections shared by all sessions in this process
+POOL_SIZE = 5
+
+# How long a connection waits for a lock held by another writer (in seconds)
+BUSY_TIMEOUT = 30
+
+# Write-behind batching: maximum statements per transaction and how long to wait for more to arrive (in seconds)
+WRITE_BATCH_SIZE = 100
+WRITE_BATCH_WAIT = 0.05
+
+# Fill the feedback topics and rating rollups from the ratings stored before they existed
+def backfill_feedback_analytics(conn):
+    from analytics import rebuild_analytics
+
+    rebuild_analytics(conn)
+
+# Schema migrations, applied in order and recorded in PRAGMA user_version. A step is an SQL statement, or a function
+# taking the connection for data changes that SQL alone cannot make.
+# Append new migrations to the end; never edit one that has already shipped.
+MIGRATIONS = [
+    # 1: feedback, generated questions and API usage logs
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS feedback (
+            id INTEGER PRIMARY KEY,
+            question_hash TEXT UNIQUE,
+            subject TEXT NOT NULL,
+            topics TEXT NOT NULL,
+            rating INTEGER NOT NULL,
+            feedback TEXT NOT NULL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS generated_questions (
+            id INTEGER PRIMARY KEY,
+            subject TEXT NOT NULL,
+            difficulty_level TEXT NOT NULL,
+            question_content TEXT NOT NULL,
+            generated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS api_usage_logs (
+            id INTEGER PRIMARY KEY,
+            api_request TEXT NOT NULL,
+            api_response TEXT NOT NULL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            response_time INTEGER NOT NULL
+        )
+        ''',
+    ],
+    # 2: cache of generations for identical requests
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS response_cache (
+            cache_key TEXT PRIMARY KEY,
+            content TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_accessed REAL NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_response_cache_last_accessed ON response_cache (last_accessed)',
+    ],
+    # 3: individual questions of structured papers
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS paper_questions (
+            id INTEGER PRIMARY KEY,
+            question_hash TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            question TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            topic TEXT,
+            marks INTEGER,
+            difficulty TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_paper_questions_question_hash ON paper_questions (question_hash)',
+    ],
+    # 4: request details on generated papers, and the question bank
+    [
+        'ALTER TABLE generated_questions ADD COLUMN question_hash TEXT',
+        'ALTER TABLE generated_questions ADD COLUMN acad_level TEXT',
+        'ALTER TABLE generated_questions ADD COLUMN language TEXT',
+        'ALTER TABLE generated_questions ADD COLUMN question_type TEXT',
+        'ALTER TABLE generated_questions ADD COLUMN topics TEXT',
+        '''
+        CREATE TABLE IF NOT EXISTS question_bank (
+            id INTEGER PRIMARY KEY,
+            question_key TEXT NOT NULL,
+            question TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            subject TEXT,
+            topic TEXT COLLATE NOCASE,
+            acad_level TEXT,
+            difficulty TEXT,
+            language TEXT,
+            question_type TEXT,
+            source_hash TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (question_key, subject, acad_level, difficulty, language, question_type)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_question_bank_lookup ON question_bank (subject, acad_level, difficulty, language, question_type, topic)',
+        'CREATE INDEX IF NOT EXISTS idx_question_bank_source_hash ON question_bank (source_hash)',
+    ],
+    # 5: performance metrics, one row per measured operation
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS metrics (
+            recorded_at REAL NOT NULL,
+            feature TEXT NOT NULL,
+            subject TEXT,
+            model TEXT,
+            duration_ms REAL NOT NULL,
+            ttft_ms REAL,
+            prompt_tokens INTEGER,
+            completion_tokens INTEGER,
+            cache_hit INTEGER,
+            error TEXT
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_metrics_recorded_at ON metrics (recorded_at)',
+    ],
+    # 6: background generation and grading jobs
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            session_id TEXT NOT NULL,
+            owner TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            label TEXT NOT NULL,
+            status TEXT NOT NULL,
+            params TEXT NOT NULL,
+            progress REAL NOT NULL DEFAULT 0,
+            partial TEXT,
+            result TEXT,
+            error TEXT,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            updated_at REAL NOT NULL,
+            finished_at REAL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_jobs_session_id ON jobs (session_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at)',
+    ],
+    # 7: state shared between replicas of the app (see shared_state.py)
+    [
+        'CREATE TABLE IF NOT EXISTS shared_state (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)',
+        'CREATE INDEX IF NOT EXISTS idx_shared_state_expires_at ON shared_state (expires_at)',
+    ],
+    # 8: MinHash signatures of the questions in stored papers (see similarity.py), and near-identical request lookup
+    [
+        'CREATE TABLE IF NOT EXISTS paper_signatures (paper_id INTEGER PRIMARY KEY, paper_hash TEXT NOT NULL, signatures BLOB NOT NULL)',
+        'ALTER TABLE response_cache ADD COLUMN request_group TEXT',
+        'ALTER TABLE response_cache ADD COLUMN request_signature BLOB',
+        'CREATE INDEX IF NOT EXISTS idx_response_cache_request_group ON response_cache (request_group)',
+    ],
+    # 9: feedback analytics: each rating's paper details, its topics, and daily rating rollups (see analytics.py)
+    [
+        'ALTER TABLE feedback ADD COLUMN acad_level TEXT',
+        'ALTER TABLE feedback ADD COLUMN difficulty TEXT',
+        'ALTER TABLE feedback ADD COLUMN prompt_variant TEXT',
+        'ALTER TABLE generated_questions ADD COLUMN prompt_variant TEXT',
+        'CREATE INDEX IF NOT EXISTS idx_generated_questions_question_hash ON generated_questions (question_hash)',
+        # Papers stored so far were generated with the prompt that is now the standard variant
+        "UPDATE generated_questions SET prompt_variant = 'standard'",
+        '''
+        UPDATE feedback SET
+            prompt_variant = 'standard',
+            acad_level = (SELECT acad_level FROM generated_questions g WHERE g.question_hash = feedback.question_hash ORDER BY g.id LIMIT 1),
+            difficulty = (SELECT difficulty_level FROM generated_questions g WHERE g.question_hash = feedback.question_hash ORDER BY g.id LIMIT 1)
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS feedback_topics (
+            feedback_id INTEGER NOT NULL,
+            topic TEXT NOT NULL COLLATE NOCASE,
+            PRIMARY KEY (feedback_id, topic)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_feedback_topics_topic ON feedback_topics (topic)',
+        '''
+        CREATE TABLE IF NOT EXISTS rating_rollups (
+            subject TEXT NOT NULL,
+            topic TEXT NOT NULL DEFAULT '',
+            acad_level TEXT NOT NULL DEFAULT '',
+            difficulty TEXT NOT NULL DEFAULT '',
+            prompt_variant TEXT NOT NULL DEFAULT '',
+            day TEXT NOT NULL,
+            ratings INTEGER NOT NULL DEFAULT 0,
+            rating_sum INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (subject, topic, acad_level, difficulty, prompt_variant, day)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_rating_rollups_day ON rating_rollups (day)',
+        backfill_feedback_analytics,
+    ],
+    # 10: papers written around a keyword or reference material are marked so that they stay out of the question bank,
+    # and questions backfilled from questions.db, which had no subject or level for a request to match, are removed
+    [
+        'ALTER TABLE generated_questions ADD COLUMN tailored INTEGER NOT NULL DEFAULT 0',
+        'DELETE FROM question_bank WHERE subject IS NULL',
+    ],
+]
+
+# Open a connection configured for concurrent use
+def open_connection(path=DB_PATH):
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+# Apply any migrations the database has not seen yet. The write lock is taken before reading the
+# schema version so that processes starting at the same time never apply the same migration twice.
+def migrate(conn):
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            for statement in statements:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {number}')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+# A fixed-size pool of connections handed out one at a time
+class ConnectionPool:
+    def __init__(self, path=DB_PATH, size=POOL_SIZE):
+        self.path = path
+        self._connections = queue.LifoQueue()
+        for _ in range(size):
+            self._connections.put(open_connection(path))
+
+    # Borrow a connection, committing on success and rolling back on error
+    @contextmanager
+    def connection(self):
+        conn = self._connections.get()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self._connections.put(conn)
+
+# Performs queued writes on a background thread so that callers never wait on the database
+class WriteBehindQueue:
+    def __init__(self, pool, batch_size=WRITE_BATCH_SIZE, batch_wait=WRITE_BATCH_WAIT):
+        self._pool = pool
+        self._batch_size = batch_size
+        self._batch_wait = batch_wait
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="db-write-behind", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    # Queue fn(conn, *args) to run on the writer thread
+    def submit(self, fn, *args):
+        self._queue.put((fn, args))
+
+    # Block until every queued write has been performed
+    def flush(self):
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self._batch_wait
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            self._write(batch)
+            for _ in batch:
+                self._queue.task_done()
+
+    # Write the batch in one transaction, falling back to one transaction per write if any of them fails
+    def _write(self, batch):
+        try:
+            with self._pool.connection() as conn:
+                for fn, args in batch:
+                    fn(conn, *args)
+            return
+        except sqlite3.Error:
+            pass
+        for fn, args in batch:
+            try:
+                with self._pool.connection() as conn:
+                    fn(conn, *args)
+            except sqlite3.Error:
+                logger.exception("Background database write failed")
+
+# Process-wide connection pool; the schema is migrated once when the pool is created
+@st.cache_resource
+def get_pool():
+    pool = ConnectionPool(DB_PATH, POOL_SIZE)
+    with pool.connection() as conn:
+        migrate(conn)
+    return pool
+
+# Process-wide write-behind queue
+@st.cache_resource
+def get_writer():
+    return WriteBehindQueue(get_pool())
+
+# Run fn(conn, *args) on a pooled connection and return its result
+def with_connection(fn, *args):
+    with get_pool().connection() as conn:
+        return fn(conn, *args)
+
+# Run a query and return the first row
+def query_one(sql, params=()):
+    with get_pool().connection() as conn:
+        return conn.execute(sql, params).fetchone()
+
+# Run a query and return all rows
+def query_all(sql, params=()):
+    with get_pool().connection() as conn:
+        return conn.execute(sql, params).fetchall()
+
+# Execute a single statement; used as a write-behind job
+def execute(conn, sql, params=()):
+    conn.execute(sql, params)
+
+# Queue fn(conn, *args) to run on the background writer
+def submit_write(fn, *args):
+    get_writer().submit(fn, *args)
+
+# Queue a single statement to run on the background writer
+def execute_later(sql, params=()):
+    submit_write(execute, sql, params)
@@ -0,0 +1,155 @@
+import argparse
+import csv
+import importlib.util
+import io
+import re
+import zipfile
+from xml.sax.saxutils import escape
+
+from latex import convert_latex_to_text
+from question_bank import split_paper
+
+# Columns exported for papers generated question by question
+QUESTION_COLUMNS = ["Question", "Answer", "Topic", "Marks", "Difficulty"]
+
+# Number of stored papers read from the database at a time during bulk export
+ARCHIVE_BATCH_SIZE = 100
+
+# Characters that are not allowed in XML documents
+INVALID_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+DOCX_CONTENT_TYPES = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n' \
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">' \
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>' \
+    '<Default Extension="xml" ContentType="application/xml"/>' \
+    '<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>' \
+    '</Types>'
+DOCX_RELATIONSHIPS = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n' \
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">' \
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>' \
+    '</Relationships>'
+
+# Rows of a paper for export as (columns, rows): one row per question for papers generated question by question,
+# otherwise one row per line of the paper
+def paper_rows(content, questions=None):
+    if questions:
+        return QUESTION_COLUMNS, [[convert_latex_to_text(question["question"]), convert_latex_to_text(question["answer"]), question["topic"],
+                                   question["marks"], question["difficulty"]] for question in questions]
+    readable_content = convert_latex_to_text(content)
+    return ["Questions"], [[line.strip()] for line in readable_content.splitlines() if line.strip()]
+
+# Write rows with a write-only workbook, which streams rows out instead of keeping a cell object for each of them
+def write_xlsx(file, columns, rows):
+    import openpyxl
+
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet("Questions")
+    sheet.append(columns)
+    for row in rows:
+        sheet.append(row)
+    workbook.save(file)
+
+# Written with a byte order mark so that Excel detects UTF-8
+def write_csv(file, columns, rows):
+    text = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+    writer = csv.writer(text)
+    writer.writerow(columns)
+    writer.writerows(rows)
+    text.flush()
+    text.detach()
+
+def write_parquet(file, columns, rows):
+    import pyarrow
+    import pyarrow.parquet
+
+    rows = list(rows)
+    table = pyarrow.table({column: [row[index] for row in rows] for index, column in enumerate(columns)})
+    pyarrow.parquet.write_table(table, file)
+
+def docx_paragraph(text, bold=False):
+    properties = '<w:rPr><w:b/></w:rPr>' if bold else ''
+    lines = INVALID_XML_CHARS.sub('', str(text)).split('\n')
+    runs = '<w:br/>'.join(f'<w:t xml:space="preserve">{escape(line)}</w:t>' for line in lines)
+    return f'<w:p><w:r>{properties}{runs}</w:r></w:p>'
+
+# A minimal Word document: each question as a numbered heading followed by its other fields, or one paragraph per line
+def write_docx(file, columns, rows):
+    with zipfile.ZipFile(file, 'w', zipfile.ZIP_DEFLATED) as document:
+        document.writestr('[Content_Types].xml', DOCX_CONTENT_TYPES)
+        document.writestr('_rels/.rels', DOCX_RELATIONSHIPS)
+        with document.open('word/document.xml', 'w') as body:
+            body.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                       b'<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>')
+            for number, row in enumerate(rows, start=1):
+                if len(columns) == 1:
+                    body.write(docx_paragraph(row[0]).encode())
+                    continue
+                body.write(docx_paragraph(f"{columns[0]} {number}", bold=True).encode())
+                body.write(docx_paragraph(row[0]).encode())
+                for column, value in zip(columns[1:], row[1:]):
+                    if value not in (None, ""):
+                        body.write(docx_paragraph(f"{column}: {value}").encode())
+            body.write(b'<w:sectPr/></w:body></w:document>')
+
+# Download formats: name -> (file extension, MIME type, writer)
+EXPORT_FORMATS = {
+    "Excel": ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", write_xlsx),
+    "CSV": ("csv", "text/csv", write_csv),
+    "Word": ("docx", "application/vnd.openxmlformats-officedocument.wordprocessingml.document", write_docx),
+}
+# Parquet needs pyarrow, which is optional
+if importlib.util.find_spec('pyarrow'):
+    EXPORT_FORMATS["Parquet"] = ("parquet", "application/vnd.apache.parquet", write_parquet)
+
+# Export a paper in one of EXPORT_FORMATS and return the file contents
+def export_paper(format_name, content, questions=None):
+    file = io.BytesIO()
+    EXPORT_FORMATS[format_name][2](file, *paper_rows(content, questions))
+    return file.getvalue()
+
+# Papers stored in generated_questions, oldest first, optionally for one subject or since a date (YYYY-MM-DD).
+# Rows are fetched in batches so that the papers are never all in memory at once.
+def iter_stored_papers(conn, subject=None, since=None, batch_size=ARCHIVE_BATCH_SIZE):
+    cursor = conn.execute('''
+                          SELECT id, subject, difficulty_level, acad_level, generated_at, question_content
+                          FROM generated_questions
+                          WHERE (? IS NULL OR subject = ?) AND (? IS NULL OR generated_at >= ?)
+                          ORDER BY id
+                          ''', (subject, subject, since, since))
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
+
+# Write stored papers into a zip archive, one file per paper plus an index of them, and return the number of papers.
+# Only one paper is held in memory at a time.
+def write_archive(file, papers, format_name):
+    extension = EXPORT_FORMATS[format_name][0]
+    index = []
+    with zipfile.ZipFile(file, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for paper_id, subject, difficulty, acad_level, generated_at, content in papers:
+            name = f"{paper_id:06d}_{re.sub(r'[^A-Za-z0-9]+', '_', subject).strip('_')}.{extension}"
+            # Papers generated question by question are stored as "1. question / Answer: answer" and split back into questions
+            archive.writestr(name, export_paper(format_name, content, split_paper(content)))
+            index.append([name, subject, acad_level or "", difficulty, generated_at])
+        index_file = io.BytesIO()
+        write_csv(index_file, ["File", "Subject", "Academic Level", "Difficulty", "Generated At"], index)
+        archive.writestr("index.csv", index_file.getvalue())
+    return len(index)
+
+def main():
+    from db import get_pool
+
+    parser = argparse.ArgumentParser(description="Export stored papers into a zip archive")
+    parser.add_argument('output', help="Path of the zip archive to write")
+    parser.add_argument('--format', choices=list(EXPORT_FORMATS), default="Excel")
+    parser.add_argument('--subject', help="Only export papers for this subject")
+    parser.add_argument('--since', help="Only export papers generated on or after this date (YYYY-MM-DD)")
+    args = parser.parse_args()
+    with get_pool().connection() as conn, open(args.output, 'wb') as file:
+        count = write_archive(file, iter_stored_papers(conn, args.subject, args.since), args.format)
+    print(f"Exported {count} papers to {args.output}.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+# A local, OpenAI-compatible stand-in for the chat completions API.
+#
+# Start it with:
+#     python fake_openai.py --port 8000
+# and point the app at it with:
+#     OPENAI_BASE_URL=http://localhost:8000/v1 streamlit run app.py
+# Any API key is accepted.
+import argparse
+import itertools
+import json
+import re
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Numbers each structured request so that parallel requests return different questions
+REQUEST_COUNTER = itertools.count(1)
+
+# Build a canned paper with LaTeX content for the number of questions requested in the prompt
+def fake_questions(prompt):
+    match = re.search(r'generate (\d+)', prompt)
+    count = int(match.group(1)) if match else 5
+    questions = [f"{n}. What is \\frac{{{n}}}{{{n + 1}}} of {n * 12} km/h?" for n in range(1, count + 1)]
+    answers = [f"{n}. \\frac{{{n * 12 * n}}}{{{n + 1}}} km/h" for n in range(1, count + 1)]
+    return "Questions:\n" + "\n".join(questions) + "\n\nAnswers:\n" + "\n".join(answers)
+
+# Build a canned paper in the structured JSON format, or a single question for a replacement request
+def fake_structured_questions(prompt):
+    if 'single JSON object' in prompt:
+        return json.dumps({"question": "What is \\frac{3}{4} of 8 hours?", "answer": "6 hours", "topic": "Fractions", "marks": 2, "difficulty": "Basic"})
+    match = re.search(r'generate (\d+)', prompt)
+    count = int(match.group(1)) if match else 5
+    request = next(REQUEST_COUNTER)
+    return json.dumps({"questions": [{
+        "question": f"What is \\frac{{{n}}}{{{n + 1}}} of {n * 12 + request * 1000} km/h?",
+        "answer": f"\\frac{{{n * 12 * n}}}{{{n + 1}}} km/h",
+        "topic": "Fractions",
+        "marks": 2,
+        "difficulty": "Basic",
+    } for n in range(1, count + 1)]}, indent=1)
+
+# Build a canned grading response
+def fake_grading(prompt):
+    return "Feedback: The working is clear and most answers are correct.\nSuggestions: Show each step of the calculation.\nGrade: B"
+
+# Build a canned response for marking one answer, awarding half the marks available rounded up
+def fake_marking(prompt):
+    match = re.search(r'Marks available: (\d+)', prompt)
+    marks = int(match.group(1)) if match else 1
+    return f"The answer gives the main idea but leaves out some detail.\nMarks: {(marks + 1) // 2}/{marks}"
+
+# Split text into small pieces that roughly resemble model tokens
+def fake_tokens(text):
+    return re.findall(r'\s*\S{1,4}|\s+', text)
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    first_token_latency = 0.2
+    token_delay = 0.01
+    # Tokens sent in each streamed chunk
+    tokens_per_chunk = 1
+    # Requests accepted per minute before answering 429 with a retry-after header; 0 disables the limit
+    rate_limit_rpm = 0
+    _request_times = deque()
+    _rate_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self.send_error(404)
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        retry_after = self.check_rate_limit()
+        if retry_after is not None:
+            self.send_json({"error": {"message": "Rate limit reached for requests", "type": "requests", "code": "rate_limit_exceeded"}},
+                           status=429, headers={"retry-after": f"{retry_after:.2f}", **self.rate_limit_headers()})
+            return
+        prompt = body.get('messages', [{}])[-1].get('content', '')
+        model = body.get('model', 'gpt-4o')
+        if 'grading the following student assessment' in prompt:
+            content = fake_grading(prompt)
+        elif 'marking one answer' in prompt:
+            content = fake_marking(prompt)
+        elif body.get('response_format', {}).get('type') == 'json_object':
+            content = fake_structured_questions(prompt)
+        else:
+            content = fake_questions(prompt)
+        tokens = fake_tokens(content)
+        time.sleep(self.first_token_latency)
+
+        if not body.get('stream'):
+            time.sleep(self.token_delay * len(tokens))
+            self.send_json({
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": len(prompt.split()), "completion_tokens": len(tokens), "total_tokens": len(prompt.split()) + len(tokens)},
+            }, headers=self.rate_limit_headers())
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        for name, value in self.rate_limit_headers().items():
+            self.send_header(name, value)
+        self.end_headers()
+        for start in range(0, len(tokens), self.tokens_per_chunk):
+            self.send_event({
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": "".join(tokens[start:start + self.tokens_per_chunk])}, "finish_reason": None}],
+            })
+            time.sleep(self.token_delay * self.tokens_per_chunk)
+        if body.get('stream_options', {}).get('include_usage'):
+            self.send_event({
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [],
+                "usage": {"prompt_tokens": len(prompt.split()), "completion_tokens": len(tokens), "total_tokens": len(prompt.split()) + len(tokens)},
+            })
+        self.wfile.write(b'data: [DONE]\n\n')
+        self.wfile.flush()
+
+    # Count this request against the per-minute limit; returns the seconds to wait if it is over the limit
+    def check_rate_limit(self):
+        if not self.rate_limit_rpm:
+            return None
+        now = time.monotonic()
+        with self._rate_lock:
+            while self._request_times and now - self._request_times[0] >= 60:
+                self._request_times.popleft()
+            if len(self._request_times) >= self.rate_limit_rpm:
+                return 60 - (now - self._request_times[0])
+            self._request_times.append(now)
+        return None
+
+    # The x-ratelimit headers the API sends with every response, when a limit is set
+    def rate_limit_headers(self):
+        if not self.rate_limit_rpm:
+            return {}
+        with self._rate_lock:
+            used = len(self._request_times)
+        return {"x-ratelimit-limit-requests": str(self.rate_limit_rpm), "x-ratelimit-remaining-requests": str(max(0, self.rate_limit_rpm - used))}
+
+    def send_json(self, payload, status=200, headers=None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_event(self, payload):
+        self.wfile.write(f"data: {json.dumps(payload)}\n\n".encode())
+        self.wfile.flush()
+
+def main():
+    parser = argparse.ArgumentParser(description="Local fake OpenAI chat completions server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--first-token-latency', type=float, default=0.2, help="Seconds before the first token is sent")
+    parser.add_argument('--token-delay', type=float, default=0.01, help="Seconds between streamed tokens")
+    parser.add_argument('--tokens-per-chunk', type=int, default=1, help="Tokens sent in each streamed chunk")
+    parser.add_argument('--rate-limit-rpm', type=int, default=0, help="Requests per minute before answering 429 (0 for no limit)")
+    args = parser.parse_args()
+
+    FakeOpenAIHandler.first_token_latency = args.first_token_latency
+    FakeOpenAIHandler.token_delay = args.token_delay
+    FakeOpenAIHandler.tokens_per_chunk = args.tokens_per_chunk
+    FakeOpenAIHandler.rate_limit_rpm = args.rate_limit_rpm
+    server = ThreadingHTTPServer((args.host, args.port), FakeOpenAIHandler)
+    print(f"Fake OpenAI server listening on http://{args.host}:{args.port}/v1")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
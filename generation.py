@@ -0,0 +1,177 @@
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from api_client import estimate_request_tokens, get_client
+from prompt_budget import compact_whitespace
+from questions import QuestionStreamParser
+from telemetry import elapsed_ms, measure
+
+# Model used for question generation
+GENERATION_MODEL = "gpt-4o"
+
+# Approximate number of completion tokens produced per question, used to drive the progress bar
+EXPECTED_TOKENS_PER_QUESTION = {
+    "Short Questions": 60,
+    "Comprehensive Exam-Style Questions": 250,
+}
+
+# Largest number of questions requested from the model in one call; bigger papers are split into shards
+SHARD_SIZE = {
+    "Short Questions": 10,
+    "Comprehensive Exam-Style Questions": 4,
+}
+
+# Number of shards generated at the same time
+SHARD_MAX_WORKERS = 8
+
+# Alternative instructions added to the generation prompt. Each paper uses one, chosen by how well each has been
+# rated (see analytics.choose_prompt_variant); new variants are tried out automatically as they are added here.
+PROMPT_VARIANTS = {
+    "standard": "",
+    "everyday_contexts": "Where it suits the topic, set questions in everyday situations familiar to pupils in Singapore.",
+    "step_by_step": "Give each answer with brief step-by-step working.",
+}
+
+# Build the instruction describing what kind of questions to generate
+def build_prompt_type(question_type, subject, no_of_qns):
+    if question_type == "Comprehensive Exam-Style Questions":
+        return f"generate {no_of_qns} {subject} long, multi-part questions suitable for exams that carry more marks and require detailed answers"
+    return f"generate {no_of_qns} {subject} short quiz questions"
+
+# Build the full generation prompt from the user's selections. Only what applies is included: the reference material
+# and keywords when given, the subject's topics when none were chosen, and the layout instructions for free-text
+# papers (structured papers carry their own), followed by the instruction of the prompt variant.
+def build_generation_prompt(file_text, selected_topics_str, prompt_type, acad_level, difficulty, language_code, keyword, portions_str, subject_topics,
+                            structured=False, variant="standard"):
+    reference = f"With reference to the content in {file_text}, and" if file_text else "For"
+    if selected_topics_str and selected_topics_str != "Any":
+        topics = f"topics {selected_topics_str}"
+    else:
+        topics = f"a mix of topics from {', '.join(topic for topic in subject_topics if topic != 'Any')}"
+    prompt = [f"You are a primary school teacher in Singapore. {reference} {topics}, {prompt_type} with corresponding answers for the academic level of \
+        {acad_level} according to the Singapore education system of {difficulty} difficulty level. Please generate the content in {language_code}."]
+    if keyword:
+        prompt.append(f"Keywords: {keyword}.")
+    if portions_str and portions_str != "Not specified":
+        prompt.append(f"portions information: {portions_str}.")
+    if not structured:
+        prompt.append("Display only questions and answers without caption or commentary. Display questions and their corresponding answers separately. \
+            Use LaTeX for rendering fractions and algebraic expressions, and ensure that all mathematical expressions can be processed through LaTeX.")
+    if PROMPT_VARIANTS.get(variant):
+        prompt.append(PROMPT_VARIANTS[variant])
+    return " ".join(prompt)
+
+# Estimate how many completion tokens a request will produce
+def estimate_completion_tokens(question_type, no_of_qns):
+    return EXPECTED_TOKENS_PER_QUESTION.get(question_type, 100) * no_of_qns
+
+# Request a completion, yielding the text received so far and the number of tokens received.
+# In streaming mode a value is yielded for every chunk; otherwise the full response is yielded once.
+# With json_mode the model is constrained to return a single JSON object. Calls use OPENAI_API_KEY unless a client
+# from api_client.get_client is given. Each call is recorded in the metrics under `feature`.
+def generate_completion(prompt, stream=True, model=GENERATION_MODEL, json_mode=False, client=None, feature="generation", subject=None):
+    client = client or get_client()
+    # Prompt templates are indented in the source; the indentation would otherwise be paid for as tokens
+    messages = [{"role": "user", "content": compact_whitespace(prompt)}]
+    options = {"response_format": {"type": "json_object"}} if json_mode else {}
+    estimated_tokens = estimate_request_tokens(messages)
+    with measure(feature, subject=subject, model=model) as metrics:
+        if not stream:
+            with client.completion(
+                estimated_tokens,
+                model=model,
+                messages=messages,
+                temperature=0.5,
+                n=1,
+                frequency_penalty=0.0,
+                **options
+            ) as response:
+                pass
+            if response.usage:
+                metrics.update(prompt_tokens=response.usage.prompt_tokens, completion_tokens=response.usage.completion_tokens)
+            if response.choices and response.choices[0].message.content:
+                content = response.choices[0].message.content
+                tokens = response.usage.completion_tokens if response.usage else len(content.split())
+                yield content, tokens
+            return
+
+        start = time.perf_counter()
+        # The request holds its place under the key's rate limits until the stream has been read
+        with client.completion(
+            estimated_tokens,
+            model=model,
+            messages=messages,
+            temperature=0.5,
+            n=1,
+            frequency_penalty=0.0,
+            stream=True,
+            # The final chunk then carries the token usage for the whole request
+            stream_options={"include_usage": True},
+            **options
+        ) as response:
+            content = ""
+            tokens = 0
+            for chunk in response:
+                if chunk.usage:
+                    metrics.update(prompt_tokens=chunk.usage.prompt_tokens, completion_tokens=chunk.usage.completion_tokens)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if not content:
+                        metrics["ttft_ms"] = elapsed_ms(start)
+                    # Each streamed chunk carries roughly one token
+                    content += delta
+                    tokens += 1
+                    yield content, tokens
+
+# Split a count into near-equal parts of at most `size`
+def split_count(count, size):
+    parts = max(1, -(-count // size))
+    return [count // parts + (1 if index < count % parts else 0) for index in range(parts)]
+
+# Share a number of questions between topics by their percentage portions (largest remainder method)
+def allocate_portions(count, portions):
+    exact = {topic: count * weight / 100 for topic, weight in portions.items()}
+    allocation = {topic: int(share) for topic, share in exact.items()}
+    remaining = count - sum(allocation.values())
+    for topic in sorted(exact, key=lambda topic: exact[topic] - allocation[topic], reverse=True)[:remaining]:
+        allocation[topic] += 1
+    return allocation
+
+# Plan the sub-requests for a paper as (question count, topic) pairs. The topic is None when a shard
+# covers all selected topics. Papers that fit in one request produce a single shard.
+def plan_shards(question_type, no_of_qns, portions=None):
+    size = SHARD_SIZE.get(question_type, 10)
+    if no_of_qns <= size:
+        return [(no_of_qns, None)]
+    if portions:
+        return [(count, topic) for topic, topic_count in allocate_portions(no_of_qns, portions).items() if topic_count
+                for count in split_count(topic_count, size)]
+    return [(count, None) for count in split_count(no_of_qns, size)]
+
+# Generate structured shards concurrently. Yields (shard index, newly completed questions, new tokens, content)
+# as the shards stream in, where content is the shard's full response once that shard has finished.
+def generate_shards(prompts, max_workers=SHARD_MAX_WORKERS, poll_interval=0.1, subject=None, client=None):
+    events = queue.Queue()
+
+    def run(index, prompt):
+        parser = QuestionStreamParser()
+        content = ""
+        tokens_reported = 0
+        for content, tokens in generate_completion(prompt, stream=True, json_mode=True, client=client, feature="generation_shard", subject=subject):
+            events.put((index, parser.update(content), tokens - tokens_reported, None))
+            tokens_reported = tokens
+        events.put((index, [], 0, content))
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(prompts)))) as executor:
+        futures = [executor.submit(run, index, prompt) for index, prompt in enumerate(prompts)]
+        while not (all(future.done() for future in futures) and events.empty()):
+            try:
+                yield events.get(timeout=poll_interval)
+            except queue.Empty:
+                pass
+        # Surface the first failure, if any shard failed
+        for future in futures:
+            future.result()
@@ -0,0 +1,158 @@
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+
+from api_client import estimate_request_tokens, get_client
+from marking import auto_mark, split_submission
+from telemetry import measure
+
+# Model used for grading
+GRADING_MODEL = "gpt-4o"
+
+# Default number of student files graded at the same time
+GRADING_MAX_WORKERS = 5
+
+# Number of a submission's open-ended answers marked by the model at the same time
+SEGMENT_MAX_WORKERS = 8
+
+# Build the grading prompt for a single student's assessment
+def build_grading_prompt(text):
+    return f"You are a teacher grading the following student assessment:\n\n{text}\n\nProvide feedback, suggestions, and a grade. \
+        End your response with a final line in the form 'Grade: <grade>'."
+
+# Build the prompt for marking one answer against the answer key
+def build_marking_prompt(question, segment, marks):
+    return "\n".join([
+        "You are a teacher marking one answer of a student's assessment against the answer key.",
+        f"Question: {question['question']}",
+        f"Answer key: {question['answer']}",
+        f"Marks available: {marks}",
+        f"Student's answer:\n{segment}",
+        f"Give one or two sentences of feedback. End your response with a final line in the form 'Marks: <marks awarded>/{marks}'.",
+    ])
+
+# Pull the final grade out of the model's response
+def extract_grade(result):
+    matches = re.findall(r'Grade\s*:\s*\**\s*([^\n*]+)', result, re.IGNORECASE)
+    return matches[-1].strip() if matches else ""
+
+# Pull the marks awarded out of the model's response, capped at the marks available
+def extract_marks(result, marks):
+    matches = re.findall(r'Marks\s*:\s*\**\s*(\d+(?:\.\d+)?)', result, re.IGNORECASE)
+    if not matches:
+        raise ValueError("The model did not return the marks awarded.")
+    return min(float(matches[-1]), marks)
+
+# Grade a single student's assessment. The client retries rate limits with backoff and calls on_retry(attempt) before
+# each retry. Calls use OPENAI_API_KEY unless a client from api_client.get_client is given.
+def grade_submission(text, on_retry=None, client=None):
+    return request_grading(build_grading_prompt(text), "grading", on_retry, client)
+
+# Send a grading prompt and return the model's response, recorded in the metrics under `feature`
+def request_grading(prompt, feature, on_retry=None, client=None):
+    client = client or get_client()
+    messages = [{"role": "user", "content": prompt}]
+    with measure(feature, model=GRADING_MODEL) as metrics:
+        with client.completion(
+            estimate_request_tokens(messages),
+            on_retry=on_retry,
+            model=GRADING_MODEL,
+            messages=messages,
+            temperature=0.5,
+            n=1,
+            frequency_penalty=0.0
+        ) as response:
+            pass
+        if response.usage:
+            metrics.update(prompt_tokens=response.usage.prompt_tokens, completion_tokens=response.usage.completion_tokens)
+    if not response.choices:
+        raise RuntimeError("The model returned no grading result.")
+    return response.choices[0].message.content.strip()
+
+# Grade a student's assessment against the answer key of a stored paper (see marking.load_answer_key), returning the
+# grade and feedback. The submission is split into its answers; objective answers are marked locally and only the
+# open-ended ones are sent to the model, each on its own and at the same time. Scripts without numbered answers are
+# graded as a whole. on_progress(marked, total) is called as answers are marked.
+def grade_with_answer_key(text, answer_key, on_retry=None, client=None, on_progress=None, max_workers=SEGMENT_MAX_WORKERS):
+    segments = split_submission(text, len(answer_key))
+    if not segments:
+        result = grade_submission(text, on_retry, client)
+        return extract_grade(result), f"No numbered answers were found, so the script was graded as a whole.\n\n{result}"
+
+    on_progress = on_progress or (lambda marked, total: None)
+    marks = [question["marks"] or 1 for question in answer_key]
+    awarded = [0.0] * len(answer_key)
+    notes = [""] * len(answer_key)
+    open_ended = []
+    with measure("grading_auto"):
+        for index, question in enumerate(answer_key):
+            segment = segments.get(index + 1, "")
+            correct = auto_mark(question["answer"], segment)
+            if correct is None:
+                open_ended.append(index)
+            else:
+                awarded[index] = marks[index] if correct else 0
+                notes[index] = "Correct." if correct else "Incorrect." if segment else "No answer found."
+    on_progress(len(answer_key) - len(open_ended), len(answer_key))
+
+    def mark(index):
+        result = request_grading(build_marking_prompt(answer_key[index], segments[index + 1], marks[index]), "grading_answer", on_retry, client)
+        awarded[index] = extract_marks(result, marks[index])
+        notes[index] = re.sub(r'\n?\s*\**\s*Marks\s*:.*$', '', result, flags=re.IGNORECASE | re.DOTALL).strip()
+
+    if open_ended:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(open_ended)))) as executor:
+            futures = [executor.submit(mark, index) for index in open_ended]
+            for marked, future in enumerate(as_completed(futures), start=len(answer_key) - len(open_ended) + 1):
+                future.result()
+                on_progress(marked, len(answer_key))
+
+    total = sum(marks)
+    feedback = "\n".join(f"- **Question {number}** ({awarded[number - 1]:g}/{marks[number - 1]}"
+                         f"{', marked automatically' if number - 1 not in open_ended else ''}): {notes[number - 1]}"
+                         for number in range(1, len(answer_key) + 1))
+    return f"{sum(awarded):g}/{total} ({sum(awarded) / total:.0%})", feedback
+
+# Grade each submission as its own job on a bounded worker pool, against the answer key if one is given.
+# `submissions` maps a file name to its text. Yields the status of every file whenever it changes,
+# where each status is a dict with "Status", "Grade" and "Feedback" keys.
+def grade_submissions(submissions, max_workers=GRADING_MAX_WORKERS, poll_interval=0.2, client=None, answer_key=None):
+    lock = threading.Lock()
+    statuses = {name: {"Status": "Queued", "Grade": "", "Feedback": ""} for name in submissions}
+
+    def set_status(name, **fields):
+        with lock:
+            statuses[name].update(fields)
+
+    def run(name, text):
+        set_status(name, Status="Grading")
+        on_retry = lambda attempt: set_status(name, Status=f"Retrying ({attempt})")
+        if answer_key:
+            grade, feedback = grade_with_answer_key(text, answer_key, on_retry, client,
+                                                    on_progress=lambda marked, total: set_status(name, Status=f"Grading ({marked}/{total} answers)"))
+        else:
+            result = grade_submission(text, on_retry=on_retry, client=client)
+            grade, feedback = extract_grade(result), result
+        set_status(name, Status="Done", Grade=grade, Feedback=feedback)
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        pending = {executor.submit(run, name, text): name for name, text in submissions.items()}
+        last_snapshot = None
+        try:
+            while pending:
+                done, _ = wait(pending, timeout=poll_interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = pending.pop(future)
+                    error = future.exception()
+                    if error:
+                        set_status(name, Status="Failed", Feedback=str(error))
+                with lock:
+                    snapshot = {name: dict(status) for name, status in statuses.items()}
+                # Polls that find nothing new are not reported, so callers only redraw on progress
+                if snapshot != last_snapshot:
+                    last_snapshot = snapshot
+                    yield snapshot
+        finally:
+            # If the caller stops early, files that have not started are not graded
+            for future in pending:
+                future.cancel()
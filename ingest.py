@@ -0,0 +1,108 @@
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# Directory holding extracted PDF text, keyed by the SHA-256 of the file. Replicas of the app should share it on a volume.
+EXTRACTION_CACHE_DIR = os.environ.get('EXTRACTION_CACHE_DIR', '.extraction_cache')
+
+# Number of pages extracted by each worker task
+PAGES_PER_TASK = 8
+
+# Number of worker processes used for extraction
+EXTRACTION_WORKERS = min(4, os.cpu_count() or 1)
+
+# The pool is created lazily and shared by every session in this process.
+# Workers are spawned rather than forked so they do not inherit the server's threads.
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_extraction_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=EXTRACTION_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+# SHA-256 digest of the file contents
+def file_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+def cache_path(digest):
+    return os.path.join(EXTRACTION_CACHE_DIR, f"{digest}.json")
+
+# Load previously extracted pages, or None if this file has not been seen before
+def load_cached_pages(digest):
+    try:
+        with open(cache_path(digest), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+# Whether the pages of a file are already in the extraction cache
+def has_cached_pages(digest):
+    return os.path.exists(cache_path(digest))
+
+# Save extracted pages; written to a temporary file first so readers never see a partial cache entry
+def store_cached_pages(digest, pages):
+    os.makedirs(EXTRACTION_CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=EXTRACTION_CACHE_DIR, suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(pages, f, ensure_ascii=False)
+    os.replace(tmp_path, cache_path(digest))
+
+# Extract the text of pages [start, stop) from a PDF on disk; runs in a worker process
+def extract_page_range(path, start, stop):
+    import PyPDF2
+
+    with open(path, 'rb') as f:
+        reader = PyPDF2.PdfReader(f)
+        return [reader.pages[number].extract_text() or '' for number in range(start, stop)]
+
+# Yield (pages done, total pages, page texts) as a PDF is read, in page order.
+# Cached files are returned in one step; new files are split across the worker pool.
+def iter_pdf_pages(data):
+    digest = file_digest(data)
+    pages = load_cached_pages(digest)
+    if pages is not None:
+        yield len(pages), len(pages), pages
+        return
+
+    # PyPDF2 is imported on first use so that startup does not pay for it
+    import PyPDF2
+
+    reader = PyPDF2.PdfReader(io.BytesIO(data))
+    total = len(reader.pages)
+    pages = []
+    if total <= PAGES_PER_TASK or EXTRACTION_WORKERS == 1:
+        for start in range(0, total, PAGES_PER_TASK):
+            batch = [reader.pages[number].extract_text() or '' for number in range(start, min(start + PAGES_PER_TASK, total))]
+            pages.extend(batch)
+            yield len(pages), total, batch
+    else:
+        # Each task re-opens the PDF, so large documents use larger tasks to keep that overhead small
+        task_pages = max(PAGES_PER_TASK, -(-total // (EXTRACTION_WORKERS * 4)))
+        # Workers read the file from disk rather than receiving a copy of it with every task
+        with tempfile.NamedTemporaryFile(suffix='.pdf') as source:
+            source.write(data)
+            source.flush()
+            pool = get_extraction_pool()
+            futures = [pool.submit(extract_page_range, source.name, start, min(start + task_pages, total))
+                       for start in range(0, total, task_pages)]
+            for future in futures:
+                batch = future.result()
+                pages.extend(batch)
+                yield len(pages), total, batch
+
+    store_cached_pages(digest, pages)
+
+# Read the full text of a PDF
+def read_pdf_bytes(data):
+    pages = []
+    for _, _, batch in iter_pdf_pages(data):
+        pages.extend(batch)
+    return ''.join(pages)
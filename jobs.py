@@ -0,0 +1,221 @@
+import json
+import logging
+import threading
+import time
+import uuid
+
+import streamlit as st
+
+from api_client import get_client
+from db import query_all, query_one, submit_write, with_connection
+from grading import grade_submissions
+from marking import load_answer_key
+from papers import generate_paper
+from shared_state import get_shared_state
+
+logger = logging.getLogger(__name__)
+
+# Number of jobs run at the same time by this server process
+JOB_WORKERS = 8
+
+# How often idle workers look for new jobs (in seconds); submitting a job wakes them immediately
+JOB_POLL_INTERVAL = 1.0
+
+# Minimum interval (in seconds) between progress updates written for a running job
+JOB_PROGRESS_INTERVAL = 0.5
+
+# How often each process marks its unfinished jobs as alive and cleans up after other processes (in seconds)
+JOB_HEARTBEAT_INTERVAL = 60
+
+# Unfinished jobs of other server processes that have not been updated for this long (in seconds) are marked as failed
+JOB_STALE_AFTER = 15 * 60
+
+# How long finished jobs are kept (in days)
+JOB_RETENTION_DAYS = 7
+
+# Job statuses
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATUSES = (DONE, FAILED, CANCELLED)
+
+class JobCancelled(Exception):
+    pass
+
+def run_generation_job(params, client, report):
+    return generate_paper(params, client=client, on_progress=lambda progress, **partial: report(progress, partial))
+
+def run_grading_job(params, client, report):
+    answer_key = with_connection(load_answer_key, params["paper_id"]) if params.get("paper_id") else None
+    statuses = {}
+    for statuses in grade_submissions(params["submissions"], max_workers=params["max_workers"], client=client, answer_key=answer_key):
+        finished = sum(1 for status in statuses.values() if status["Status"] in ("Done", "Failed"))
+        report(finished / len(statuses), {"statuses": statuses})
+    return {"results": [{"File": name, **status} for name, status in statuses.items()]}
+
+# Function run for each kind of job: fn(params, client, report) returning a JSON-serializable result.
+# report(progress, partial) records progress and partial output, and raises JobCancelled if the job was cancelled.
+JOB_HANDLERS = {
+    "generation": run_generation_job,
+    "grading": run_grading_job,
+}
+
+def insert_job(conn, job_id, session_id, owner, kind, label, params):
+    now = time.time()
+    conn.execute('INSERT INTO jobs (id, session_id, owner, kind, label, status, params, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                 (job_id, session_id, owner, kind, label, QUEUED, json.dumps(params, ensure_ascii=False), now, now))
+
+# Take the next queued job of this process, preferring sessions with the fewest jobs already running
+def claim_job(conn, owner):
+    now = time.time()
+    return conn.execute('''
+                        UPDATE jobs SET status = ?, started_at = ?, updated_at = ?
+                        WHERE id = (
+                            SELECT id FROM jobs AS queued
+                            WHERE status = ? AND owner = ?
+                            ORDER BY (SELECT COUNT(*) FROM jobs AS running WHERE running.session_id = queued.session_id AND running.status = ?), created_at
+                            LIMIT 1
+                        )
+                        RETURNING id, kind, params, session_id
+                        ''', (RUNNING, now, now, QUEUED, owner, RUNNING)).fetchone()
+
+def update_job_progress(conn, job_id, progress, partial):
+    conn.execute('UPDATE jobs SET progress = ?, partial = ?, updated_at = ? WHERE id = ? AND status = ?',
+                 (progress, partial, time.time(), job_id, RUNNING))
+
+# Cancel a job that has not started yet; returns whether it was still queued
+def cancel_queued_job(conn, job_id):
+    now = time.time()
+    return conn.execute('UPDATE jobs SET status = ?, updated_at = ?, finished_at = ? WHERE id = ? AND status = ?',
+                        (CANCELLED, now, now, job_id, QUEUED)).rowcount > 0
+
+def finish_job(conn, job_id, status, result=None, error=None):
+    now = time.time()
+    conn.execute('UPDATE jobs SET status = ?, progress = 1, result = ?, error = ?, updated_at = ?, finished_at = ? WHERE id = ?',
+                 (status, None if result is None else json.dumps(result, ensure_ascii=False), error, now, now, job_id))
+
+# Jobs cannot outlive the process that holds their API key. Each process keeps its unfinished jobs fresh, and the
+# unfinished jobs of processes that have stopped doing so are failed. Old finished jobs are deleted.
+def clean_up_jobs(conn, owner):
+    now = time.time()
+    conn.execute('UPDATE jobs SET updated_at = ? WHERE owner = ? AND status IN (?, ?)', (now, owner, QUEUED, RUNNING))
+    conn.execute('''
+                 UPDATE jobs SET status = ?, error = ?, updated_at = ?, finished_at = ?
+                 WHERE status IN (?, ?) AND owner != ? AND updated_at < ?
+                 ''', (FAILED, "The server restarted before this job finished. Please submit it again.", now, now, QUEUED, RUNNING,
+                       owner, now - JOB_STALE_AFTER))
+    conn.execute(f"DELETE FROM jobs WHERE status IN ({', '.join('?' * len(FINISHED_STATUSES))}) AND finished_at < ?",
+                 (*FINISHED_STATUSES, now - JOB_RETENTION_DAYS * 86400))
+
+# Shared state key set when a job is cancelled, so that the replica running it sees the request
+def cancel_key(job_id):
+    return f"job_cancelled:{job_id}"
+
+# A persistent queue of generation and grading jobs, run by a pool of worker threads independently of any
+# session's script run. Jobs and their progress live in the database; API keys are only ever held in memory.
+class JobQueue:
+    def __init__(self, workers=JOB_WORKERS):
+        self.owner = uuid.uuid4().hex
+        self._api_keys = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._threads = [threading.Thread(target=self._run, name=f"job-worker-{number}", daemon=True) for number in range(workers)]
+        self._threads.append(threading.Thread(target=self._heartbeat, name="job-heartbeat", daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    # Queue a job and return its id
+    def submit(self, session_id, kind, label, params, api_key):
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._api_keys[job_id] = api_key
+        with_connection(insert_job, job_id, session_id, self.owner, kind, label, params)
+        self._wake.set()
+        return job_id
+
+    # Cancel a job. A running job, on this or any other replica, stops at its next progress update.
+    def cancel(self, job_id):
+        get_shared_state().set(cancel_key(job_id), True, JOB_STALE_AFTER)
+        if with_connection(cancel_queued_job, job_id):
+            get_shared_state().delete(cancel_key(job_id))
+            with self._lock:
+                self._api_keys.pop(job_id, None)
+
+    def _run(self):
+        while True:
+            try:
+                job = with_connection(claim_job, self.owner)
+            except Exception:
+                logger.exception("Could not claim a job")
+                job = None
+            if job is None:
+                self._wake.wait(JOB_POLL_INTERVAL)
+                self._wake.clear()
+                continue
+            self._execute(*job)
+
+    def _heartbeat(self):
+        while True:
+            try:
+                with_connection(clean_up_jobs, self.owner)
+            except Exception:
+                logger.exception("Could not clean up jobs")
+            time.sleep(JOB_HEARTBEAT_INTERVAL)
+
+    def _execute(self, job_id, kind, params, session_id):
+        with self._lock:
+            api_key = self._api_keys.pop(job_id, None)
+        if api_key is None:
+            with_connection(finish_job, job_id, FAILED, None, "The API key for this job is no longer available. Please submit it again.")
+            return
+
+        last_report = 0
+
+        def report(progress, partial):
+            nonlocal last_report
+            if time.monotonic() - last_report >= JOB_PROGRESS_INTERVAL:
+                last_report = time.monotonic()
+                if get_shared_state().get(cancel_key(job_id)):
+                    raise JobCancelled()
+                submit_write(update_job_progress, job_id, progress, json.dumps(partial, ensure_ascii=False))
+
+        try:
+            result = JOB_HANDLERS[kind](json.loads(params), get_client(api_key, session_id), report)
+            with_connection(finish_job, job_id, DONE, result)
+        except JobCancelled:
+            with_connection(finish_job, job_id, CANCELLED)
+        except Exception as e:
+            logger.exception("Job %s failed", job_id)
+            with_connection(finish_job, job_id, FAILED, None, str(e))
+        finally:
+            get_shared_state().delete(cancel_key(job_id))
+
+# Process-wide job queue
+@st.cache_resource
+def get_job_queue():
+    return JobQueue()
+
+# Queue a job for a session and return its id
+def submit_job(session_id, kind, label, params, api_key):
+    return get_job_queue().submit(session_id, kind, label, params, api_key)
+
+def cancel_job(job_id):
+    get_job_queue().cancel(job_id)
+
+# A job with its progress, partial output and result decoded
+def get_job(job_id):
+    row = query_one('SELECT id, kind, label, status, progress, partial, result, error, created_at, finished_at FROM jobs WHERE id = ?', (job_id,))
+    if row is None:
+        return None
+    job = dict(zip(["id", "kind", "label", "status", "progress", "partial", "result", "error", "created_at", "finished_at"], row))
+    job["partial"] = json.loads(job["partial"]) if job["partial"] else {}
+    job["result"] = json.loads(job["result"]) if job["result"] else None
+    return job
+
+# A session's jobs of one kind, newest first, without their outputs
+def list_jobs(session_id, kind):
+    rows = query_all('SELECT id, label, status, progress, error, created_at, finished_at FROM jobs WHERE session_id = ? AND kind = ? ORDER BY created_at DESC',
+                     (session_id, kind))
+    return [dict(zip(["id", "label", "status", "progress", "error", "created_at", "finished_at"], row)) for row in rows]
@@ -0,0 +1,99 @@
+import re
+
+# All patterns are compiled once at import time rather than on every render.
+
+# Repeated units, such as "km/h km/h"
+REPEATED_KM_H = re.compile(r'(km/h)\s+\1')
+REPEATED_HOURS = re.compile(r'(hours)\s+\1')
+
+# Brace repairs, done together in one pass:
+# - a complete fraction gets a closing brace for every opening brace left unclosed inside it
+# - a fraction or text command left open at the end of the content is closed
+BRACE_REPAIRS = re.compile(r'\\frac\{([^\}]*)\}\{([^\}]*)\}|\\(?:frac|text)\{[^\}]*$')
+
+# Patterns identifying LaTeX expressions
+LATEX_PATTERNS = [
+    r'\\frac\{.*?\}\{.*?\}',  # Fractions
+    r'\$.*?\$',               # Inline math
+    r'\\sqrt(?:\{.*?\})?',    # Square root
+    r'\\sum(?:_\{.*?\})?(?:\^\{.*?\})?',  # Summation
+    r'\\int(?:_\{.*?\})?(?:\^\{.*?\})?',  # Integral
+    r'\^\{.*?\}',  # Exponents (Superscripts)
+    r'_\{.*?\}',  # Subscripts
+    r'\\begin\{.*?matrix\}.*?\\end\{.*?matrix\}',  # Matrices and arrays
+    r'\\text\{.*?\}',  # Text formatting in math mode
+    r'\\[a-zA-Z]+(?=\W|\Z)',  # Greek letters
+    r'\\(?:log|sin|cos|tan|ln|exp|arcsin|arccos|arctan)\b',  # Trig and log functions
+    r'\\left[\(\[\{].*?\\right[\)\]\}]',  # Parentheses and Brackets
+    r'\\begin\{aligned\}.*?\\end\{aligned\}',  # Aligned equations
+    r'\\begin\{align\*?\}.*?\\end\{align\*?\}',  # Align and align* environments
+]
+LATEX_REGEX = re.compile('|'.join(LATEX_PATTERNS))
+
+# Pattern used to split content into LaTeX and plain-text parts (align* environments are not split out)
+LATEX_SPLIT_REGEX = re.compile(
+    r'('  # Start a capturing group
+    r'\$.*?\$|'  # Inline math
+    r'\\frac\{.*?\}\{.*?\}|'  # Fractions
+    r'\\sqrt(?:\{.*?\})?|'  # Square root
+    r'\\sum(?:_\{.*?\})?(?:\^\{.*?\})?|'  # Summation
+    r'\\int(?:_\{.*?\})?(?:\^\{.*?\})?|'  # Integral
+    r'\^\{.*?\}|'  # Exponents (Superscripts)
+    r'_\{.*?\}|'  # Subscripts
+    r'\\begin\{.*?matrix\}.*?\\end\{.*?matrix\}|'  # Matrices and arrays
+    r'\\text\{.*?\}|'  # Text formatting in math mode
+    r'\\[a-zA-Z]+(?=\W|\Z)|'  # Greek letters
+    r'\\(?:log|sin|cos|tan|ln|exp|arcsin|arccos|arctan)\b|'  # Trig and log functions
+    r'\\left[\(\[\{].*?\\right[\)\]\}]|'  # Parentheses and Brackets
+    r'\\begin\{aligned\}.*?\\end\{aligned\}'  # Aligned equations
+    r')'
+)
+
+# Plain-text conversions used for export
+FRACTION_TO_TEXT = re.compile(r'\\frac\{(.*?)\}\{(.*?)\}')
+TEXT_COMMAND_TO_TEXT = re.compile(r'\\text\{(.*?)\}')
+
+# Fix repeated units in the content, such as "km/h km/h"
+def fix_repeated_units(content):
+    content = REPEATED_KM_H.sub(r'\1', content)
+    return REPEATED_HOURS.sub(r'\1', content)
+
+# Fix unbalanced braces in the content
+def fix_unbalanced_braces(content):
+    open_braces = content.count('{')
+    close_braces = content.count('}')
+    # Add missing closing braces if there are more opening braces
+    if open_braces > close_braces:
+        content += '}' * (open_braces - close_braces)
+    # Add missing opening braces if there are more closing braces
+    elif close_braces > open_braces:
+        content = '{' * (close_braces - open_braces) + content
+    return content
+
+def repair_braces(match):
+    if match.group(1) is not None:
+        return match.group(0) + '}' * (match.group(1).count('{') + match.group(2).count('{'))
+    return match.group(0) + '}'
+
+# Balance braces, complete fractions and text commands, and remove repeated units
+def normalize_latex(content):
+    content = fix_unbalanced_braces(content)
+    content = BRACE_REPAIRS.sub(repair_braces, content)
+    return fix_repeated_units(content)
+
+# Convert content into Markdown with each LaTeX expression set as display math
+def latex_to_markdown(content):
+    content = normalize_latex(content)
+    processed_parts = []
+    # re.split alternates plain text and captured LaTeX; captured parts always match LATEX_REGEX
+    for index, part in enumerate(LATEX_SPLIT_REGEX.split(content)):
+        if index % 2 or LATEX_REGEX.search(part):
+            processed_parts.append(f"$$ {part.strip()} $$")
+        else:
+            processed_parts.append(part.strip())
+    return ' '.join(processed_parts)
+
+# Convert LaTeX to plain text for display or export
+def convert_latex_to_text(content):
+    content = FRACTION_TO_TEXT.sub(r'\1/\2', content)
+    return TEXT_COMMAND_TO_TEXT.sub(r'\1', content)
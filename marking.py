@@ -0,0 +1,161 @@
+import re
+from fractions import Fraction
+
+from question_bank import INLINE_ANSWER, ITEM_PATTERN, split_paper
+from questions import normalize_question
+
+# Multiple-choice answers such as "B", "(b)", "B)" or "B. 12". The letter must stand alone or be marked with brackets or
+# punctuation, so that answers starting with the article "A" are not read as option A.
+CHOICE_PATTERN = re.compile(r'^\s*(?:option\s+)?\(?([A-Da-d])(?:\)|[.:]|\s*$)', re.IGNORECASE)
+# LaTeX fractions, written out as "a/b" before numbers are read
+LATEX_FRACTION = re.compile(r'\\[dt]?frac\s*\{\s*([^{}]*?)\s*\}\s*\{\s*([^{}]*?)\s*\}')
+# Powers in units such as cm^2 or m³, which are not part of the answer's value
+UNIT_POWER = re.compile(r'\^\s*\{?\s*\d+\s*\}?|[²³]')
+# Numbers with optional thousands separators and decimals, as a mixed number ("2 1/2"), a fraction ("3/4") or a
+# percentage ("50%", "50 percent")
+NUMBER_PATTERN = re.compile(r'(?<![\w.])(-?(?:\d{1,3}(?:,\d{3})+|\d+)(?:\.\d+)?)(?:\s+(\d+)\s*/\s*(\d+)|\s*/\s*(\d+(?:\.\d+)?))?(?![\d/])'
+                            r'(\s*\\?%|\s*per\s?cent\b)?', re.IGNORECASE)
+WORD_PATTERN = re.compile(r'[^\W\d_]+')
+# A line giving the final answer, such as "Answer: 12" or "Final answer 12"
+ANSWER_LINE = re.compile(r'^\s*(?:\*\*)?\s*(?:final\s+)?(?:answer|ans)\b\s*(?:\*\*)?\s*[:=-]?', re.IGNORECASE)
+
+# Most words, such as units or "apples", that an answer key may have besides its number and still be marked locally
+OBJECTIVE_MAX_WORDS = 4
+
+# Decimal answers with at least this many places count as correct when they are the key rounded to those places
+MIN_ROUNDED_PLACES = 2
+
+# Questions of a stored paper with their answers, taken from paper_questions for papers generated question by question
+# and read from the paper's text otherwise
+def load_answer_key(conn, paper_id):
+    row = conn.execute('SELECT question_hash, question_content FROM generated_questions WHERE id = ?', (paper_id,)).fetchone()
+    if row is None:
+        raise ValueError(f"Paper {paper_id} was not found.")
+    question_hash, content = row
+    # A paper generated twice has its questions stored twice; the first copy is used
+    rows = conn.execute('''
+                        SELECT question, answer, topic, marks, difficulty FROM paper_questions
+                        WHERE id IN (SELECT MIN(id) FROM paper_questions WHERE question_hash = ? GROUP BY position)
+                        ORDER BY position
+                        ''', (question_hash,)).fetchall()
+    if rows:
+        return [normalize_question(dict(zip(["question", "answer", "topic", "marks", "difficulty"], row))) for row in rows]
+    return split_paper(content)
+
+# Split a student's submission into the text given for each question, keyed by question number. A numbered line starts
+# the next question's segment only if it is labelled ("Q3", "Question 3") or numbered past the current question, so
+# numbered steps of working stay with their question.
+def split_submission(text, question_count):
+    segments = {}
+    current = None
+    for line in text.splitlines():
+        match = ITEM_PATTERN.match(line)
+        if match:
+            number = int(match.group("number"))
+            if 1 <= number <= question_count and number not in segments and (match.group("kind") or current is None or number > current):
+                current = number
+                segments[number] = [match.group("rest").strip()]
+                continue
+        if current is not None:
+            segments[current].append(line.strip())
+    return {number: "\n".join(line for line in lines if line) for number, lines in segments.items()}
+
+# The part of a segment that is the student's answer: what follows "Answer:" if the question was copied out first
+def answer_part(segment):
+    lines = segment.splitlines()
+    for index, line in enumerate(lines):
+        inline = INLINE_ANSWER.match(line)
+        if inline:
+            return "\n".join([line[inline.end():]] + lines[index + 1:]).strip()
+    return segment.strip()
+
+# Value of a NUMBER_PATTERN match, the decimal places it was written with and whether it is a percentage,
+# or None for a zero denominator
+def number_value(match):
+    whole, numerator, denominator, divisor, percent = match.groups()
+    value = Fraction(whole.replace(",", ""))
+    if numerator:
+        if not int(denominator):
+            return None
+        part = Fraction(int(numerator), int(denominator))
+        return (value - part if value < 0 else value + part), 0, bool(percent)
+    if divisor:
+        return (value / Fraction(divisor), 0, bool(percent)) if Fraction(divisor) else None
+    return value, len(whole.partition(".")[2]), bool(percent)
+
+# Numbers in a text, with LaTeX fractions and unit powers taken into account, as (value, decimal places written,
+# percentage) tuples
+def read_numbers(text):
+    text = UNIT_POWER.sub('', LATEX_FRACTION.sub(r' \1/\2 ', text.replace('$', ' ')))
+    return [number for number in map(number_value, NUMBER_PATTERN.finditer(text)) if number]
+
+# Words in a text besides its numbers, such as units
+def count_words(text):
+    return len(WORD_PATTERN.findall(NUMBER_PATTERN.sub(' ', LATEX_FRACTION.sub(' ', text))))
+
+# What an answer key can be marked against without a model: ("choice", letter) for a multiple-choice answer,
+# ("number", value, places, percentage) for a single number with at most a few words such as its unit, or None
+def objective_key(answer):
+    answer = answer_part(answer)
+    choice = CHOICE_PATTERN.match(answer)
+    if choice and choice.group(1).isupper():
+        return ("choice", choice.group(1))
+    numbers = read_numbers(answer)
+    if len(numbers) == 1 and count_words(answer) <= OBJECTIVE_MAX_WORDS:
+        return ("number", *numbers[0])
+    return None
+
+# The student's final number, or None if it cannot be told apart from the working. An answer with a single line of
+# numbers gives that line's only number. Otherwise the last line with numbers must be an equation (the first number
+# after its last "="), an answer line ("Answer: 12") or a number on its own; a line such as "So 3 boxes" after the
+# working may be about something other than what was asked, so it is left to the model.
+def final_number(answer):
+    lines = [line for line in answer.splitlines() if read_numbers(line)]
+    if not lines:
+        return None
+    last = lines[-1]
+    if "=" in last:
+        numbers = read_numbers(last.rpartition("=")[2])
+        if numbers:
+            return numbers[0]
+    label = ANSWER_LINE.match(last)
+    if label:
+        last = last[label.end():]
+    elif len(lines) > 1 and count_words(last):
+        return None
+    numbers = read_numbers(last)
+    return numbers[0] if len(numbers) == 1 else None
+
+# Whether a student's number is the key's: the same value, or either one the other rounded to the places it was written
+# with. None when only one of them is a percentage, since whether 0.5 answers "50%" depends on the question.
+def numbers_match(key, student):
+    (key_value, key_places, key_percent), (value, places, percent) = key, student
+    if key_percent != percent:
+        return None
+    if value == key_value:
+        return True
+    # 0.33 for 1/3, or 1/3 for a key of 0.33
+    if places >= MIN_ROUNDED_PLACES and round(key_value, places) == value:
+        return True
+    return key_places >= MIN_ROUNDED_PLACES and round(value, key_places) == key_value
+
+# Mark an answer against the answer key without a model: True or False, or None if it needs a model to judge.
+# Blank answers are wrong; objective keys are compared by value, so "0.75", "3/4" and "\frac{3}{4}" agree.
+def auto_mark(key_answer, segment):
+    answer = answer_part(segment)
+    if not answer:
+        return False
+    key = objective_key(key_answer)
+    if key is None:
+        return None
+    if key[0] == "choice":
+        # The last line giving a letter is taken as the student's choice
+        choices = [match for match in map(CHOICE_PATTERN.match, answer.splitlines()) if match]
+        if choices:
+            return choices[-1].group(1).upper() == key[1]
+        # The option's value may have been given instead of its letter
+        key = objective_key(CHOICE_PATTERN.sub('', answer_part(key_answer), count=1))
+        if key is None or key[0] != "number":
+            return None
+    student = final_number(answer)
+    return numbers_match(key[1:], student) if student else None
@@ -0,0 +1,245 @@
+import hashlib
+import json
+import time
+import uuid
+
+from analytics import choose_prompt_variant, paper_prompt_variant
+from curriculum import LANGUAGE_OPTIONS, SUBJECT_TO_TOPICS
+from db import execute_later, submit_write, with_connection
+from generation import (build_generation_prompt, build_prompt_type, estimate_completion_tokens, generate_completion, generate_shards, plan_shards,
+                        GENERATION_MODEL)
+from prompt_budget import count_prompt_tokens, count_tokens, prompt_token_budget, summarize
+from question_bank import add_to_bank, assemble_from_bank, split_paper
+from questions import (add_exclusions, build_structured_prompt, merge_questions, parse_questions, questions_to_text, store_paper_questions,
+                       QuestionStreamParser)
+from response_cache import (get_cached_response, get_similar_cached_response, make_cache_key, make_request_group, store_cached_response,
+                            touch_cached_response)
+from retrieval import build_query
+from shared_state import get_shared_state
+from similarity import drop_near_duplicates, find_similar_paper, near_duplicate_positions, request_signature
+from telemetry import measure
+
+# How long a request being generated stays locked against duplicate generation (in seconds), and how often
+# sessions waiting on it check the cache
+GENERATION_LOCK_TTL = 5 * 60
+GENERATION_WAIT_INTERVAL = 0.5
+
+# Unique hash of a paper, used to identify it in feedback and the question bank
+def paper_hash(content):
+    return hashlib.sha256(content.encode()).hexdigest()
+
+def generation_lock_key(cache_key):
+    return f"generating:{cache_key}"
+
+# Lock a request for generation so that identical requests, from any session on any replica, are only sent to the
+# API once. If another session holds the lock, wait for its result to reach the cache and return it; returns None
+# once the lock is taken and the caller should generate.
+def claim_generation(cache_key, owner, on_progress):
+    while not get_shared_state().add(generation_lock_key(cache_key), owner, GENERATION_LOCK_TTL):
+        on_progress(0)
+        time.sleep(GENERATION_WAIT_INTERVAL)
+        content = with_connection(get_cached_response, cache_key)
+        if content:
+            return content
+    return None
+
+# Generate a paper for a request built from the user's choices: subject, topics, acad_level, difficulty,
+# question_type, no_of_qns, language, keyword, portions, reference_text, file_digest, context_budget,
+# structured, stream, force_regenerate and use_bank, and optionally prompt_variant (otherwise chosen by past ratings).
+# Progress is reported as on_progress(fraction, questions=...) for structured papers, or
+# on_progress(fraction, text=...) with the text so far otherwise. Returns the paper and its details.
+def generate_paper(request, client=None, on_progress=None):
+    on_progress = on_progress or (lambda progress, **partial: None)
+    subject = request["subject"]
+    selected_topics = request["topics"]
+    portions = request["portions"]
+    question_type = request["question_type"]
+    no_of_qns = request["no_of_qns"]
+    structured = request["structured"]
+    selected_topics_str = "Any" if "Any" in selected_topics else ", ".join(selected_topics)
+    portions_str = ', '.join([f"{topic}: {weight}%" for topic, weight in portions.items()]) if portions else "Not specified"
+
+    # End-to-end time for the whole paper, including cache and bank lookups
+    with measure("paper", subject=subject) as metrics:
+        reference_text = request["reference_text"]
+        prompt_variant = request.get("prompt_variant") or with_connection(choose_prompt_variant, subject, request["acad_level"])
+
+        # Prompt for `count` questions on the given topics; shards of a large paper use the same template
+        def paper_prompt(count, topics_str, portions_text):
+            prompt_type = build_prompt_type(question_type, subject, count)
+            paper = build_generation_prompt(reference_text, topics_str, prompt_type, request["acad_level"], request["difficulty"],
+                                            LANGUAGE_OPTIONS[request["language"]], request["keyword"], portions_text,
+                                            SUBJECT_TO_TOPICS.get(subject, []), structured, prompt_variant)
+            return build_structured_prompt(paper) if structured else paper
+
+        prompt = paper_prompt(no_of_qns, selected_topics_str, portions_str)
+        shards = plan_shards(question_type, no_of_qns, portions or None) if structured else []
+        expected_tokens = estimate_completion_tokens(question_type, no_of_qns)
+
+        # Summarize the reference material down to its budget, and further if the prompt would not leave room for the response
+        if reference_text:
+            reference_tokens = count_tokens(reference_text)
+            overflow = count_prompt_tokens(prompt) - prompt_token_budget(GENERATION_MODEL, expected_tokens)
+            reference_budget = min(request["context_budget"] or reference_tokens, reference_tokens - max(overflow, 0))
+            if reference_budget < reference_tokens:
+                reference_text = summarize(reference_text, reference_budget, build_query(subject, selected_topics, request["keyword"]))
+                prompt = paper_prompt(no_of_qns, selected_topics_str, portions_str)
+
+        # Reuse an earlier generation for identical inputs and reference material unless asked not to
+        cache_inputs = {
+            "subject": subject,
+            "topics": selected_topics,
+            "acad_level": request["acad_level"],
+            "difficulty": request["difficulty"],
+            "question_type": question_type,
+            "no_of_qns": no_of_qns,
+            "language": request["language"],
+            "keyword": request["keyword"],
+            "portions": portions,
+            "context_budget": request["context_budget"],
+            "structured": structured,
+        }
+        cache_key = make_cache_key(cache_inputs, request["file_digest"])
+        cached_content = None if request["force_regenerate"] else with_connection(get_cached_response, cache_key)
+        # Then for the same choices with keywords and reference material that differ only trivially
+        request_group = make_request_group(cache_inputs)
+        signature = request_signature(request["keyword"], request["reference_text"])
+        if not cached_content and not request["force_regenerate"]:
+            similar_request = with_connection(get_similar_cached_response, request_group, signature)
+            if similar_request:
+                cache_key, cached_content = similar_request
+        generation_owner = None
+        if not cached_content and not request["force_regenerate"]:
+            generation_owner = uuid.uuid4().hex
+            cached_content = claim_generation(cache_key, generation_owner, on_progress)
+            if cached_content:
+                generation_owner = None
+        metrics["cache_hit"] = bool(cached_content)
+
+        # Take what the question bank already has and only generate the gaps
+        bank_context = {
+            "subject": subject,
+            "acad_level": request["acad_level"],
+            "difficulty": request["difficulty"],
+            "language": request["language"],
+            "question_type": question_type,
+        }
+        # Questions written around a keyword or reference material could not stand on their own in other papers,
+        # so such papers neither take questions from the bank nor add theirs to it
+        tailored = bool(request["reference_text"] or request["keyword"])
+        bank_questions = []
+        if request["use_bank"] and structured and not (cached_content or request["force_regenerate"] or tailored):
+            bank_questions, gaps = with_connection(assemble_from_bank, bank_context, selected_topics, portions or None, no_of_qns)
+            shards = [(count, topic) for gap_count, topic in gaps for count, _ in plan_shards(question_type, gap_count)]
+            expected_tokens = max(1, estimate_completion_tokens(question_type, sum(count for count, _ in shards)))
+
+        # Replace questions dropped as repeats or near-duplicates of others in the paper with one more request,
+        # keeping the paper to `count` questions
+        def top_up(questions, count):
+            questions = drop_near_duplicates(questions)[:count]
+            shortfall = count - len(questions)
+            if shortfall <= 0:
+                return questions
+            topup_prompt = add_exclusions(paper_prompt(shortfall, selected_topics_str, "Not specified"), questions)
+            topup_content = "".join(content for content, _ in generate_completion(topup_prompt, stream=False, json_mode=True, client=client,
+                                                                              feature="generation_topup", subject=subject))
+            return drop_near_duplicates(merge_questions([questions, parse_questions(topup_content)]))[:count]
+
+        try:
+            # Start timing API call
+            start_time = time.time()
+
+            result_content = ""
+            if cached_content:
+                result_content = cached_content
+                submit_write(touch_cached_response, cache_key)
+            elif len(shards) > 1 or bank_questions:
+                # Large papers are split into shards that are generated in parallel and merged into one paper,
+                # after any questions taken from the bank
+                shard_prompts = [add_exclusions(paper_prompt(count, topic, "Not specified") if topic else paper_prompt(count, selected_topics_str, portions_str),
+                                                bank_questions)
+                                 for count, topic in shards]
+                shard_contents = [""] * len(shards)
+                tokens_received = 0
+                live_questions = list(bank_questions)
+                on_progress(0, questions=live_questions)
+                for shard_index, new_questions, new_tokens, shard_content in generate_shards(shard_prompts, subject=subject, client=client):
+                    tokens_received += new_tokens
+                    live_questions.extend(new_questions)
+                    if shard_content is not None:
+                        shard_contents[shard_index] = shard_content
+                    on_progress(min(tokens_received / expected_tokens, 0.99), questions=live_questions)
+
+                merged_questions = top_up(merge_questions([bank_questions] + [parse_questions(content) for content in shard_contents]), no_of_qns)
+                result_content = json.dumps({"questions": merged_questions}, ensure_ascii=False)
+            else:
+                # Report the response as it arrives, advancing the progress by tokens received
+                question_parser = QuestionStreamParser()
+                for result_content, tokens_received in generate_completion(prompt, stream=request["stream"], json_mode=structured, client=client, subject=subject):
+                    if structured:
+                        question_parser.update(result_content)
+                        on_progress(min(tokens_received / expected_tokens, 0.99), questions=question_parser.questions)
+                    else:
+                        on_progress(min(tokens_received / expected_tokens, 0.99), text=result_content)
+                if structured:
+                    generated_questions = parse_questions(result_content)
+                    replaced_questions = top_up(generated_questions, len(generated_questions))
+                    if replaced_questions != generated_questions:
+                        result_content = json.dumps({"questions": replaced_questions}, ensure_ascii=False)
+
+            # Record response time
+            response_time = int((time.time() - start_time) * 1000)  # Response time in milliseconds
+
+            result_content = result_content.strip()
+            structured_questions = parse_questions(result_content) if structured else []
+            if not result_content or (structured and not structured_questions):
+                raise ValueError("The response did not contain any questions. Please try again.")
+            paper_content = questions_to_text(structured_questions) if structured else result_content
+            question_hash = paper_hash(paper_content)
+            paper_questions = structured_questions or split_paper(paper_content)
+            # Free-text papers cannot be regenerated question by question, so their near-duplicates are only pointed out
+            near_duplicates = [] if structured else [position + 1 for position in near_duplicate_positions(paper_questions)]
+
+            similar_paper = None
+            if cached_content:
+                # Ratings of a cached paper count towards the variant it was generated with
+                prompt_variant = with_connection(paper_prompt_variant, question_hash)
+            else:
+                # An earlier paper that this one mostly repeats shares its feedback
+                similar_paper = find_similar_paper(paper_questions, question_hash)
+
+                # Written before the generation lock is released, so that sessions waiting on it find the result
+                with_connection(store_cached_response, cache_key, result_content, request_group, signature)
+
+                # Insert generated questions into the generated_questions table
+                execute_later('INSERT INTO generated_questions (subject, difficulty_level, question_content, question_hash, acad_level, language, question_type, topics, prompt_variant, tailored) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                              (subject, request["difficulty"], paper_content, question_hash, request["acad_level"], request["language"], question_type,
+                               selected_topics_str, prompt_variant, tailored))
+                if structured_questions:
+                    submit_write(store_paper_questions, question_hash, structured_questions)
+                if not tailored:
+                    submit_write(add_to_bank, paper_questions, bank_context, question_hash)
+
+                # Insert API usage log into the api_usage_logs table
+                execute_later('INSERT INTO api_usage_logs (api_request, api_response, response_time) VALUES (?, ?, ?)',
+                              (prompt, result_content, response_time))
+        finally:
+            if generation_owner and get_shared_state().get(generation_lock_key(cache_key)) == generation_owner:
+                get_shared_state().delete(generation_lock_key(cache_key))
+
+    return {
+        "content": paper_content,
+        "questions": structured_questions,
+        "question_hash": question_hash,
+        "cached": bool(cached_content),
+        "bank_count": min(len(bank_questions), len(structured_questions)),
+        "similar_paper": similar_paper,
+        "near_duplicates": near_duplicates,
+        "context": {
+            "topics": selected_topics_str,
+            "language_code": LANGUAGE_OPTIONS[request["language"]],
+            "prompt_variant": prompt_variant,
+            "tailored": tailored,
+            **bank_context,
+        },
+    }
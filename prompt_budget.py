@@ -0,0 +1,182 @@
+import argparse
+import logging
+import math
+import os
+import re
+import threading
+from collections import Counter
+
+from retrieval import tokenize
+
+logger = logging.getLogger(__name__)
+
+# Context window of each generation model (in tokens)
+MODEL_CONTEXT_TOKENS = {
+    "gpt-4o": 128000,
+}
+
+# Tokens added by the chat format around each message and to start the reply
+MESSAGE_OVERHEAD_TOKENS = 3
+REPLY_OVERHEAD_TOKENS = 3
+
+# Encoding of the generation models, used when tiktoken is installed
+TIKTOKEN_ENCODING = "o200k_base"
+
+# Where tiktoken keeps its vocabulary. Filled by `python prompt_budget.py` when the environment is built, so that the
+# server never has to download it; TIKTOKEN_CACHE_DIR is read by tiktoken itself.
+TIKTOKEN_CACHE_DIR = os.environ.setdefault('TIKTOKEN_CACHE_DIR', '.tiktoken_cache')
+
+# Lines repeated at least this many times in reference material are page headers and footers; only the first is kept
+BOILERPLATE_MIN_REPEATS = 3
+
+# Longest line that can count as a header or footer (in characters)
+BOILERPLATE_MAX_LENGTH = 100
+
+# Extra weight of query terms when choosing the sentences of a summary
+SUMMARY_QUERY_WEIGHT = 2.0
+
+# Pieces of text that the offline estimate counts separately: Chinese and Japanese characters, LaTeX commands,
+# ASCII words, digits, words in other scripts, line breaks and runs of symbols
+ESTIMATE_PATTERN = re.compile(r'(?P<cjk>[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef])|(?P<latex>\\[A-Za-z]+)|(?P<word>[A-Za-z]+)'
+                              r'|(?P<number>\d+)|(?P<letters>[^\W\d_]+)|(?P<newline>\n+)|(?P<symbols>[^\w\s]+|_+)')
+
+# Sentence ends in Latin and CJK text, and line breaks
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?])\s+|(?<=[。！？])|\n+')
+
+# Runs of spaces and tabs
+SPACES = re.compile(r'[ \t]+')
+
+# The tiktoken encoding once loaded, or False if it cannot be
+_encoding = None
+_encoding_loader = None
+_encoding_lock = threading.Lock()
+
+# Load the tiktoken encoding, or record that it is unavailable if tiktoken is missing or its vocabulary can neither be
+# read from TIKTOKEN_CACHE_DIR nor downloaded
+def load_encoding():
+    global _encoding
+    try:
+        import tiktoken
+    except ImportError:
+        _encoding = False
+        return None
+    try:
+        _encoding = tiktoken.get_encoding(TIKTOKEN_ENCODING)
+    except Exception:
+        logger.warning("The %s encoding could not be loaded; token counts are estimated", TIKTOKEN_ENCODING, exc_info=True)
+        _encoding = False
+    return _encoding or None
+
+# The tiktoken encoding, or None while it is loading or if it cannot be loaded. It is loaded in the background on first
+# use, since a vocabulary missing from TIKTOKEN_CACHE_DIR is downloaded and no session should wait on the network.
+def get_encoding():
+    global _encoding_loader
+    if _encoding is None:
+        with _encoding_lock:
+            if _encoding_loader is None:
+                _encoding_loader = threading.Thread(target=load_encoding, name="tiktoken-load", daemon=True)
+                _encoding_loader.start()
+    return _encoding or None
+
+# Offline token estimate. Each piece is counted the way the model's tokenizer tends to split it: one token per Chinese
+# or Japanese character, a token per seven letters of a word (plus one for the backslash of a LaTeX command), per
+# three digits and per two symbols or letters of other scripts. It errs on the high side, so prompts within an
+# estimated budget fit the real one.
+def estimate_tokens(text):
+    count = 0
+    for match in ESTIMATE_PATTERN.finditer(text):
+        length = len(match.group())
+        kind = match.lastgroup
+        if kind in ('cjk', 'newline'):
+            count += 1
+        elif kind == 'word':
+            count += math.ceil(length / 7)
+        elif kind == 'latex':
+            count += 1 + math.ceil((length - 1) / 7)
+        elif kind == 'number':
+            count += math.ceil(length / 3)
+        else:
+            count += math.ceil(length / 2)
+    return count
+
+# Number of tokens in the text: exact with tiktoken, otherwise the offline estimate
+def count_tokens(text):
+    encoding = get_encoding()
+    if encoding:
+        return len(encoding.encode(text, disallowed_special=()))
+    return estimate_tokens(text)
+
+# Tokens taken by a prompt sent as a single user message
+def count_prompt_tokens(prompt):
+    return count_tokens(prompt) + MESSAGE_OVERHEAD_TOKENS + REPLY_OVERHEAD_TOKENS
+
+# Largest prompt that leaves room for the expected response in the model's context window
+def prompt_token_budget(model, completion_tokens):
+    return MODEL_CONTEXT_TOKENS.get(model, min(MODEL_CONTEXT_TOKENS.values())) - completion_tokens
+
+# Collapse the indentation and repeated spaces of prompt templates, keeping line breaks
+def compact_whitespace(text):
+    return "\n".join(SPACES.sub(" ", line).strip() for line in text.splitlines()).strip()
+
+# Drop repeats of short lines that occur on many pages, such as headers, footers and copyright notices
+def remove_boilerplate(text):
+    lines = text.splitlines()
+    counts = Counter(line.strip() for line in lines if line.strip() and len(line.strip()) <= BOILERPLATE_MAX_LENGTH)
+    seen = set()
+    kept = []
+    for line in lines:
+        key = line.strip()
+        if counts.get(key, 0) >= BOILERPLATE_MIN_REPEATS:
+            if key in seen:
+                continue
+            seen.add(key)
+        kept.append(line)
+    return "\n".join(kept)
+
+# Cut text to at most max_tokens tokens
+def truncate_to_tokens(text, max_tokens):
+    encoding = get_encoding()
+    if encoding:
+        return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+    length = len(text)
+    while length and estimate_tokens(text[:length]) > max_tokens:
+        length = int(length * min(0.9, max_tokens / max(estimate_tokens(text[:length]), 1)))
+    return text[:length]
+
+# Shorten text to max_tokens tokens by keeping its most representative sentences, in their original order.
+# Sentences are scored by how common their terms are in the whole text, with extra weight for the query terms.
+def summarize(text, max_tokens, query=""):
+    if max_tokens <= 0:
+        return ""
+    if count_tokens(text) <= max_tokens:
+        return text
+    sentences = [sentence.strip() for sentence in SENTENCE_BOUNDARY.split(text) if sentence.strip()]
+    frequencies = Counter(term for sentence in sentences for term in tokenize(sentence))
+    query_terms = set(tokenize(query))
+
+    def score(sentence):
+        terms = set(tokenize(sentence))
+        if not terms:
+            return 0.0
+        return (sum(math.log1p(frequencies[term]) for term in terms) / math.sqrt(len(terms))
+                + SUMMARY_QUERY_WEIGHT * len(terms & query_terms))
+
+    selected = []
+    used = 0
+    for index in sorted(range(len(sentences)), key=lambda index: -score(sentences[index])):
+        tokens = count_tokens(sentences[index]) + 1
+        if used + tokens <= max_tokens:
+            selected.append(index)
+            used += tokens
+    if not selected:
+        return truncate_to_tokens(text, max_tokens)
+    return " ".join(sentences[index] for index in sorted(selected))
+
+def main():
+    argparse.ArgumentParser(description=f"Download the {TIKTOKEN_ENCODING} vocabulary into TIKTOKEN_CACHE_DIR ({TIKTOKEN_CACHE_DIR})").parse_args()
+    if load_encoding() is None:
+        raise SystemExit(f"The {TIKTOKEN_ENCODING} vocabulary could not be loaded; token counts will be estimated.")
+    print(f"The {TIKTOKEN_ENCODING} vocabulary is in {TIKTOKEN_CACHE_DIR}.")
+
+if __name__ == "__main__":
+    main()
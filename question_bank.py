@@ -0,0 +1,195 @@
+import argparse
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+
+import streamlit as st
+
+from api_client import get_client
+from curriculum import LANGUAGE_OPTIONS, SUBJECT_TO_TOPICS
+from db import get_pool, query_all, with_connection
+from generation import allocate_portions, build_generation_prompt, build_prompt_type, generate_completion
+from questions import build_structured_prompt, normalize_question, parse_questions, question_key
+from shared_state import get_shared_state
+
+logger = logging.getLogger(__name__)
+
+# Questions from papers rated below this are never reused; unrated papers count as this rating
+BANK_MIN_RATING = 3
+
+# Pre-warming: how many of the most requested subject/level combinations to keep stocked,
+# how many questions to keep for each, how many to request at a time, and how often to run (in seconds)
+PREWARM_COMBINATIONS = 10
+PREWARM_TARGET = 30
+PREWARM_BATCH = 10
+PREWARM_INTERVAL = 6 * 60 * 60
+
+# Numbered items in free-text papers, such as "1.", "**Question 2:**" or "Answer 3:"
+ITEM_PATTERN = re.compile(r'^\s*(?:#+\s*)?(?:\*\*)?\s*(?:(?P<kind>Question|Answer|Q|A)\s*)?(?P<number>\d{1,2})\s*[.):]\s*(?P<rest>.*)$', re.IGNORECASE)
+# Section headings such as "**Questions:**" and "**Answers:**"
+QUESTION_HEADING = re.compile(r'^\s*(?:#+\s*)?(?:\*\*)?\s*Questions?\s*:?\s*(?:\*\*)?\s*:?\s*$', re.IGNORECASE)
+ANSWER_HEADING = re.compile(r'^\s*(?:#+\s*)?(?:\*\*)?\s*(?:Answers?|Answer Key|Solutions?)\s*:?\s*(?:\*\*)?\s*:?\s*$', re.IGNORECASE)
+# An answer given directly under its question, such as "Answer: 12"
+INLINE_ANSWER = re.compile(r'^\s*(?:\*\*)?\s*(?:Answer|Ans)\s*(?:\*\*)?\s*:\s*(?:\*\*)?\s*', re.IGNORECASE)
+SEPARATOR = re.compile(r'^\s*(?:-{3,}|\*{3,}|_{3,})\s*$')
+
+# Split a free-text paper into questions with their answers
+def split_paper(content):
+    items = {"question": {}, "answer": {}}
+    titles = {}
+    section = "question"
+    current = None
+    for line in content.splitlines():
+        if SEPARATOR.match(line) or QUESTION_HEADING.match(line):
+            continue
+        if ANSWER_HEADING.match(line):
+            section = "answer"
+            current = None
+            continue
+        match = ITEM_PATTERN.match(line)
+        if match:
+            kind = (match.group("kind") or "").lower()
+            item_section = "answer" if kind in ("answer", "a") else "question" if kind in ("question", "q") else section
+            number = int(match.group("number"))
+            # Numbered steps inside an item are only treated as a new item when they continue the numbering
+            if kind or number == len(items[item_section]) + 1:
+                rest = match.group("rest").strip().strip('*').strip()
+                if kind and line.strip().startswith('**') and line.strip().endswith('**'):
+                    # "**Question 1: Fractions**" is a heading; the question follows on the next lines
+                    if item_section == "question" and rest:
+                        titles[number] = rest
+                    rest = ""
+                current = (item_section, number)
+                items[item_section][number] = [rest] if rest else []
+                continue
+        inline = INLINE_ANSWER.match(line)
+        if inline and current and current[0] == "question":
+            current = ("answer", current[1])
+            items["answer"][current[1]] = [line[inline.end():].strip()]
+            continue
+        if current and line.strip():
+            items[current[0]][current[1]].append(line.strip())
+
+    return [normalize_question({
+        "question": "\n".join(items["question"][number]),
+        "answer": "\n".join(items["answer"].get(number, [])),
+        "topic": titles.get(number, ""),
+    }) for number in sorted(items["question"]) if items["question"][number]]
+
+# Add questions to the bank under the request details they were generated for
+def add_to_bank(conn, questions, context, source_hash=None):
+    conn.executemany('''
+                     INSERT OR IGNORE INTO question_bank
+                         (question_key, question, answer, subject, topic, acad_level, difficulty, language, question_type, source_hash)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                     ''',
+                     [(question_key(question), question["question"], question["answer"], context.get("subject"), question["topic"] or None,
+                       context.get("acad_level"), context.get("difficulty") or question["difficulty"] or None, context.get("language"),
+                       context.get("question_type"), source_hash)
+                      for question in questions if question_key(question)])
+
+# Pick up to `count` stored questions matching the request, best rated first
+def find_bank_questions(conn, context, topics, count, exclude_keys=()):
+    topic_filter = f"AND b.topic IN ({', '.join('?' * len(topics))})" if topics else ""
+    rows = conn.execute(f'''
+                        SELECT b.question_key, b.question, b.answer, b.topic, b.difficulty
+                        FROM question_bank b LEFT JOIN feedback f ON f.question_hash = b.source_hash
+                        WHERE b.subject = ? AND b.acad_level = ? AND b.difficulty = ? AND b.language = ? AND b.question_type = ?
+                          {topic_filter} AND COALESCE(f.rating, ?) >= ?
+                        ORDER BY COALESCE(f.rating, ?) DESC, RANDOM()
+                        LIMIT ?
+                        ''', (context["subject"], context["acad_level"], context["difficulty"], context["language"], context["question_type"],
+                              *topics, BANK_MIN_RATING, BANK_MIN_RATING, BANK_MIN_RATING, count + len(exclude_keys))).fetchall()
+    return [normalize_question({"question": question, "answer": answer, "topic": topic, "difficulty": difficulty})
+            for key, question, answer, topic, difficulty in rows if key not in exclude_keys][:count]
+
+# Assemble as much of a paper as possible from the bank. Returns the questions found and the remaining
+# gaps as (count, topic) pairs still to be generated, where the topic is None for all selected topics.
+def assemble_from_bank(conn, context, topics, portions, count):
+    targets = [(topic, topic_count) for topic, topic_count in allocate_portions(count, portions).items() if topic_count] if portions else [(None, count)]
+    questions = []
+    gaps = []
+    for topic, target_count in targets:
+        found = find_bank_questions(conn, context, [topic] if topic else list(topics), target_count, {question_key(question) for question in questions})
+        questions.extend(found)
+        if len(found) < target_count:
+            gaps.append((target_count - len(found), topic))
+    return questions, gaps
+
+# Split every stored paper into the bank, except those written around a keyword or reference material. The questions
+# in questions.db are left out: they were stored without a subject or level, so no request could ever be matched to them.
+def backfill_bank(conn):
+    rows = conn.execute('SELECT subject, difficulty_level, question_content, acad_level, language, question_type FROM generated_questions WHERE NOT tailored').fetchall()
+    for subject, difficulty, content, acad_level, language, question_type in rows:
+        context = {"subject": subject, "difficulty": difficulty, "acad_level": acad_level, "language": language, "question_type": question_type}
+        questions = parse_questions(content) if content.lstrip().startswith('{') else split_paper(content)
+        add_to_bank(conn, questions, context, hashlib.sha256(content.encode()).hexdigest())
+    return len(rows)
+
+# Most requested subject/level combinations whose bank stock is below target
+def popular_combinations(limit=PREWARM_COMBINATIONS, target=PREWARM_TARGET):
+    return query_all('''
+                     SELECT g.subject, g.acad_level, g.difficulty_level, g.language, g.question_type
+                     FROM generated_questions g
+                     WHERE g.acad_level IS NOT NULL AND g.language IS NOT NULL AND g.question_type IS NOT NULL
+                     GROUP BY g.subject, g.acad_level, g.difficulty_level, g.language, g.question_type
+                     HAVING (SELECT COUNT(*) FROM question_bank b
+                             WHERE b.subject = g.subject AND b.acad_level = g.acad_level AND b.difficulty = g.difficulty_level
+                               AND b.language = g.language AND b.question_type = g.question_type) < ?
+                     ORDER BY COUNT(*) DESC
+                     LIMIT ?
+                     ''', (target, limit))
+
+# Generate questions for the most requested combinations until each is stocked
+def prewarm_bank(client, limit=PREWARM_COMBINATIONS, batch=PREWARM_BATCH):
+    added = 0
+    for subject, acad_level, difficulty, language, question_type in popular_combinations(limit):
+        context = {"subject": subject, "acad_level": acad_level, "difficulty": difficulty, "language": language, "question_type": question_type}
+        prompt = build_structured_prompt(build_generation_prompt("", "Any", build_prompt_type(question_type, subject, batch), acad_level, difficulty,
+                                                                 LANGUAGE_OPTIONS.get(language, "en"), "", "Not specified",
+                                                                 SUBJECT_TO_TOPICS.get(subject, []), structured=True))
+        content = "".join(content for content, _ in generate_completion(prompt, stream=False, json_mode=True, client=client,
+                                                                     feature="question_bank_prewarm", subject=subject))
+        questions = parse_questions(content)
+        with_connection(add_to_bank, questions, context)
+        added += len(questions)
+    return added
+
+# Keep the bank stocked in the background. Runs only when the server has its own API key, since
+# the keys teachers enter belong to their sessions. With several replicas, one of them pre-warms in each interval.
+@st.cache_resource
+def start_prewarm_worker():
+    api_key = os.environ.get('OPENAI_API_KEY')
+    if not api_key:
+        return None
+
+    def run():
+        client = get_client(api_key, "question-bank-prewarm")
+        while True:
+            try:
+                # The claim expires a little before the next round so that it is free again by then
+                if get_shared_state().add("question_bank_prewarm", True, PREWARM_INTERVAL - 60):
+                    prewarm_bank(client)
+            except Exception:
+                logger.exception("Question bank pre-warm failed")
+            time.sleep(PREWARM_INTERVAL)
+
+    thread = threading.Thread(target=run, name="question-bank-prewarm", daemon=True)
+    thread.start()
+    return thread
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the question bank")
+    parser.add_argument('command', choices=['backfill', 'prewarm'], help="backfill: split stored papers into the bank; prewarm: stock popular combinations (uses OPENAI_API_KEY)")
+    args = parser.parse_args()
+    get_pool()
+    if args.command == 'backfill':
+        print(f"Split {with_connection(backfill_bank)} stored papers into the question bank.")
+    else:
+        print(f"Added {prewarm_bank(get_client(session_id='question-bank-prewarm'))} questions to the question bank.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import json
+import re
+
+# Fields carried by every structured question
+QUESTION_FIELDS = ["question", "answer", "topic", "marks", "difficulty"]
+
+# Instructions appended to the generation prompt in structured mode
+STRUCTURED_OUTPUT_INSTRUCTIONS = "Return the result as a JSON object of the form \
+    {\"questions\": [{\"question\": \"...\", \"answer\": \"...\", \"topic\": \"...\", \"marks\": 1, \"difficulty\": \"...\"}]} \
+    with one entry per question, in order. Put the full question text in \"question\" and its worked answer in \"answer\". \
+    Use LaTeX inside the strings for mathematical expressions, escaping backslashes as JSON requires."
+
+# Add the structured output instructions to a generation prompt
+def build_structured_prompt(prompt):
+    return f"{prompt} {STRUCTURED_OUTPUT_INSTRUCTIONS}"
+
+# Build a prompt asking for a single replacement question in the same style as the rest of the paper
+def build_replacement_prompt(context, questions, index):
+    current = questions[index]
+    others = "\n".join(f"- {question['question']}" for number, question in enumerate(questions) if number != index)
+    return f"You are a primary school teacher in Singapore. Write one new {context['subject']} question with its answer for the academic level of \
+        {context['acad_level']} according to the Singapore education system, in {context['language_code']}, on the topic \
+        {current['topic'] or context['topics']}, of {current['difficulty'] or context['difficulty']} difficulty, worth {current['marks'] or 1} marks. \
+        It replaces this question: {current['question']} \
+        It must be different from the replaced question and from these other questions in the paper:\n{others}\n \
+        Use LaTeX for rendering fractions and algebraic expressions. Return only a single JSON object of the form \
+        {{\"question\": \"...\", \"answer\": \"...\", \"topic\": \"...\", \"marks\": 1, \"difficulty\": \"...\"}}."
+
+# Ask the model not to repeat questions that are already in the paper
+def add_exclusions(prompt, questions):
+    if not questions:
+        return prompt
+    existing = "\n".join(f"- {question['question']}" for question in questions)
+    return f"{prompt} Do not repeat any of these existing questions:\n{existing}"
+
+# Coerce a parsed question into the expected fields
+def normalize_question(item):
+    question = {field: item.get(field, "") if isinstance(item, dict) else "" for field in QUESTION_FIELDS}
+    for field in ("question", "answer", "topic", "difficulty"):
+        question[field] = str(question[field] or "").strip()
+    try:
+        question["marks"] = int(question["marks"])
+    except (TypeError, ValueError):
+        question["marks"] = None
+    return question
+
+# Picks complete question objects out of a JSON response while it is still streaming
+class QuestionStreamParser:
+    def __init__(self):
+        self.questions = []
+        self._position = 0
+        self._depth = 0
+        self._question_depth = None
+        self._in_string = False
+        self._escaped = False
+        self._start = None
+
+    # Scan the newly received part of the accumulated response and return any questions it completed
+    def update(self, content):
+        new_questions = []
+        for position in range(self._position, len(content)):
+            char = content[position]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+            if char == '"':
+                self._in_string = True
+            elif char in '{[':
+                # Questions sit inside the outer object's array, or directly inside a bare array
+                if self._question_depth is None:
+                    self._question_depth = 2 if char == '{' else 1
+                if char == '{' and self._depth == self._question_depth:
+                    self._start = position
+                self._depth += 1
+            elif char in '}]':
+                self._depth -= 1
+                if char == '}' and self._depth == self._question_depth and self._start is not None:
+                    try:
+                        new_questions.append(normalize_question(json.loads(content[self._start:position + 1])))
+                    except ValueError:
+                        pass
+                    self._start = None
+        self._position = len(content)
+        self.questions.extend(new_questions)
+        return new_questions
+
+# Parse a complete structured response into a list of questions
+def parse_questions(content):
+    try:
+        data = json.loads(content)
+    except ValueError:
+        # Fall back to whatever complete questions can be recovered from a truncated response
+        parser = QuestionStreamParser()
+        parser.update(content)
+        return parser.questions
+    if isinstance(data, dict):
+        data = data.get("questions", [data] if "question" in data else [])
+    return [normalize_question(item) for item in data if isinstance(item, dict)]
+
+# Parse a single replacement question
+def parse_question(content):
+    questions = parse_questions(content)
+    if not questions or not questions[0]["question"]:
+        raise ValueError("The model did not return a question.")
+    return questions[0]
+
+# Normalized question text used to spot the same question generated twice
+def question_key(question):
+    return " ".join(re.sub(r'[^\w\\]+', ' ', question["question"].casefold()).split())
+
+# Merge questions from several shards in order, dropping repeats
+def merge_questions(question_lists):
+    merged = []
+    seen = set()
+    for questions in question_lists:
+        for question in questions:
+            key = question_key(question)
+            if key and key not in seen:
+                seen.add(key)
+                merged.append(question)
+    return merged
+
+# Plain-text version of a structured paper, used for hashing, history and feedback
+def questions_to_text(questions):
+    return "\n\n".join(f"{number}. {question['question']}\nAnswer: {question['answer']}" for number, question in enumerate(questions, start=1))
+
+# Store each question of a paper as its own row
+def store_paper_questions(conn, question_hash, questions):
+    conn.executemany('INSERT INTO paper_questions (question_hash, position, question, answer, topic, marks, difficulty) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     [(question_hash, position, question["question"], question["answer"], question["topic"], question["marks"], question["difficulty"])
+                      for position, question in enumerate(questions, start=1)])
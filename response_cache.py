@@ -0,0 +1,78 @@
+import hashlib
+import json
+import time
+
+# How long a cached generation stays valid (in seconds)
+RESPONSE_CACHE_TTL = 7 * 24 * 60 * 60
+
+# Maximum number of cached generations kept; least recently used entries are evicted first
+RESPONSE_CACHE_MAX_ENTRIES = 1000
+
+# Estimated similarity of keywords and reference material from which an earlier request's generation is reused
+NEAR_IDENTICAL_REQUEST_THRESHOLD = 0.9
+
+# Digest of the reference material so that identical uploads map to the same key
+def reference_digest(file_text):
+    return hashlib.sha256(file_text.encode()).hexdigest() if file_text else ""
+
+# Normalize a single input value so that trivial differences (case, spacing, ordering) share a key
+def normalize_input(value):
+    if isinstance(value, str):
+        return " ".join(value.split()).casefold()
+    if isinstance(value, dict):
+        return {normalize_input(k): normalize_input(v) for k, v in sorted(value.items())}
+    if isinstance(value, (list, tuple, set)):
+        return sorted(normalize_input(v) for v in value)
+    return value
+
+# Build a content-addressed cache key from the generation inputs and the reference digest
+def make_cache_key(inputs, file_digest):
+    payload = json.dumps({"inputs": normalize_input(inputs), "reference": file_digest}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+# Key shared by requests that make the same choices, whatever their keywords and reference material, so that
+# near-identical requests can be found by comparing the signatures of those
+def make_request_group(inputs):
+    return make_cache_key({name: value for name, value in inputs.items() if name != "keyword"}, "")
+
+# Look up a cached generation, returning None if it is missing or has expired
+def get_cached_response(conn, cache_key, ttl=RESPONSE_CACHE_TTL):
+    row = conn.execute('SELECT content FROM response_cache WHERE cache_key = ? AND created_at >= ?',
+                       (cache_key, time.time() - ttl)).fetchone()
+    return row[0] if row else None
+
+# Look up the cached generation of the most similar earlier request in a group, returning (cache key, content), or None
+# if no request is similar enough. `signature` is similarity.request_signature of the request's keywords and reference material.
+def get_similar_cached_response(conn, request_group, signature, ttl=RESPONSE_CACHE_TTL):
+    import numpy as np
+
+    rows = conn.execute('SELECT cache_key, request_signature FROM response_cache WHERE request_group = ? AND created_at >= ?',
+                        (request_group, time.time() - ttl)).fetchall()
+    if not rows:
+        return None
+    signatures = np.frombuffer(b"".join(row[1] for row in rows), np.uint32).reshape(len(rows), -1)
+    similarity = (signatures == signature).mean(axis=1)
+    best = int(similarity.argmax())
+    if similarity[best] < NEAR_IDENTICAL_REQUEST_THRESHOLD:
+        return None
+    return rows[best][0], get_cached_response(conn, rows[best][0], ttl)
+
+# Record a cache hit so that frequently used entries survive eviction
+def touch_cached_response(conn, cache_key):
+    conn.execute('UPDATE response_cache SET last_accessed = ?, hits = hits + 1 WHERE cache_key = ?', (time.time(), cache_key))
+
+# Store a generation in the cache, with its request group and signature if it can be reused for near-identical
+# requests, and evict expired and least recently used entries
+def store_cached_response(conn, cache_key, content, request_group=None, request_signature=None, ttl=RESPONSE_CACHE_TTL,
+                          max_entries=RESPONSE_CACHE_MAX_ENTRIES):
+    now = time.time()
+    conn.execute('''
+                 INSERT OR REPLACE INTO response_cache (cache_key, content, created_at, last_accessed, hits, request_group, request_signature)
+                 VALUES (?, ?, ?, ?, 0, ?, ?)
+                 ''', (cache_key, content, now, now, request_group, None if request_signature is None else request_signature.tobytes()))
+    conn.execute('DELETE FROM response_cache WHERE created_at < ?', (now - ttl,))
+    conn.execute('''
+                 DELETE FROM response_cache WHERE cache_key IN (
+                     SELECT cache_key FROM response_cache ORDER BY last_accessed DESC LIMIT -1 OFFSET ?
+                 )
+                 ''', (max_entries,))
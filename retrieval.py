@@ -0,0 +1,116 @@
+import re
+
+# Size of each reference chunk and the overlap between neighbouring chunks (in words)
+CHUNK_WORDS = 200
+CHUNK_OVERLAP = 40
+
+# Default number of reference tokens included in the generation prompt
+CONTEXT_TOKEN_BUDGET = 3000
+
+# Passages are selected up to this multiple of the reference budget and then summarized down to the budget, so that
+# the prompt gets the most relevant sentences of more passages than would fit whole
+CANDIDATE_TOKEN_RATIO = 1.5
+
+# BM25 ranking parameters
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Chinese and Japanese characters are indexed one by one; everything else by word
+TERM_PATTERN = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff]|[^\W_]+')
+
+# Split text into index terms
+def tokenize(text):
+    return TERM_PATTERN.findall(text.lower())
+
+# Split text into overlapping chunks of roughly CHUNK_WORDS words. Returns the words, the string that joins them and
+# the (start, end) word offsets of each chunk.
+def chunk_spans(text, chunk_words=CHUNK_WORDS, overlap=CHUNK_OVERLAP):
+    # Text without spaces between words (Chinese, Japanese) is chunked by character instead
+    words = text.split()
+    if words and len(words) * 20 < len(text):
+        words = list(text.replace('\n', ' '))
+        chunk_words, overlap = chunk_words * 2, overlap * 2
+        joiner = ''
+    else:
+        joiner = ' '
+    step = max(1, chunk_words - overlap)
+    return words, joiner, [(start, min(start + chunk_words, len(words))) for start in range(0, max(len(words) - overlap, 1), step)]
+
+def chunk_text(text, chunk_words=CHUNK_WORDS, overlap=CHUNK_OVERLAP):
+    words, joiner, spans = chunk_spans(text, chunk_words, overlap)
+    return [joiner.join(words[start:end]) for start, end in spans]
+
+# BM25 index over the chunks of a reference document. numpy is imported when an index is first used rather than at startup.
+class ReferenceIndex:
+    def __init__(self, text, count_tokens):
+        import numpy as np
+
+        self.text = text
+        self.text_tokens = count_tokens(text)
+        self.words, self.joiner, self.spans = chunk_spans(text) if text.strip() else ([], ' ', [])
+        self.chunks = [self.joiner.join(self.words[start:end]) for start, end in self.spans]
+        self.chunk_tokens = np.array([count_tokens(chunk) for chunk in self.chunks], dtype=float)
+
+        # Postings: term -> (chunk ids, term frequencies)
+        postings = {}
+        lengths = []
+        for chunk_id, chunk in enumerate(self.chunks):
+            terms = tokenize(chunk)
+            lengths.append(len(terms))
+            counts = {}
+            for term in terms:
+                counts[term] = counts.get(term, 0) + 1
+            for term, count in counts.items():
+                postings.setdefault(term, ([], []))
+                postings[term][0].append(chunk_id)
+                postings[term][1].append(count)
+
+        self.lengths = np.array(lengths, dtype=float)
+        average_length = self.lengths.mean() if len(lengths) else 1.0
+        self.length_norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths / max(average_length, 1.0))
+        self.postings = {term: (np.array(ids), np.array(tfs, dtype=float)) for term, (ids, tfs) in postings.items()}
+
+    # Score every chunk against the query terms
+    def score(self, query):
+        import numpy as np
+
+        scores = np.zeros(len(self.chunks))
+        total = len(self.chunks)
+        for term in set(tokenize(query)):
+            if term not in self.postings:
+                continue
+            ids, tfs = self.postings[term]
+            idf = np.log(1 + (total - len(ids) + 0.5) / (len(ids) + 0.5))
+            scores[ids] += idf * tfs * (BM25_K1 + 1) / (tfs + self.length_norm[ids])
+        return scores
+
+    # Pick the highest-scoring chunks that fit within the token budget, returned in document order. Neighbouring chunks
+    # overlap, so a chunk next to one already picked only costs the tokens of the words it adds, and picked chunks
+    # are merged into runs of the document by word offsets so that the overlap is not repeated.
+    def select(self, query, token_budget=CONTEXT_TOKEN_BUDGET):
+        if not self.chunks:
+            return ""
+        if self.text_tokens <= token_budget:
+            return self.text
+        import numpy as np
+
+        scores = self.score(query)
+        # Stable sort keeps earlier chunks first among equal scores, so an unmatched query falls back to the opening text
+        order = np.argsort(-scores, kind='stable')
+        covered = np.zeros(len(self.words), dtype=bool)
+        used = 0
+        for chunk_id in order:
+            start, end = self.spans[chunk_id]
+            new_words = end - start - int(covered[start:end].sum())
+            cost = self.chunk_tokens[chunk_id] * new_words / max(end - start, 1)
+            if used + cost > token_budget:
+                continue
+            covered[start:end] = True
+            used += cost
+        # Runs of consecutive covered words, in document order
+        edges = np.flatnonzero(np.diff(np.concatenate([[0], covered.astype(np.int8), [0]])))
+        return "\n...\n".join(self.joiner.join(self.words[start:end]) for start, end in zip(edges[::2], edges[1::2]))
+
+# Build the retrieval query from the user's selections
+def build_query(subject, topics, keyword):
+    return " ".join([subject, *topics, keyword or ""])
@@ -0,0 +1,152 @@
+import json
+import os
+import threading
+import time
+
+import streamlit as st
+
+from db import get_pool
+
+# Backend for state shared by every replica of the app, chosen by SHARED_STATE_URL:
+#   sqlite://            the application database; put FEEDBACK_DB_PATH on a volume shared by the replicas (the default)
+#   redis://host:6379/0  a Redis-compatible server; needs the redis package
+#   memory://            this process only; a stand-in for development and tests
+SHARED_STATE_URL = os.environ.get('SHARED_STATE_URL', 'sqlite://')
+
+# How often the SQLite store deletes expired keys (in seconds)
+SQLITE_PURGE_INTERVAL = 10 * 60
+
+# Every store holds JSON-serializable values under string keys, optionally expiring after `ttl` seconds, and offers:
+#   get(key)                  the value, or None if it is missing or has expired
+#   set(key, value, ttl)      store a value
+#   add(key, value, ttl)      store a value only if the key is not set; returns whether it was stored (for locks and cooldowns)
+#   incr(key, amount, ttl)    add to a counter and return its new value; the ttl applies from the counter's first increment
+#   delete(key)
+
+# Keys in a table of the application database. Writes take SQLite's write lock, so add() and incr() are atomic
+# across processes sharing the database file.
+class SQLiteStore:
+    def __init__(self, pool):
+        self._pool = pool
+        self._last_purge = 0
+
+    def get(self, key):
+        with self._pool.connection() as conn:
+            row = conn.execute('SELECT value FROM shared_state WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)', (key, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl=None):
+        with self._pool.connection() as conn:
+            conn.execute('INSERT OR REPLACE INTO shared_state (key, value, expires_at) VALUES (?, ?, ?)', (key, json.dumps(value), self._expiry(ttl)))
+            self._purge(conn)
+
+    def add(self, key, value, ttl=None):
+        with self._pool.connection() as conn:
+            conn.execute('DELETE FROM shared_state WHERE key = ? AND expires_at <= ?', (key, time.time()))
+            added = conn.execute('INSERT OR IGNORE INTO shared_state (key, value, expires_at) VALUES (?, ?, ?)',
+                                 (key, json.dumps(value), self._expiry(ttl))).rowcount > 0
+            self._purge(conn)
+        return added
+
+    def incr(self, key, amount=1, ttl=None):
+        now = time.time()
+        with self._pool.connection() as conn:
+            row = conn.execute('''
+                               INSERT INTO shared_state (key, value, expires_at) VALUES (?, ?, ?)
+                               ON CONFLICT (key) DO UPDATE SET
+                                   value = CASE WHEN expires_at <= ? THEN excluded.value ELSE CAST(value AS INTEGER) + ? END,
+                                   expires_at = CASE WHEN expires_at <= ? THEN excluded.expires_at ELSE expires_at END
+                               RETURNING value
+                               ''', (key, str(amount), self._expiry(ttl), now, amount, now)).fetchone()
+        return int(row[0])
+
+    def delete(self, key):
+        with self._pool.connection() as conn:
+            conn.execute('DELETE FROM shared_state WHERE key = ?', (key,))
+
+    def _expiry(self, ttl):
+        return time.time() + ttl if ttl else None
+
+    def _purge(self, conn):
+        if time.monotonic() - self._last_purge > SQLITE_PURGE_INTERVAL:
+            self._last_purge = time.monotonic()
+            conn.execute('DELETE FROM shared_state WHERE expires_at <= ?', (time.time(),))
+
+# Keys on a Redis-compatible server, for replicas that do not share a volume
+class RedisStore:
+    def __init__(self, url):
+        import redis
+
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self._client.get(key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        self._client.set(key, json.dumps(value), px=self._milliseconds(ttl))
+
+    def add(self, key, value, ttl=None):
+        return bool(self._client.set(key, json.dumps(value), nx=True, px=self._milliseconds(ttl)))
+
+    def incr(self, key, amount=1, ttl=None):
+        pipeline = self._client.pipeline()
+        pipeline.set(key, 0, nx=True, px=self._milliseconds(ttl))
+        pipeline.incrby(key, amount)
+        return pipeline.execute()[1]
+
+    def delete(self, key):
+        self._client.delete(key)
+
+    def _milliseconds(self, ttl):
+        return int(ttl * 1000) if ttl else None
+
+# Keys in this process's memory
+class MemoryStore:
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key)
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._values[key] = (value, time.time() + ttl if ttl else None)
+
+    def add(self, key, value, ttl=None):
+        with self._lock:
+            if self._get(key) is not None:
+                return False
+            self._values[key] = (value, time.time() + ttl if ttl else None)
+            return True
+
+    def incr(self, key, amount=1, ttl=None):
+        with self._lock:
+            value = self._get(key)
+            expires_at = self._values[key][1] if value is not None else (time.time() + ttl if ttl else None)
+            self._values[key] = ((value or 0) + amount, expires_at)
+            return self._values[key][0]
+
+    def delete(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+
+    def _get(self, key):
+        value, expires_at = self._values.get(key, (None, None))
+        if expires_at is not None and expires_at <= time.time():
+            del self._values[key]
+            return None
+        return value
+
+# Process-wide shared state store
+@st.cache_resource
+def get_shared_state():
+    if SHARED_STATE_URL.startswith(('redis://', 'rediss://')):
+        return RedisStore(SHARED_STATE_URL)
+    if SHARED_STATE_URL.startswith('memory://'):
+        return MemoryStore()
+    if SHARED_STATE_URL.startswith('sqlite://'):
+        return SQLiteStore(get_pool())
+    raise ValueError(f"Unsupported SHARED_STATE_URL: {SHARED_STATE_URL}")
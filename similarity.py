@@ -0,0 +1,265 @@
+import argparse
+import hashlib
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+
+import streamlit as st
+
+from db import get_pool, query_all, with_connection
+from question_bank import split_paper
+from questions import question_key
+
+# Questions are compared as sets of overlapping pieces of this many characters of their normalized text
+SHINGLE_SIZE = 4
+
+# Length of a MinHash signature, and the number of LSH bands it is cut into. Two questions become candidates when all
+# values of any one band agree, which is almost certain from a similarity of 0.7 upwards and rare below 0.3.
+NUM_PERM = 36
+LSH_BANDS = 12
+
+# Estimated Jaccard similarity from which two questions count as near-duplicates. Rewordings such as "how many did it
+# sell" and "how many were sold" score above it; questions asking for something else, such as the perimeter instead
+# of the area of the same rectangle, score below it.
+NEAR_DUPLICATE_THRESHOLD = 0.7
+
+# Share of a paper's questions that must be near-duplicates of questions in one earlier paper for it to count as a repeat of that paper
+NEAR_DUPLICATE_PAPER_SHARE = 0.8
+
+# How often the index picks up papers stored by this or another replica (in seconds)
+INDEX_REFRESH_INTERVAL = 5.0
+
+# Questions added since the band keys were last sorted are scanned linearly; at this many they are merged into the sorted keys
+INDEX_MERGE_SIZE = 4096
+
+# Stored papers signed at a time while the index catches up with generated_questions
+SIGN_BATCH_SIZE = 500
+
+# Shingles hashed at a time, which bounds the memory used for long reference material
+MINHASH_CHUNK = 16384
+
+# Modulus of the MinHash permutations (the Mersenne prime 2^31 - 1) and the seed of their coefficients. The coefficients
+# are derived with SHA-256 rather than numpy's random generators, whose output may change between releases, since
+# signatures are stored.
+MINHASH_PRIME = (1 << 31) - 1
+MINHASH_SEED = "ict499-minhash"
+
+NUMBER = re.compile(r'\d+')
+
+_permutations = None
+
+# Coefficients (a, b) of the NUM_PERM hash functions (a * x + b) mod MINHASH_PRIME
+def permutations():
+    global _permutations
+    if _permutations is None:
+        import numpy as np
+
+        def coefficient(index, name, low):
+            digest = hashlib.sha256(f"{MINHASH_SEED}:{index}:{name}".encode()).digest()
+            return low + int.from_bytes(digest[:8], 'big') % (MINHASH_PRIME - low)
+
+        _permutations = (np.array([coefficient(index, "a", 1) for index in range(NUM_PERM)], np.uint64),
+                         np.array([coefficient(index, "b", 0) for index in range(NUM_PERM)], np.uint64))
+    return _permutations
+
+# MinHash signature of a text's character shingles. With exact_numbers, the numbers in the text are mixed into every
+# shingle, so texts with different numbers share no shingles: "3/4 of 12" and "3/4 of 16" are different questions
+# however alike their wording. numpy is only imported once signatures are needed.
+def minhash(text, exact_numbers=False):
+    import numpy as np
+
+    a, b = permutations()
+    signature = np.full(NUM_PERM, MINHASH_PRIME, np.uint64)
+    numbers = 0
+    if exact_numbers:
+        numbers = zlib.crc32(" ".join(NUMBER.findall(text)).encode())
+        text = NUMBER.sub("0", text)
+    codes = np.frombuffer(text.encode('utf-32-le'), np.uint32).astype(np.uint64)
+    if not len(codes):
+        return signature.astype(np.uint32)
+    if len(codes) < SHINGLE_SIZE:
+        codes = np.concatenate([codes, np.zeros(SHINGLE_SIZE - len(codes), np.uint64)])
+    count = len(codes) - SHINGLE_SIZE + 1
+    shingles = np.zeros(count, np.uint64)
+    for offset in range(SHINGLE_SIZE):
+        shingles = shingles * np.uint64(1000003) + codes[offset:offset + count]
+    shingles = np.unique((shingles * np.uint64(1000003) + np.uint64(numbers)) % np.uint64(MINHASH_PRIME))
+    for start in range(0, len(shingles), MINHASH_CHUNK):
+        chunk = shingles[start:start + MINHASH_CHUNK]
+        signature = np.minimum(signature, ((a[:, None] * chunk + b[:, None]) % np.uint64(MINHASH_PRIME)).min(axis=1))
+    return signature.astype(np.uint32)
+
+# Signatures of a list of questions as an array with one row per question
+def sign_questions(questions):
+    import numpy as np
+
+    return np.array([minhash(question_key(question), exact_numbers=True) for question in questions], np.uint32).reshape(len(questions), NUM_PERM)
+
+# Estimated Jaccard similarity of each row of `signatures` to `signature`
+def similarities(signatures, signature):
+    return (signatures == signature).mean(axis=1)
+
+# LSH key of every band of each signature. The band number is part of the key so that all bands share one sorted array.
+def band_keys(signatures):
+    import numpy as np
+
+    rows = NUM_PERM // LSH_BANDS
+    bands = signatures.astype(np.uint64).reshape(len(signatures), LSH_BANDS, rows)
+    keys = np.zeros((len(signatures), LSH_BANDS), np.uint64)
+    for row in range(rows):
+        keys = keys * np.uint64(0x100000001B3) + bands[:, :, row]
+    return keys * np.uint64(LSH_BANDS) + np.arange(LSH_BANDS, dtype=np.uint64)
+
+# Positions of the questions that are near-duplicates of an earlier question in the list
+def near_duplicate_positions(questions):
+    signatures = sign_questions(questions)
+    kept = []
+    duplicates = []
+    for position, signature in enumerate(signatures):
+        if kept and similarities(signatures[kept], signature).max() >= NEAR_DUPLICATE_THRESHOLD:
+            duplicates.append(position)
+        else:
+            kept.append(position)
+    return duplicates
+
+# The questions without those that nearly repeat an earlier one
+def drop_near_duplicates(questions):
+    duplicates = set(near_duplicate_positions(questions)) if questions else set()
+    return [question for position, question in enumerate(questions) if position not in duplicates]
+
+# Signature of the free text of a generation request, used to find near-identical requests in the response cache
+def request_signature(keyword, reference_text):
+    return minhash(" ".join(f"{keyword}\n{reference_text}".casefold().split()))
+
+# Sign the stored papers that have no signatures yet, oldest first, and return how many were signed.
+# Papers get ids in commit order, so everything up to the highest signed id has been signed.
+def sign_new_papers(conn, limit=SIGN_BATCH_SIZE):
+    rows = conn.execute('''
+                        SELECT id, question_hash, question_content FROM generated_questions
+                        WHERE id > (SELECT COALESCE(MAX(paper_id), 0) FROM paper_signatures)
+                        ORDER BY id LIMIT ?
+                        ''', (limit,)).fetchall()
+    conn.executemany('INSERT OR IGNORE INTO paper_signatures (paper_id, paper_hash, signatures) VALUES (?, ?, ?)',
+                     [(paper_id, paper_hash or hashlib.sha256(content.encode()).hexdigest(), sign_questions(split_paper(content)).tobytes())
+                      for paper_id, paper_hash, content in rows])
+    return len(rows)
+
+# An in-memory LSH index over the questions of every stored paper. Each question's band keys are kept in one sorted
+# array, so a lookup is a binary search per band plus a scan of the few questions added since the last sort, and
+# candidates are confirmed by comparing signatures. Signatures are stored in paper_signatures, so the index is rebuilt
+# from the database at startup without re-hashing any text.
+class SimilarityIndex:
+    def __init__(self, capacity=1024):
+        import numpy as np
+
+        self._signatures = np.empty((capacity, NUM_PERM), np.uint32)
+        self._band_keys = np.empty((capacity, LSH_BANDS), np.uint64)
+        self._papers = np.empty(capacity, np.int64)
+        self._count = 0
+        self._sorted_keys = np.empty(0, np.uint64)
+        self._sorted_rows = np.empty(0, np.int64)
+        self._merged = 0
+        self._paper_hashes = []
+        self._last_paper_id = 0
+        self._last_refresh = 0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    # Index the question signatures of a paper
+    def add(self, paper_hash, signatures):
+        import numpy as np
+
+        with self._lock:
+            end = self._count + len(signatures)
+            if end > len(self._signatures):
+                capacity = max(end, 2 * len(self._signatures))
+                self._signatures = np.resize(self._signatures, (capacity, NUM_PERM))
+                self._band_keys = np.resize(self._band_keys, (capacity, LSH_BANDS))
+                self._papers = np.resize(self._papers, capacity)
+            self._signatures[self._count:end] = signatures
+            self._band_keys[self._count:end] = band_keys(signatures)
+            self._papers[self._count:end] = len(self._paper_hashes)
+            self._paper_hashes.append(paper_hash)
+            self._count = end
+
+    # Hashes of the papers containing a near-duplicate of the question with this signature
+    def query(self, signature):
+        import numpy as np
+
+        keys = band_keys(signature[None, :])[0]
+        with self._lock:
+            if self._count - self._merged >= INDEX_MERGE_SIZE:
+                self._merge()
+            left = np.searchsorted(self._sorted_keys, keys, 'left')
+            right = np.searchsorted(self._sorted_keys, keys, 'right')
+            candidates = [self._sorted_rows[start:end] for start, end in zip(left, right) if end > start]
+            recent = np.nonzero((self._band_keys[self._merged:self._count] == keys).any(axis=1))[0]
+            candidates.append(recent + self._merged)
+            rows = np.unique(np.concatenate(candidates))
+            rows = rows[similarities(self._signatures[rows], signature) >= NEAR_DUPLICATE_THRESHOLD]
+            return {self._paper_hashes[paper] for paper in self._papers[rows]}
+
+    # Pick up papers stored since the last refresh, signing any that have not been signed yet
+    def refresh(self):
+        import numpy as np
+
+        # Sessions that find a refresh under way go ahead with the index as it is
+        if time.monotonic() - self._last_refresh < INDEX_REFRESH_INTERVAL or not self._refresh_lock.acquire(blocking=False):
+            return
+        try:
+            self._last_refresh = time.monotonic()
+            with_connection(sign_new_papers)
+            rows = query_all('SELECT paper_id, paper_hash, signatures FROM paper_signatures WHERE paper_id > ? ORDER BY paper_id', (self._last_paper_id,))
+            for paper_id, paper_hash, signatures in rows:
+                self.add(paper_hash, np.frombuffer(signatures, np.uint32).reshape(-1, NUM_PERM))
+                self._last_paper_id = paper_id
+        finally:
+            self._refresh_lock.release()
+
+    def _merge(self):
+        import numpy as np
+
+        keys = self._band_keys[:self._count].ravel()
+        order = np.argsort(keys, kind='stable')
+        self._sorted_keys = keys[order]
+        self._sorted_rows = order // LSH_BANDS
+        self._merged = self._count
+
+# Process-wide similarity index
+@st.cache_resource
+def get_similarity_index():
+    return SimilarityIndex()
+
+# Hash of an earlier paper that most of these questions repeat, if there is one
+def find_similar_paper(questions, exclude_hash=None):
+    if not questions:
+        return None
+    index = get_similarity_index()
+    index.refresh()
+    matches = Counter()
+    for signature in sign_questions(questions):
+        matches.update(index.query(signature) - {exclude_hash})
+    if matches:
+        paper_hash, count = matches.most_common(1)[0]
+        if count >= NEAR_DUPLICATE_PAPER_SHARE * len(questions):
+            return paper_hash
+    return None
+
+def main():
+    argparse.ArgumentParser(description="Sign every stored paper for near-duplicate detection").parse_args()
+    get_pool()
+    total = 0
+    while True:
+        signed = with_connection(sign_new_papers)
+        if not signed:
+            break
+        total += signed
+    print(f"Signed {total} stored papers.")
+
+if __name__ == "__main__":
+    main()
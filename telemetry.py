@@ -0,0 +1,92 @@
+import time
+from contextlib import contextmanager
+
+from db import execute, execute_later, query_all
+
+# How long measurements are kept (in days)
+METRICS_RETENTION_DAYS = 30
+
+# Price per million tokens (prompt, completion) in USD, used to estimate cost on the dashboard
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 10.00),
+}
+
+# Record one measurement. Written by the background writer so the caller never waits on the database.
+def record(feature, duration_ms, subject=None, model=None, ttft_ms=None, prompt_tokens=None, completion_tokens=None, cache_hit=None, error=None):
+    execute_later('''
+                  INSERT INTO metrics (recorded_at, feature, subject, model, duration_ms, ttft_ms, prompt_tokens, completion_tokens, cache_hit, error)
+                  VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                  ''', (time.time(), feature, subject, model, duration_ms, ttft_ms, prompt_tokens, completion_tokens,
+                        None if cache_hit is None else int(cache_hit), error))
+
+# Time the enclosed block and record it under `feature`. The block can add fields to the yielded dict
+# (tokens, time to first token, cache hit); an exception is recorded by its type and re-raised.
+@contextmanager
+def measure(feature, **fields):
+    start = time.perf_counter()
+    try:
+        yield fields
+    except Exception as e:
+        fields["error"] = type(e).__name__
+        raise
+    finally:
+        record(feature, elapsed_ms(start), **fields)
+
+# Milliseconds since a time.perf_counter() reading
+def elapsed_ms(start):
+    return (time.perf_counter() - start) * 1000
+
+# Drop measurements older than the retention period; used as a write-behind job
+def prune_metrics(conn, retention_days=METRICS_RETENTION_DAYS):
+    execute(conn, 'DELETE FROM metrics WHERE recorded_at < ?', (time.time() - retention_days * 86400,))
+
+# Load the measurements recorded in the last `seconds` as a DataFrame. pandas is only imported by the dashboard
+# functions, so that recording measurements does not load it.
+def load_metrics(seconds):
+    import pandas as pd
+
+    rows = query_all('''
+                     SELECT recorded_at, feature, subject, model, duration_ms, ttft_ms, prompt_tokens, completion_tokens, cache_hit, error
+                     FROM metrics WHERE recorded_at >= ?
+                     ''', (time.time() - seconds,))
+    df = pd.DataFrame(rows, columns=["recorded_at", "feature", "subject", "model", "duration_ms", "ttft_ms", "prompt_tokens",
+                                     "completion_tokens", "cache_hit", "error"])
+    df["recorded_at"] = pd.to_datetime(df["recorded_at"], unit="s")
+    for column in ["duration_ms", "ttft_ms", "prompt_tokens", "completion_tokens", "cache_hit"]:
+        df[column] = pd.to_numeric(df[column])
+    df["subject"] = df["subject"].fillna("")
+    return df
+
+# Estimated cost in USD of each measurement's tokens
+def estimate_cost(df):
+    prices = df["model"].map(MODEL_PRICES)
+    prompt_price = prices.map(lambda price: price[0] if isinstance(price, tuple) else 0.0)
+    completion_price = prices.map(lambda price: price[1] if isinstance(price, tuple) else 0.0)
+    return (df["prompt_tokens"].fillna(0) * prompt_price + df["completion_tokens"].fillna(0) * completion_price) / 1_000_000
+
+# Latency percentiles, token usage, cost, cache hits and errors per feature and subject
+def summarize_metrics(df):
+    import pandas as pd
+
+    df = df.assign(cost=estimate_cost(df), failed=df["error"].notna())
+    groups = df.groupby(["feature", "subject"])
+    latency = groups["duration_ms"].quantile([0.5, 0.95, 0.99]).unstack()
+    summary = pd.DataFrame({
+        "Calls": groups.size(),
+        "Errors": groups["failed"].sum(),
+        "p50 (ms)": latency[0.5],
+        "p95 (ms)": latency[0.95],
+        "p99 (ms)": latency[0.99],
+        "p50 TTFT (ms)": groups["ttft_ms"].median(),
+        "Cache hits (%)": groups["cache_hit"].mean() * 100,
+        "Prompt tokens": groups["prompt_tokens"].sum(),
+        "Completion tokens": groups["completion_tokens"].sum(),
+        "Cost (USD)": groups["cost"].sum(),
+    })
+    summary = summary.round({"p50 (ms)": 1, "p95 (ms)": 1, "p99 (ms)": 1, "p50 TTFT (ms)": 1, "Cache hits (%)": 1})
+    return summary.reset_index().rename(columns={"feature": "Feature", "subject": "Subject"})
+
+# p95 latency per feature in each time bucket, for spotting regressions
+def latency_trend(df, bucket="1h"):
+    trend = df.set_index("recorded_at").groupby("feature")["duration_ms"].resample(bucket).quantile(0.95)
+    return trend.unstack("feature")
@@ -0,0 +1,101 @@
+from fractions import Fraction
+
+import pytest
+
+from marking import CHOICE_PATTERN, answer_part, auto_mark, numbers_match, split_submission
+
+
+@pytest.mark.parametrize("text, letter", [
+    ("B", "B"),
+    ("b", "b"),
+    ("(C)", "C"),
+    ("B)", "B"),
+    ("B. 12", "B"),
+    ("D: 7", "D"),
+    ("Option C", "C"),
+    ("  (a) shark", "a"),
+])
+def test_choice_pattern_reads_marked_letters(text, letter):
+    assert CHOICE_PATTERN.match(text).group(1) == letter
+
+
+# Answers starting with the article "A", or with a word starting with a letter, are not options
+@pytest.mark.parametrize("text", ["A noun is a naming word.", "A time I went to the beach", "Bees", "E", "AB", "12"])
+def test_choice_pattern_ignores_words(text):
+    assert CHOICE_PATTERN.match(text) is None
+
+
+def test_split_submission_keeps_numbered_working_with_its_question():
+    text = "Name: Tom\n1. 3/4 of 12 = 9\n2) Working:\n1. 80 / 4 = 20\nAnswer: 20\nQ4: B\n3. late answer\n"
+    segments = split_submission(text, 4)
+    assert segments == {1: "3/4 of 12 = 9", 2: "Working:\n1. 80 / 4 = 20\nAnswer: 20", 4: "B\n3. late answer"}
+    assert answer_part(segments[2]) == "20"
+
+
+def test_split_submission_ignores_numbers_past_the_paper():
+    assert split_submission("1. 5\n7. 12\nQuestion 2: 8", 3) == {1: "5\n7. 12", 2: "8"}
+
+
+@pytest.mark.parametrize("key, student, expected", [
+    ((Fraction(9), 0, False), (Fraction(9), 0, False), True),
+    ((Fraction(9), 0, False), (Fraction(8), 0, False), False),
+    ((Fraction(1, 3), 0, False), (Fraction("0.33"), 2, False), True),
+    ((Fraction(1, 3), 0, False), (Fraction("0.3"), 1, False), False),
+    ((Fraction("0.33"), 2, False), (Fraction(1, 3), 0, False), True),
+    ((Fraction(25), 0, True), (Fraction(25), 0, True), True),
+    # Whether 0.5 answers 50% depends on the question
+    ((Fraction(50), 0, True), (Fraction(1, 2), 1, False), None),
+    ((Fraction(1, 2), 1, False), (Fraction(50), 0, True), None),
+])
+def test_numbers_match(key, student, expected):
+    assert numbers_match(key, student) is expected
+
+
+@pytest.mark.parametrize("key, answer, expected", [
+    ("9", "3/4 of 12 = 9", True),
+    ("9", "9", True),
+    ("9", "8", False),
+    ("9", "", False),
+    ("\\frac{3}{4}", "0.75", True),
+    ("\\frac{3}{4}", "6/8", True),
+    ("\\frac{1}{3}", "0.33", True),
+    ("\\frac{1}{3}", "0.3", False),
+    ("2\\frac{1}{2} hours", "2 1/2 h", True),
+    ("$12.50", "$12.5", True),
+    ("1,250 m", "1250", True),
+    ("45 cm^2", "45 cm²", True),
+    ("83 apples", "45 + 38 = 83", True),
+    ("83 apples", "45 + 38\n83", True),
+    ("12", "Working: 4 x 3\nAnswer: 12", True),
+    ("-3", "-3", True),
+    ("25%", "25 %", True),
+    ("50%", "50 percent", True),
+    ("50%", "0.5", None),
+    ("0.5", "50%", None),
+    # The last line with numbers is neither an equation nor an answer line
+    ("12", "12\nSo 3 boxes", None),
+    ("9 km/h", "9 km/h (rounded to 2 d.p.)", None),
+    ("Length 5 cm, width 3 cm", "5 and 3", None),
+    ("The plant needs sunlight to make food through photosynthesis.", "sunlight", None),
+])
+def test_auto_mark_numbers(key, answer, expected):
+    assert auto_mark(key, answer) is expected
+
+
+@pytest.mark.parametrize("key, answer, expected", [
+    ("B", "b", True),
+    ("A", "a", True),
+    ("(C)", "Answer: B", False),
+    ("B) 12", "A.", False),
+    ("(B) whale", "(B)", True),
+    ("Option C", "C", True),
+    # The option's value may be given instead of its letter
+    ("B) 12", "12", True),
+    ("B: 12", "12", True),
+    ("B", "I think it is the second one", None),
+    ("B", "A noun", None),
+    ("A noun is a naming word.", "A verb", None),
+    ("(A) shark", "A time I saw one", None),
+])
+def test_auto_mark_choices(key, answer, expected):
+    assert auto_mark(key, answer) is expected